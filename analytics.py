@@ -0,0 +1,302 @@
+from collections import namedtuple
+import numpy as np
+from sqlalchemy import select
+from models import AssetPriceHistory, Portfolio, db, format_date
+from price_cube import price_cube
+
+TRADING_DAYS = 252
+
+price_table = AssetPriceHistory.__table__
+portfolio_table = Portfolio.__table__
+
+
+def to_float(value):
+    """numpy scalar -> float, NaN and infinities -> None so they serialize to null."""
+    value = float(value)
+    return value if np.isfinite(value) else None
+
+
+def load_price_rows(filters):
+    """Returns (asset types, dates, prices) arrays for the matching rows,
+    ordered by asset type and date."""
+    statement = select(price_table.c.asset_type, price_table.c.date, price_table.c.price) \
+        .where(*filters) \
+        .order_by(price_table.c.asset_type, price_table.c.date)
+    rows = db.session.execute(statement).fetchall()
+    if not rows:
+        return np.array([], dtype=object), np.array([], dtype='datetime64[D]'), np.array([], dtype=np.float64)
+
+    asset_types, dates, prices = zip(*rows)
+    return (np.array(asset_types, dtype=object),
+            np.array(dates, dtype='datetime64[D]'),
+            np.array(prices, dtype=np.float64))
+
+
+def load_series_rows(filters):
+    """Returns (portfolio ids, asset types, dates, prices) arrays for the
+    matching rows."""
+    statement = select(price_table.c.portfolio_id, price_table.c.asset_type, price_table.c.date,
+                       price_table.c.price) \
+        .where(*filters)
+    rows = db.session.execute(statement).fetchall()
+    if not rows:
+        return (np.array([], dtype=np.int64), np.array([], dtype=object),
+                np.array([], dtype='datetime64[D]'), np.array([], dtype=np.float64))
+
+    portfolio_ids, asset_types, dates, prices = zip(*rows)
+    return (np.array(portfolio_ids, dtype=np.int64),
+            np.array(asset_types, dtype=object),
+            np.array(dates, dtype='datetime64[D]'),
+            np.array(prices, dtype=np.float64))
+
+
+def series_keys(portfolio_ids, asset_types):
+    """Numbers every distinct (portfolio id, asset type) pair. Returns the
+    column index of every row plus the portfolio id and asset type of every
+    column."""
+    type_names, type_codes = np.unique(asset_types, return_inverse=True)
+    combined = portfolio_ids * len(type_names) + type_codes.reshape(-1)
+    keys, column_index = np.unique(combined, return_inverse=True)
+    return column_index.reshape(-1), keys // len(type_names), type_names[keys % len(type_names)]
+
+
+def forward_fill(matrix):
+    """Carries the last valid value of every column forward, leading gaps stay NaN."""
+    index = np.where(np.isnan(matrix), 0, np.arange(len(matrix))[:, None])
+    np.maximum.accumulate(index, axis=0, out=index)
+    return matrix[index, np.arange(matrix.shape[1])]
+
+
+def align_prices(column_index, dates, prices, columns):
+    """Scatters the rows into a date x column matrix and forward-fills the gaps.
+    Returns the sorted date axis and the matrix."""
+    date_axis, row_index = np.unique(dates, return_inverse=True)
+    matrix = np.full((len(date_axis), columns), np.nan)
+    matrix[row_index.reshape(-1), column_index] = prices
+    return date_axis, forward_fill(matrix)
+
+
+def blend(matrix, weights):
+    """Rebases every column to 1 and applies the weights as one matrix-vector
+    product."""
+    return (matrix / matrix[0]) @ (weights / weights.sum())
+
+
+def relative_metrics(nav, benchmark_nav, periods_per_year=TRADING_DAYS):
+    """Tracking error, information ratio, beta and active return of `nav`
+    against `benchmark_nav`."""
+    returns = simple_returns(nav)
+    benchmark_returns = simple_returns(benchmark_nav)
+    active = returns - benchmark_returns
+    metrics = {
+        'active_return': None,
+        'tracking_error': None,
+        'information_ratio': None,
+        'beta': None
+    }
+    if len(active) < 2:
+        return metrics
+
+    active_return = active.mean() * periods_per_year
+    tracking_error = active.std(ddof=1) * np.sqrt(periods_per_year)
+    covariance = np.cov(returns, benchmark_returns)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        metrics.update({
+            'active_return': to_float(active_return),
+            'tracking_error': to_float(tracking_error),
+            'information_ratio': to_float(active_return / tracking_error),
+            'beta': to_float(covariance[0, 1] / covariance[1, 1])
+        })
+    return metrics
+
+
+def load_series_matrix(portfolio_ids, start=None, end=None):
+    """Returns the portfolio id and asset type of every price series of the
+    portfolios, their date axis and the forward-filled date x series price
+    matrix, or None when they have no prices. Read from the price cube when
+    it is enabled, with the same result as the query."""
+    if price_cube.enabled:
+        keys = price_cube.keys(set(portfolio_ids))
+        dates, matrix = price_cube.window(keys, start, end)
+        has_prices = ~np.isnan(matrix)
+        columns = has_prices.any(axis=0)
+        if not columns.any():
+            return None
+        rows = has_prices.any(axis=1)
+        keys = [key for key, column in zip(keys, columns) if column]
+        return (np.array([portfolio_id for portfolio_id, _ in keys], dtype=np.int64),
+                np.array([asset_type for _, asset_type in keys], dtype=object),
+                dates[rows], forward_fill(matrix[rows][:, columns]))
+
+    filters = [price_table.c.portfolio_id.in_(list(portfolio_ids))]
+    if start is not None:
+        filters.append(price_table.c.date >= start)
+    if end is not None:
+        filters.append(price_table.c.date <= end)
+
+    row_portfolios, asset_types, dates, prices = load_series_rows(filters)
+    if len(prices) == 0:
+        return None
+
+    column_index, column_portfolios, column_types = series_keys(row_portfolios, asset_types)
+    date_axis, matrix = align_prices(column_index, dates, prices, len(column_portfolios))
+    return column_portfolios, column_types, date_axis, matrix
+
+
+Allocation = namedtuple('Allocation', 'dates prices portfolio_ids asset_types benchmark weights')
+
+
+def load_allocation(portfolio_ids=None, start=None, end=None):
+    """Loads the price series of the portfolios into an aligned date x series
+    matrix.
+
+    Every portfolio row is an asset class with a weight. Its price rows whose
+    asset type equals its `benchmark_desc` make up its benchmark, the other
+    rows are its own series. When a portfolio has several series the weight is
+    split evenly between them. The matrix starts on the first date where every
+    series has a price. Returns None when there is no price data.
+    """
+    statement = select(portfolio_table.c.id, portfolio_table.c.weight, portfolio_table.c.benchmark_desc) \
+        .order_by(portfolio_table.c.id)
+    if portfolio_ids is not None:
+        statement = statement.where(portfolio_table.c.id.in_(portfolio_ids))
+    portfolios = db.session.execute(statement).fetchall()
+    if not portfolios:
+        return None
+
+    weights = {portfolio_id: weight for portfolio_id, weight, _ in portfolios}
+    benchmarks = {portfolio_id: benchmark for portfolio_id, _, benchmark in portfolios}
+    series = load_series_matrix(list(weights), start, end)
+    if series is None:
+        return None
+
+    column_portfolios, column_types, date_axis, matrix = series
+    is_benchmark = np.array([asset_type == benchmarks[portfolio_id]
+                             for portfolio_id, asset_type in zip(column_portfolios.tolist(), column_types)], dtype=bool)
+    column_weights = np.array([weights[portfolio_id] for portfolio_id in column_portfolios.tolist()])
+
+    # split each portfolio's weight between its own series (and its benchmark series)
+    for mask in (~is_benchmark, is_benchmark):
+        _, inverse, counts = np.unique(column_portfolios[mask], return_inverse=True, return_counts=True)
+        column_weights[mask] = column_weights[mask] / counts[inverse.reshape(-1)]
+
+    # start on the first date where every series has a price
+    first_valid = np.argmax(~np.isnan(matrix), axis=0).max()
+    return Allocation(date_axis[first_valid:], matrix[first_valid:], column_portfolios, column_types,
+                      is_benchmark, column_weights)
+
+
+def aggregate_portfolios(portfolio_ids=None, start=None, end=None, periods_per_year=TRADING_DAYS):
+    """Blends the price series of the portfolios by their weights, see
+    `load_allocation`. The dates and NAVs are arrays. Returns None when there
+    is nothing to blend."""
+    allocation = load_allocation(portfolio_ids, start, end)
+    if allocation is None or len(allocation.dates) == 0 or allocation.benchmark.all():
+        return None
+
+    assets = ~allocation.benchmark
+    nav = blend(allocation.prices[:, assets], allocation.weights[assets])
+    result = {
+        'dates': allocation.dates,
+        'nav': nav,
+        'benchmark_nav': None,
+        'stats': performance_stats(nav, periods_per_year),
+        'metrics': None,
+        'series': [{
+            'portfolio_id': int(portfolio_id),
+            'asset_type': asset_type,
+            'benchmark': bool(benchmark),
+            'weight': to_float(weight)
+        } for portfolio_id, asset_type, benchmark, weight in zip(
+            allocation.portfolio_ids, allocation.asset_types, allocation.benchmark, allocation.weights)]
+    }
+    if allocation.benchmark.any():
+        benchmark_nav = blend(allocation.prices[:, allocation.benchmark], allocation.weights[allocation.benchmark])
+        result['benchmark_nav'] = benchmark_nav
+        result['metrics'] = relative_metrics(nav, benchmark_nav, periods_per_year)
+    return result
+
+
+def split_series(keys, *arrays):
+    """Splits arrays sorted by `keys` into one slice (a view) per distinct key."""
+    if len(keys) == 0:
+        return {}
+    boundaries = np.flatnonzero(keys[1:] != keys[:-1]) + 1
+    starts = np.concatenate(([0], boundaries))
+    ends = np.concatenate((boundaries, [len(keys)]))
+    return {keys[start]: tuple(array[start:end] for array in arrays) for start, end in zip(starts, ends)}
+
+
+def simple_returns(prices):
+    return prices[1:] / prices[:-1] - 1.0
+
+
+def log_returns(prices):
+    return np.diff(np.log(prices))
+
+
+def drawdowns(prices):
+    """Returns the drawdown series and, for every point, the number of periods
+    since the last peak."""
+    running_max = np.maximum.accumulate(prices)
+    index = np.arange(len(prices))
+    last_peak = np.maximum.accumulate(np.where(prices >= running_max, index, 0))
+    return prices / running_max - 1.0, index - last_peak
+
+
+def performance_stats(prices, periods_per_year=TRADING_DAYS, risk_free=0.0):
+    """Computes the summary statistics of a price series in one vectorized
+    pass. `risk_free` is an annual rate."""
+    prices = np.asarray(prices, dtype=np.float64)
+    observations = len(prices)
+    stats = {
+        'observations': observations,
+        'cumulative_return': None,
+        'annualized_return': None,
+        'mean_simple_return': None,
+        'mean_log_return': None,
+        'annualized_volatility': None,
+        'sharpe_ratio': None,
+        'max_drawdown': None,
+        'max_drawdown_duration': None
+    }
+    if observations < 2:
+        return stats
+
+    simple = simple_returns(prices)
+    logs = log_returns(prices)
+    drawdown, duration = drawdowns(prices)
+
+    cumulative = prices[-1] / prices[0] - 1.0
+    annualized_return = np.exp(logs.sum() * periods_per_year / len(logs)) - 1.0
+    volatility = simple.std(ddof=1) * np.sqrt(periods_per_year) if len(simple) > 1 else np.nan
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sharpe = (simple.mean() * periods_per_year - risk_free) / volatility
+
+    stats.update({
+        'cumulative_return': to_float(cumulative),
+        'annualized_return': to_float(annualized_return),
+        'mean_simple_return': to_float(simple.mean()),
+        'mean_log_return': to_float(logs.mean()),
+        'annualized_volatility': to_float(volatility),
+        'sharpe_ratio': to_float(sharpe),
+        'max_drawdown': to_float(drawdown.min()),
+        'max_drawdown_duration': int(duration.max())
+    })
+    return stats
+
+
+def portfolio_analytics(filters, periods_per_year=TRADING_DAYS, risk_free=0.0):
+    """Returns the performance statistics of every asset type matching the
+    filters."""
+    asset_types, dates, prices = load_price_rows(filters)
+    analytics = []
+    for asset_type, (series_dates, series_prices) in split_series(asset_types, dates, prices).items():
+        stats = performance_stats(series_prices, periods_per_year, risk_free)
+        analytics.append({
+            'asset_type': asset_type,
+            'start': format_date(series_dates[0].item()),
+            'end': format_date(series_dates[-1].item()),
+            **stats
+        })
+    return analytics
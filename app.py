@@ -1,181 +1,476 @@
-from functools import wraps
-import os, json
 from flask import (
+    Blueprint,
     Flask,
+    Response,
     request,
     abort, 
-    jsonify)
+    jsonify,
+    stream_with_context)
 from flask_cors import CORS
-from urllib.request import urlopen
-from jose import jwt
-from models import AssetPriceHistory, Portfolio, setup_db
-
-AUTH0_DOMAIN = os.environ['AUTH0_DOMAIN']
-API_AUDIENCE = os.environ['API_AUDIENCE'] 
-ALGORITHMS = ['RS256']
+import click
+import math
+import os
+from sqlalchemy.exc import OperationalError
+from analytics import TRADING_DAYS, aggregate_portfolios, portfolio_analytics
+from auth import AuthError, init_auth, requires_auth
+from backtest import BACKTEST_SCHEDULES, MAX_SWEEP_RUNS, backtest, backtest_sweep, sweep_runs
+from columnar import row_columns
+from corrections import MAX_PATCH_ITEMS, PATCH_MODES, apply_patches
+from covariance import covariance_cache
+from export import EXPORT_FORMATS, export_price_rows
+from ingest import INGEST_CHUNK_SIZE, INGEST_FORMATS, ingest_lines
+from ingest_queue import QueueFull, ingest_queue
+from instrumentation import init_instrumentation
+from models import AssetPriceHistory, AssetPriceRollup, Portfolio, parse_date, price_history_filters, setup_db
+from pagination import keyset_page, keyset_rows, page_args
+from price_cube import price_cube
+from resample import RESAMPLE_INTERVALS, bar_columns, format_bars, resample_bars, rollups
+from response_cache import conditional
+from risk import MAX_SCENARIOS, RISK_METHODS, portfolio_risk
+from rolling import DEFAULT_ROLLING_WINDOWS, MAX_ROLLING_WINDOWS, ROLLING_METRICS, rolling_statistics
+from serialization import json_response, negotiated_response, wants_columnar
+from snapshots import snapshot_as_of, snapshot_payload, snapshots
+from stats_cache import stats_cache
+from workers import jobs
+
+
+api = Blueprint('api', __name__, cli_group=None)
 
 
 def create_app(test_config=None):
-  # create and configure the app
+  """Builds the application. Settings come from `test_config` and fall back
+  to the environment, nothing touches the database until a request does.
+  The schema is managed with `flask db upgrade`."""
   app = Flask(__name__)
-  setup_db(app)
+  app.config.from_mapping(
+      DATABASE_URL=os.environ.get('DATABASE_URL'),
+      REPLICA_DATABASE_URL=os.environ.get('REPLICA_DATABASE_URL'),
+      AUTH0_DOMAIN=os.environ.get('AUTH0_DOMAIN'),
+      API_AUDIENCE=os.environ.get('API_AUDIENCE'),
+      JWKS_URL=os.environ.get('JWKS_URL'))
+  if test_config is not None:
+      app.config.from_mapping(test_config)
+
+  if not app.config['DATABASE_URL']:
+      raise RuntimeError('DATABASE_URL is not set')
+
+  setup_db(app, app.config['DATABASE_URL'], app.config['REPLICA_DATABASE_URL'])
+  init_auth(app)
   CORS(app)
+  init_instrumentation(app)
+  ingest_queue.init_app(app)
+  snapshots.init_app(app)
+  app.register_blueprint(api)
   return app
 
 
-app = create_app()
+@api.route('/portfolios')
+@requires_auth('get:portfolios')
+def get_portfolios(jwt):
+    if 'as_of' in request.args:
+        return get_portfolio_snapshots()
+    return list_portfolios()
 
 
-class AuthError(Exception):
-    def __init__(self, error, status_code):
-        self.error = error
-        self.status_code = status_code
+@conditional(Portfolio.__tablename__)
+def list_portfolios():
+    try:
+        fields, after, limit = page_args(Portfolio)
+    except ValueError:
+        abort(400)
 
+    portfolios, next_cursor = keyset_page(Portfolio, fields, after, limit)
 
-def get_token_auth_header():
-    """Obtains the Access Token from the Authorization Header
-    """
-    auth = request.headers.get('Authorization', None)
-    if not auth:
-        raise AuthError({
-            'code': 'authorization_header_missing',
-            'description': 'Authorization header is expected.'
-        }, 401)
-    
-    parts = auth.split()
-
-    if parts[0].lower() != 'bearer':
-        raise AuthError({
-            'code': 'invalid_header',
-            'description': 'Authorization header must start with "Bearer".'
-        }, 401)
-    elif len(parts) == 1:
-        raise AuthError({
-            'code': 'invalid_header',
-            'description': 'Token not found.'
-        }, 401)
-    elif len(parts) > 2:
-        raise AuthError({
-            'code': 'invalid_header',
-            'description': 'Authorization header must be bearer token.'
-        }, 401)
-    
-    token = parts[1]
-    return token
-
-
-def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
-    unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
-    if 'kid' not in unverified_header:
-        raise AuthError({
-            'code': 'invalid_header',
-            'description': 'Authorization malformed.'
-        }, 401)
-
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
-
-    if rsa_key:
-        try:
-            payload = jwt.decode(
-                token,
-                rsa_key,
-                algorithms=ALGORITHMS,
-                audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
-            )
-            return payload
-        except jwt.ExpiredSignatureError:
-            raise AuthError({
-                'code': 'token_expired',
-                'description': 'Token expired.'
-            }, 401)
-        except jwt.JWTClaimsError:
-            raise AuthError({
-                'code': 'invalid_claims',
-                'description': 'Incorrect claims. Please, check the audience and issuer.'
-            }, 401)
-        except Exception:
-            raise AuthError({
-                'code': 'invalid_header',
-                'description': 'Unable to parse authentication token.'
-            }, 400)
-    raise AuthError({
-        'code': 'invalid_header',
-                'description': 'Unable to find the appropriate key.'
-    }, 400)
-
-
-def check_permissions(permission, payload):
-    if 'permissions' not in payload:
-        raise AuthError({
-            'code': 'invalid_claims',
-            'description': 'Permissions not included in JWT.'
-        }, 400)
-
-    if permission not in payload['permissions']:
-        raise AuthError({
-            'code': 'unauthorized',
-            'description': 'Permission not found.'
-        }, 403)
-    return True
-
-
-def requires_auth(permission=''):
-    def requires_auth_decorater(f):
-        @wraps(f)
-        def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            try:
-                payload = verify_decode_jwt(token)
-                check_permissions(permission, payload)
-            except Exception:
-                abort(401)
-            return f(payload, *args, **kwargs)
-
-        return wrapper
-    return requires_auth_decorater
-
-
-@app.route('/portfolios')
+    if len(portfolios) == 0 and after is None:
+        abort(404)
+
+    return json_response({
+        'success': True,
+        'portfolios': portfolios,
+        'next_cursor': next_cursor
+    })
+
+
+def get_portfolio_snapshots():
+    try:
+        as_of = parse_date(request.args['as_of'])
+        ids = request.args.get('ids')
+        portfolio_ids = [int(id) for id in ids.split(',')] if ids else None
+    except ValueError:
+        abort(400)
+
+    rows = snapshot_as_of(as_of, portfolio_ids)
+
+    if len(rows) == 0:
+        abort(404)
+
+    return negotiated_response(snapshot_payload(rows, wants_columnar()))
+
+
+@api.route('/portfolios/aggregate')
 @requires_auth('get:portfolios')
-def get_portfolios(jwt):
-    portfolios = Portfolio.query.all()
+def get_portfolios_aggregate(jwt):
+    try:
+        ids = request.args.get('ids')
+        portfolio_ids = [int(id) for id in ids.split(',')] if ids else None
+        start = parse_date(request.args['start']) if 'start' in request.args else None
+        end = parse_date(request.args['end']) if 'end' in request.args else None
+        periods_per_year = int(request.args.get('periods_per_year', TRADING_DAYS))
+    except ValueError:
+        abort(400)
+
+    if periods_per_year < 1:
+        abort(400)
+
+    aggregate = aggregate_portfolios(portfolio_ids, start, end, periods_per_year)
 
-    if len(portfolios) == 0:
+    if aggregate is None:
         abort(404)
 
+    return negotiated_response({
+        'success': True,
+        **aggregate
+    })
+
+
+@api.route('/portfolios/<int:id>/analytics')
+@requires_auth('get:portfolios')
+def get_portfolio_analytics(jwt, id):
+    portfolio = Portfolio.query.filter(Portfolio.id == id).one_or_none()
+
+    if portfolio is None:
+        abort(404)
+
+    try:
+        periods_per_year = int(request.args.get('periods_per_year', TRADING_DAYS))
+        risk_free = float(request.args.get('risk_free', 0.0))
+        filters = price_history_filters({
+            'portfolio_id': id,
+            'asset_type': request.args.get('asset_type'),
+            'start': request.args.get('start'),
+            'end': request.args.get('end')
+        })
+    except ValueError:
+        abort(400)
+
+    if periods_per_year < 1:
+        abort(400)
+
+    if 'start' in request.args or 'end' in request.args:
+        analytics = portfolio_analytics(filters, periods_per_year, risk_free)
+    else:
+        # the full history is served from the incrementally maintained cache
+        asset_type = request.args.get('asset_type')
+        analytics = [
+            dict(asset_type=name, **series.snapshot(periods_per_year, risk_free))
+            for name, series in sorted(stats_cache.get(id).items())
+            if asset_type is None or name == asset_type
+        ]
+
+    if len(analytics) == 0:
+        abort(404)
+
+    return negotiated_response({
+        'success': True,
+        'portfolio_id': id,
+        'analytics': analytics
+    })
+
+
+@api.route('/portfolios/analytics/cache')
+@requires_auth('get:portfolios')
+def get_portfolio_analytics_cache(jwt):
     return jsonify({
         'success': True,
-        'portfolios': [portfolio.format() for portfolio in portfolios]
+        'cache': stats_cache.stats()
     }), 200
 
 
-@app.route('/asset_price_histories')
+@api.route('/portfolios/risk', methods=['POST'])
+@requires_auth('get:portfolios')
+def create_risk_job(jwt):
+    body = request.get_json() or {}
+
+    try:
+        ids = body.get('ids')
+        portfolio_ids = [int(id) for id in ids] if ids is not None else None
+        method = body.get('method', 'monte_carlo')
+        confidence = float(body.get('confidence', 0.99))
+        horizon = int(body.get('horizon_days', 1))
+        scenarios = int(body.get('scenarios', 100000))
+        seed = int(body['seed']) if body.get('seed') is not None else None
+        start = parse_date(body['start']) if body.get('start') else None
+        end = parse_date(body['end']) if body.get('end') else None
+    except (TypeError, ValueError):
+        abort(400)
+
+    if method not in RISK_METHODS or not 0 < confidence < 1 or horizon < 1 \
+            or not 0 < scenarios <= MAX_SCENARIOS or (seed is not None and seed < 0):
+        abort(422)
+
+    job_id = jobs.submit('risk', portfolio_risk, portfolio_ids, start, end, method, confidence,
+                         horizon, scenarios, seed)
+
+    return jsonify({
+        'success': True,
+        'job_id': job_id
+    }), 202, {'Location': '/risk_jobs/{}'.format(job_id)}
+
+
+@api.route('/risk_jobs/<job_id>')
+@requires_auth('get:portfolios')
+def get_risk_job(jwt, job_id):
+    job = jobs.get(job_id)
+
+    if job is None or job['kind'] != 'risk':
+        abort(404)
+
+    return jsonify({
+        'success': True,
+        'job': job
+    }), 200
+
+
+@api.route('/portfolios/backtest', methods=['POST'])
+@requires_auth('get:portfolios')
+def create_backtest(jwt):
+    body = request.get_json() or {}
+
+    try:
+        ids = body.get('ids')
+        portfolio_ids = [int(id) for id in ids] if ids is not None else None
+        schedule = body.get('schedule', 'monthly')
+        band = float(body.get('band', 0.05))
+        cost_bps = float(body.get('cost_bps', 0.0))
+        start = parse_date(body['start']) if body.get('start') else None
+        end = parse_date(body['end']) if body.get('end') else None
+        periods_per_year = int(body.get('periods_per_year', TRADING_DAYS))
+    except (TypeError, ValueError):
+        abort(400)
+
+    if schedule not in BACKTEST_SCHEDULES or not 0 < band < 1 or not 0 <= cost_bps < 10000 \
+            or periods_per_year < 1:
+        abort(422)
+
+    result = backtest(portfolio_ids, start, end, schedule, band, cost_bps, periods_per_year)
+
+    if result is None:
+        abort(404)
+
+    return negotiated_response({
+        'success': True,
+        **result
+    })
+
+
+@api.route('/portfolios/backtest/sweep', methods=['POST'])
+@requires_auth('get:portfolios')
+def create_backtest_sweep_job(jwt):
+    body = request.get_json() or {}
+
+    try:
+        ids = body.get('ids')
+        portfolio_ids = [int(id) for id in ids] if ids is not None else None
+        schedules = list(body.get('schedules', BACKTEST_SCHEDULES))
+        bands = [float(band) for band in body.get('bands', [0.05])]
+        costs_bps = [float(cost_bps) for cost_bps in body.get('costs_bps', [0.0])]
+        start = parse_date(body['start']) if body.get('start') else None
+        end = parse_date(body['end']) if body.get('end') else None
+        periods_per_year = int(body.get('periods_per_year', TRADING_DAYS))
+    except (TypeError, ValueError):
+        abort(400)
+
+    if not schedules or any(schedule not in BACKTEST_SCHEDULES for schedule in schedules) \
+            or not bands or any(not 0 < band < 1 for band in bands) \
+            or not costs_bps or any(not 0 <= cost_bps < 10000 for cost_bps in costs_bps) \
+            or periods_per_year < 1 or len(sweep_runs(schedules, bands, costs_bps)) > MAX_SWEEP_RUNS:
+        abort(422)
+
+    job_id = jobs.submit('backtest', backtest_sweep, portfolio_ids, start, end, schedules, bands, costs_bps,
+                         periods_per_year)
+
+    return jsonify({
+        'success': True,
+        'job_id': job_id
+    }), 202, {'Location': '/backtest_jobs/{}'.format(job_id)}
+
+
+@api.route('/backtest_jobs/<job_id>')
+@requires_auth('get:portfolios')
+def get_backtest_job(jwt, job_id):
+    job = jobs.get(job_id)
+
+    if job is None or job['kind'] != 'backtest':
+        abort(404)
+
+    return jsonify({
+        'success': True,
+        'job': job
+    }), 200
+
+
+@api.route('/asset_price_histories')
 @requires_auth('get:asset_price_histories')
+@conditional(AssetPriceHistory.__tablename__)
 def get_asset_price_histories(jwt):
-    asset_price_histories = AssetPriceHistory.query.all()
+    try:
+        fields, after, limit = page_args(AssetPriceHistory)
+        filters = price_history_filters(request.args)
+    except ValueError:
+        abort(400)
+
+    if wants_columnar():
+        rows, next_cursor = keyset_rows(AssetPriceHistory, fields, after, limit, filters)
+        asset_price_histories = row_columns(AssetPriceHistory.__table__, fields, rows)
+    else:
+        asset_price_histories, next_cursor = keyset_page(AssetPriceHistory, fields, after, limit, filters)
+        rows = asset_price_histories
     
-    if len(asset_price_histories) == 0:
+    if len(rows) == 0 and after is None:
         abort(404) 
     
-    return jsonify({
+    return negotiated_response({
         'success': True,
-        'asset_price_histories': [asset_price_history.format() for asset_price_history in asset_price_histories]
-    }), 200
+        'asset_price_histories': asset_price_histories,
+        'next_cursor': next_cursor
+    })
+
+
+@api.route('/asset_price_histories/resample')
+@requires_auth('get:asset_price_histories')
+@conditional(AssetPriceHistory.__tablename__, AssetPriceRollup.__tablename__)
+def resample_asset_price_histories(jwt):
+    interval = request.args.get('interval', 'day')
+    asset_type = request.args.get('asset_type')
 
+    try:
+        portfolio_id = int(request.args['portfolio_id'])
+        start = parse_date(request.args['start']) if 'start' in request.args else None
+        end = parse_date(request.args['end']) if 'end' in request.args else None
+    except (KeyError, ValueError):
+        abort(400)
+
+    if interval not in RESAMPLE_INTERVALS or not asset_type or (start and end and start > end):
+        abort(400)
+
+    bars = resample_bars(portfolio_id, asset_type, interval, start, end)
+
+    if len(bars) == 0:
+        abort(404)
+
+    return negotiated_response({
+        'success': True,
+        'portfolio_id': portfolio_id,
+        'asset_type': asset_type,
+        'interval': interval,
+        'bars': bar_columns(bars) if wants_columnar() else format_bars(bars)
+    })
+
+
+@api.route('/asset_price_histories/rolling')
+@requires_auth('get:asset_price_histories')
+@conditional(AssetPriceHistory.__tablename__, Portfolio.__tablename__)
+def get_rolling_statistics(jwt):
+    try:
+        ids = request.args.get('ids')
+        portfolio_ids = [int(id) for id in ids.split(',')] if ids else None
+        windows = sorted({int(window) for window in request.args['windows'].split(',')}) \
+            if 'windows' in request.args else list(DEFAULT_ROLLING_WINDOWS)
+        benchmark = None
+        if 'benchmark' in request.args:
+            benchmark_id, _, benchmark_type = request.args['benchmark'].partition(':')
+            benchmark = (int(benchmark_id), benchmark_type)
+        start = parse_date(request.args['start']) if 'start' in request.args else None
+        end = parse_date(request.args['end']) if 'end' in request.args else None
+        periods_per_year = int(request.args.get('periods_per_year', TRADING_DAYS))
+    except ValueError:
+        abort(400)
+
+    default_metrics = ROLLING_METRICS if benchmark is not None else ('volatility', 'correlation')
+    metrics = request.args['metrics'].split(',') if 'metrics' in request.args else default_metrics
+
+    if any(metric not in ROLLING_METRICS for metric in metrics) or ('beta' in metrics and benchmark is None) \
+            or (benchmark is not None and not benchmark[1]) or not 0 < len(windows) <= MAX_ROLLING_WINDOWS \
+            or windows[0] < 2 or periods_per_year < 1 or (start and end and start > end):
+        abort(400)
+
+    try:
+        statistics = rolling_statistics(portfolio_ids, request.args.get('asset_type'), benchmark, windows,
+                                        metrics, start, end, periods_per_year)
+    except ValueError:
+        abort(422)
+
+    if statistics is None:
+        abort(404)
+
+    return negotiated_response({
+        'success': True,
+        **statistics
+    })
 
-@app.route('/portfolios', methods=['POST'])
+
+@api.route('/asset_price_histories/covariance')
+@requires_auth('get:asset_price_histories')
+# the estimates are cached by covariance_cache, in any response format
+@conditional(AssetPriceHistory.__tablename__, Portfolio.__tablename__, cache=False)
+def get_covariance(jwt):
+    try:
+        ids = request.args.get('ids')
+        portfolio_ids = [int(id) for id in ids.split(',')] if ids else None
+        series = None
+        if 'series' in request.args:
+            series = []
+            for item in request.args['series'].split(','):
+                portfolio_id, _, asset_type = item.partition(':')
+                series.append((int(portfolio_id), asset_type))
+        start = parse_date(request.args['start']) if 'start' in request.args else None
+        end = parse_date(request.args['end']) if 'end' in request.args else None
+        periods_per_year = int(request.args.get('periods_per_year', TRADING_DAYS))
+    except ValueError:
+        abort(400)
+
+    if (series is not None and not all(asset_type for _, asset_type in series)) or periods_per_year < 1 \
+            or (start and end and start > end):
+        abort(400)
+
+    try:
+        estimates = covariance_cache.get(portfolio_ids, series, request.args.get('asset_type'), start, end,
+                                         periods_per_year)
+    except ValueError:
+        abort(422)
+
+    if estimates is None:
+        abort(404)
+
+    return negotiated_response({
+        'success': True,
+        **estimates
+    })
+
+
+@api.route('/asset_price_histories/export')
+@requires_auth('get:asset_price_histories')
+def export_asset_price_histories(jwt):
+    export_format = request.args.get('format', 'ndjson')
+    gzip = request.args.get('gzip', 'false').lower() in ('1', 'true')
+
+    if export_format not in EXPORT_FORMATS:
+        abort(400)
+
+    try:
+        filters = price_history_filters(request.args)
+    except ValueError:
+        abort(400)
+
+    chunks = export_price_rows(export_format, filters, gzip)
+    response = Response(stream_with_context(chunks), mimetype=EXPORT_FORMATS[export_format])
+    response.headers['Content-Disposition'] = 'attachment; filename=asset_price_histories.{}'.format(export_format)
+    if gzip:
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+@api.route('/portfolios', methods=['POST'])
 @requires_auth('post:portfolios')
 def create_portfolio(jwt):
     body = request.get_json()
@@ -201,7 +496,100 @@ def create_portfolio(jwt):
         abort(422)
 
 
-@app.route('/asset_price_histories/<int:id>/edit', methods=['PATCH'])
+@api.route('/asset_price_histories/bulk', methods=['POST'])
+@requires_auth('post:asset_price_histories')
+def bulk_create_asset_price_histories(jwt):
+    default_format = 'csv' if request.mimetype == 'text/csv' else 'ndjson'
+    ingest_format = request.args.get('format', default_format)
+
+    try:
+        chunk_size = int(request.args.get('chunk_size', INGEST_CHUNK_SIZE))
+    except ValueError:
+        abort(400)
+
+    if ingest_format not in INGEST_FORMATS or chunk_size < 1:
+        abort(400)
+
+    result = ingest_lines(request.stream, ingest_format, chunk_size)
+
+    return jsonify({
+        'success': True,
+        **result
+    }), 200
+
+
+@api.route('/asset_price_histories/queue', methods=['POST'])
+@requires_auth('post:asset_price_histories')
+def enqueue_asset_price_histories(jwt):
+    body = request.get_json()
+    records = body if isinstance(body, list) else [body]
+
+    if len(records) == 0:
+        abort(422)
+
+    try:
+        first, last = ingest_queue.submit(records)
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': 422,
+            'message': str(e)
+        }), 422
+    except QueueFull:
+        return jsonify({
+            'success': False,
+            'error': 429,
+            'message': 'ingest queue full'
+        }), 429, {'Retry-After': str(max(1, math.ceil(ingest_queue.flush_interval)))}
+
+    return jsonify({
+        'success': True,
+        'accepted': len(records),
+        'first_sequence': first,
+        'last_sequence': last
+    }), 202
+
+
+@api.route('/asset_price_histories/queue')
+@requires_auth('get:asset_price_histories')
+def get_ingest_queue(jwt):
+    return jsonify({
+        'success': True,
+        'queue': ingest_queue.stats(),
+        'errors': ingest_queue.last_errors
+    }), 200
+
+
+@api.route('/asset_price_histories/bulk', methods=['PATCH'])
+@requires_auth('patch:asset_price_histories')
+def bulk_edit_asset_price_histories(jwt):
+    body = request.get_json()
+    patches = body.get('patches') if isinstance(body, dict) else body
+    mode = body.get('mode', 'atomic') if isinstance(body, dict) else 'atomic'
+
+    if not isinstance(patches, list) or mode not in PATCH_MODES:
+        abort(400)
+
+    if len(patches) == 0 or len(patches) > MAX_PATCH_ITEMS:
+        abort(422)
+
+    result = apply_patches(patches, mode)
+
+    if result['updated'] == 0 and result['errors']:
+        return jsonify({
+            'success': False,
+            'error': 422,
+            'message': 'unprocessable',
+            **result
+        }), 422
+
+    return jsonify({
+        'success': True,
+        **result
+    }), 200
+
+
+@api.route('/asset_price_histories/<int:id>/edit', methods=['PATCH'])
 @requires_auth('patch:asset_price_histories')
 def edit_asset_price_history(jwt, id):
     body = request.get_json()
@@ -237,7 +625,7 @@ def edit_asset_price_history(jwt, id):
         abort(422)
 
 
-@app.route('/portfolios/<int:id>', methods=['DELETE'])
+@api.route('/portfolios/<int:id>', methods=['DELETE'])
 @requires_auth('delete:portfolios')
 def delete_portfolio(jwt, id):
     try:
@@ -258,9 +646,55 @@ def delete_portfolio(jwt, id):
         abort(422)
 
 
+@api.cli.command('ingest-prices')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'ingest_format', type=click.Choice(INGEST_FORMATS), default=None,
+              help='Defaults to the file extension.')
+@click.option('--chunk-size', default=INGEST_CHUNK_SIZE, show_default=True)
+def ingest_prices_command(path, ingest_format, chunk_size):
+    """Bulk loads asset price histories from an NDJSON or CSV file."""
+    if ingest_format is None:
+        ingest_format = 'csv' if path.lower().endswith('.csv') else 'ndjson'
+
+    with open(path, encoding='utf-8', newline='') as lines:
+        result = ingest_lines(lines, ingest_format, chunk_size)
+
+    for chunk in result['chunks']:
+        click.echo('chunk {chunk}: {accepted} accepted, {rejected} rejected'.format(**chunk))
+        for error in chunk['errors']:
+            click.echo('  line {line}: {error}'.format(**error))
+    click.echo('{accepted} rows accepted, {rejected} rejected'.format(**result))
+
+
+@api.cli.command('rebuild-rollups')
+def rebuild_rollups_command():
+    """Recomputes the OHLC rollups from the raw price histories."""
+    rollups.rebuild()
+    click.echo('rollups rebuilt for: {}'.format(', '.join(rollups.intervals) or 'no intervals'))
+
+
+@api.cli.command('rebuild-cube')
+def rebuild_cube_command():
+    """Reloads the memory-mapped price cube from the price histories."""
+    if not price_cube.enabled:
+        raise click.UsageError('PRICE_CUBE_DIR is not set')
+    price_cube.rebuild()
+    click.echo('price cube rebuilt: {dates} dates x {series} series'.format(**price_cube.stats()))
+
+
+@api.cli.command('refresh-snapshots')
+@click.option('--full', is_flag=True, help='Recompute every snapshot instead of the logged changes.')
+def refresh_snapshots_command(full):
+    """Brings the portfolio snapshots up to date with the logged writes."""
+    result = snapshots.refresh(full)
+    if result is None:
+        raise click.ClickException('another process is refreshing the snapshots')
+    click.echo('{changes} changes applied, {days} days and {rows} snapshot rows written'.format(**result))
+
+
 # Error Handling
 
-@app.errorhandler(422)
+@api.app_errorhandler(422)
 def unprocessable(error):
     return jsonify({
         "success": False,
@@ -269,7 +703,7 @@ def unprocessable(error):
     }), 422
 
 
-@app.errorhandler(404)
+@api.app_errorhandler(404)
 def not_found(error):
     return jsonify({
         "success": False,
@@ -278,7 +712,7 @@ def not_found(error):
     }), 404
 
 
-@app.errorhandler(AuthError)
+@api.app_errorhandler(AuthError)
 def auth_error(error):
     return jsonify({
         "success": False,
@@ -287,7 +721,7 @@ def auth_error(error):
     }), error.status_code
 
 
-@app.errorhandler(401)
+@api.app_errorhandler(401)
 def unauthorized(error):
     return jsonify({
         "success": False,
@@ -296,7 +730,7 @@ def unauthorized(error):
     }), 401
 
 
-@app.errorhandler(500)
+@api.app_errorhandler(500)
 def internal_server_error(error):
     return jsonify({
         "success": False,
@@ -305,7 +739,7 @@ def internal_server_error(error):
     }), 500
 
 
-@app.errorhandler(400)
+@api.app_errorhandler(400)
 def bad_request(error):
     return jsonify({
         "success": False,
@@ -314,7 +748,7 @@ def bad_request(error):
     }), 400
 
 
-@app.errorhandler(405)
+@api.app_errorhandler(405)
 def method_not_allowed(error):
     return jsonify({
         "success": False,
@@ -323,7 +757,17 @@ def method_not_allowed(error):
     }), 405
 
 
-@app.errorhandler(403)
+@api.app_errorhandler(OperationalError)
+def database_unavailable(error):
+    # the database is unreachable or a statement hit DB_STATEMENT_TIMEOUT_MS
+    return jsonify({
+        "success": False,
+        "error": 503,
+        "message": 'Service Unavailable'
+    }), 503
+
+
+@api.app_errorhandler(403)
 def unauthorized(error):
     return jsonify({
         "success": False,
@@ -333,4 +777,4 @@ def unauthorized(error):
 
 
 if __name__ == '__main__':
-    app.run(host='127.0.0.1', port=8080, debug=True)
\ No newline at end of file
+    create_app().run(host='127.0.0.1', port=8080, debug=True)
@@ -0,0 +1,390 @@
+import asyncio, io, os, sys, time
+from concurrent.futures import ThreadPoolExecutor
+from flask import Response
+from sqlalchemy.exc import OperationalError
+from werkzeug.datastructures import Headers, MIMEAccept
+from werkzeug.http import parse_accept_header, parse_etags
+from werkzeug.urls import url_decode
+from app import create_app
+from auth import check_permissions, decode_jwt, parse_auth_header, token_cache
+from columnar import COLUMNAR_MIMETYPE, encode as encode_columnar, row_columns
+from db_routing import DB_STATEMENT_TIMEOUT_MS, engine_options
+from instrumentation import RequestTimings, set_timings
+from models import AssetPriceHistory, Portfolio, parse_date, price_history_filters, table_versions_statement
+from pagination import format_rows, keyset_statement, next_page, page_args
+from response_cache import CACHE_CONTROL, entry_body, make_etag, response_cache
+from serialization import JSON_MIMETYPE, dumps, negotiated_mimetype
+from snapshots import snapshot_as_of_statement, snapshot_payload
+
+# threads running the Flask app for the routes without an async handler,
+# and the blocking parts of the async ones (verifying a new token)
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS', 32))
+# chunks of a streamed WSGI response buffered ahead of a slow client
+WSGI_BUFFERED_CHUNKS = 16
+
+ASYNC_DRIVERS = {'postgresql': 'asyncpg', 'sqlite': 'aiosqlite'}
+
+
+def async_database_url(url):
+    """`url` with the asyncio driver of its database, asyncpg for
+    PostgreSQL and aiosqlite for SQLite."""
+    if url.startswith('postgres://'):
+        url = url.replace('postgres://', 'postgresql://', 1)
+    scheme, _, rest = url.partition('://')
+    driver = ASYNC_DRIVERS.get(scheme)
+    return '{}+{}://{}'.format(scheme, driver, rest) if driver else url
+
+
+def async_engine_options(url, statement_timeout=DB_STATEMENT_TIMEOUT_MS):
+    """The pool settings of `engine_options`, the statement timeout passed
+    the way asyncpg takes it."""
+    options = engine_options(url, statement_timeout=0)
+    if statement_timeout and url.startswith('postgresql'):
+        options['connect_args'] = {'server_settings': {'statement_timeout': str(statement_timeout)}}
+    return options
+
+
+class Fallback(Exception):
+    """Raised by an async handler to hand the request over to the Flask app.
+    Errors and the cases the handlers don't cover are answered there, so
+    they behave exactly as under WSGI."""
+
+
+class AsyncRequest:
+    """The parts of an ASGI HTTP request the async handlers read, parsed
+    with the same werkzeug helpers as Flask's request."""
+
+    def __init__(self, scope):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.args = url_decode(scope['query_string'])
+        self.headers = Headers([(name.decode('latin-1'), value.decode('latin-1'))
+                                for name, value in scope['headers']])
+        self.accept_mimetypes = parse_accept_header(self.headers.get('Accept'), MIMEAccept)
+        self.accept_encodings = parse_accept_header(self.headers.get('Accept-Encoding'))
+        self.if_none_match = parse_etags(self.headers.get('If-None-Match'))
+        self.timings = RequestTimings()
+
+
+class AsyncResponse:
+    def __init__(self, body=b'', status=200, mimetype=None):
+        self.body = body
+        self.status = status
+        self.headers = Headers()
+        if mimetype is not None:
+            self.headers['Content-Type'] = mimetype
+        self.vary = []
+
+    async def send(self, send):
+        self.headers['Content-Length'] = str(len(self.body))
+        await send({'type': 'http.response.start', 'status': self.status,
+                    'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                for name, value in self.headers.items()]})
+        await send({'type': 'http.response.body', 'body': self.body})
+
+
+def wsgi_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            environ[name] = value
+            continue
+        key = 'HTTP_' + name
+        environ[key] = environ[key] + ',' + value if key in environ else value
+    return environ
+
+
+class AsyncApp:
+    """ASGI application serving the routes of `app.py`.
+
+    The most requested reads, GET /portfolios and GET /asset_price_histories,
+    have async handlers: the query runs on an asyncio engine (asyncpg or
+    aiosqlite) over the tables of models.py, and the token checks of
+    `requires_auth` only leave the event loop to verify a token missing from
+    the token cache. A request waiting on the database then costs a
+    coroutine instead of a worker. Every other route, and every error, is
+    served by the Flask app on a thread pool.
+    """
+
+    def __init__(self, app, engine, threads=ASGI_THREADS):
+        self.app = app
+        self.engine = engine
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix='asgi-wsgi')
+        self.routes = {
+            ('GET', '/portfolios'): ('get_portfolios', self.get_portfolios),
+            ('GET', '/asset_price_histories'): ('get_asset_price_histories', self.get_asset_price_histories)
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+
+        route = self.routes.get((scope['method'], scope['path']))
+        if route is not None:
+            request = AsyncRequest(scope)
+            try:
+                response = await route[1](request)
+            except Fallback:
+                pass
+            else:
+                self.process_response(scope, request, response)
+                await response.send(send)
+                return
+        await self.call_wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.engine.dispose()
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def process_response(self, scope, request, response):
+        """Runs the Flask app's after_request hooks on a bodiless stand-in
+        for `response`, so the async handlers send the same headers (CORS,
+        Server-Timing) and are counted in the same metrics."""
+        if response.vary:
+            response.headers['Vary'] = ', '.join(response.vary)
+        stand_in = Response(status=response.status, headers=list(response.headers.items()))
+        with self.app.request_context(wsgi_environ(scope, b'')):
+            set_timings(request.timings)
+            try:
+                stand_in = self.app.process_response(stand_in)
+            finally:
+                set_timings(None)
+        if 'Content-Type' not in response.headers:
+            del stand_in.headers['Content-Type']
+        response.headers = stand_in.headers
+
+    async def call_wsgi(self, scope, receive, send):
+        """Runs the Flask app on the thread pool. The app call and the
+        iteration of its body stay on one thread, the chunks are passed
+        through a bounded queue."""
+        body = []
+        while True:
+            message = await receive()
+            body.append(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(WSGI_BUFFERED_CHUNKS)
+        environ = wsgi_environ(scope, b''.join(body))
+
+        def put(item):
+            asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+        def run():
+            try:
+                def start_response(status, headers, exc_info=None):
+                    put(('start', int(status.split(' ', 1)[0]), headers))
+                    return lambda data: put(('body', data))
+
+                iterable = self.app(environ, start_response)
+                try:
+                    for chunk in iterable:
+                        if chunk:
+                            put(('body', chunk))
+                finally:
+                    if hasattr(iterable, 'close'):
+                        iterable.close()
+                put(('end',))
+            except Exception as e:
+                put(('error', e))
+
+        loop.run_in_executor(self.executor, run)
+        finished = False
+        try:
+            while True:
+                item = await queue.get()
+                if item[0] == 'start':
+                    await send({'type': 'http.response.start', 'status': item[1],
+                                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                            for name, value in item[2]]})
+                elif item[0] == 'body':
+                    await send({'type': 'http.response.body', 'body': item[1], 'more_body': True})
+                else:
+                    finished = True
+                    if item[0] == 'error':
+                        raise item[1]
+                    await send({'type': 'http.response.body', 'body': b''})
+                    return
+        finally:
+            if not finished:
+                # the client went away, let the thread run to its end
+                asyncio.ensure_future(self.drain(queue))
+
+    @staticmethod
+    async def drain(queue):
+        while (await queue.get())[0] not in ('end', 'error'):
+            pass
+
+    async def authorize(self, request, permission):
+        """`requires_auth` for the async handlers."""
+        started = time.perf_counter()
+        try:
+            token = parse_auth_header(request.headers.get('Authorization'))
+            payload = token_cache.get(token)
+            if payload is None:
+                # python-jose and a possible JWKS fetch block
+                payload = await asyncio.get_running_loop().run_in_executor(self.executor, decode_jwt, token)
+            check_permissions(permission, payload)
+        except Exception:
+            raise Fallback()
+        request.timings.phases['auth'] += time.perf_counter() - started
+        return payload
+
+    async def fetch(self, request, statement):
+        started = time.perf_counter()
+        try:
+            async with self.engine.connect() as connection:
+                rows = (await connection.execute(statement)).fetchall()
+        except OperationalError:
+            # answered by the Flask app's 503 handler
+            raise Fallback()
+        request.timings.statements += 1
+        request.timings.rows += len(rows)
+        request.timings.phases['db'] += time.perf_counter() - started
+        return rows
+
+    def encode(self, request, payload, negotiated=True):
+        started = time.perf_counter()
+        mimetype = negotiated_mimetype(request.accept_mimetypes) if negotiated else JSON_MIMETYPE
+        body = encode_columnar(payload) if mimetype == COLUMNAR_MIMETYPE else dumps(payload)
+        request.timings.phases['serialize'] += time.perf_counter() - started
+        return mimetype, body
+
+    async def conditional(self, request, table_names, view):
+        """`response_cache.conditional` for the async handlers: same ETags,
+        same cache."""
+        versions = dict(await self.fetch(request, table_versions_statement(table_names)))
+        versions = tuple(versions.get(table_name, 0) for table_name in table_names)
+        etag = make_etag(request.path, versions, request.args.items(multi=True),
+                         negotiated_mimetype(request.accept_mimetypes))
+
+        if request.if_none_match.contains_weak(etag):
+            response_cache.not_modified += 1
+            response = AsyncResponse(status=304)
+        else:
+            entry = response_cache.get(etag) if response_cache.enabled else None
+            if entry is None:
+                mimetype, body = await view(request)
+                entry = response_cache.put(etag, mimetype, body) if response_cache.enabled else \
+                    (mimetype, body, None, None)
+            body, encoding = entry_body(entry, request.accept_encodings)
+            response = AsyncResponse(body, mimetype=entry[0])
+            if encoding is not None:
+                response.headers['Content-Encoding'] = encoding
+            if entry[2] is not None:
+                response.vary.append('Accept-Encoding')
+
+        response.headers['ETag'] = '"{}"'.format(etag)
+        response.vary.append('Accept')
+        response.headers['Cache-Control'] = CACHE_CONTROL
+        return response
+
+    async def get_portfolios(self, request):
+        await self.authorize(request, 'get:portfolios')
+        if 'as_of' in request.args:
+            return await self.get_portfolio_snapshots(request)
+        return await self.conditional(request, (Portfolio.__tablename__,), self.list_portfolios)
+
+    async def list_portfolios(self, request):
+        try:
+            fields, after, limit = page_args(Portfolio, request.args)
+        except ValueError:
+            raise Fallback()
+
+        rows, next_cursor = next_page(await self.fetch(request, keyset_statement(Portfolio, fields, after, limit)),
+                                      limit)
+
+        if len(rows) == 0 and after is None:
+            raise Fallback()
+
+        return self.encode(request, {
+            'success': True,
+            'portfolios': format_rows(Portfolio.__table__, fields, rows),
+            'next_cursor': next_cursor
+        }, negotiated=False)
+
+    async def get_portfolio_snapshots(self, request):
+        try:
+            as_of = parse_date(request.args['as_of'])
+            ids = request.args.get('ids')
+            portfolio_ids = [int(id) for id in ids.split(',')] if ids else None
+        except ValueError:
+            raise Fallback()
+
+        rows = await self.fetch(request, snapshot_as_of_statement(as_of, portfolio_ids))
+
+        if len(rows) == 0:
+            raise Fallback()
+
+        columnar = negotiated_mimetype(request.accept_mimetypes) == COLUMNAR_MIMETYPE
+        mimetype, body = self.encode(request, snapshot_payload(rows, columnar))
+        response = AsyncResponse(body, mimetype=mimetype)
+        response.vary.append('Accept')
+        return response
+
+    async def get_asset_price_histories(self, request):
+        await self.authorize(request, 'get:asset_price_histories')
+        return await self.conditional(request, (AssetPriceHistory.__tablename__,), self.list_asset_price_histories)
+
+    async def list_asset_price_histories(self, request):
+        try:
+            fields, after, limit = page_args(AssetPriceHistory, request.args)
+            filters = price_history_filters(request.args)
+        except ValueError:
+            raise Fallback()
+
+        rows, next_cursor = next_page(
+            await self.fetch(request, keyset_statement(AssetPriceHistory, fields, after, limit, filters)), limit)
+
+        if len(rows) == 0 and after is None:
+            raise Fallback()
+
+        table = AssetPriceHistory.__table__
+        columnar = negotiated_mimetype(request.accept_mimetypes) == COLUMNAR_MIMETYPE
+        return self.encode(request, {
+            'success': True,
+            'asset_price_histories': row_columns(table, fields, rows) if columnar else format_rows(table, fields, rows),
+            'next_cursor': next_cursor
+        })
+
+
+def create_asgi_app(test_config=None):
+    """Builds the Flask app with `create_app` and wraps it in an `AsyncApp`
+    reading from DATABASE_URL through its asyncio driver. Serve it with an
+    ASGI server, e.g. `uvicorn --factory asgi:create_asgi_app`."""
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    app = create_app(test_config)
+    url = async_database_url(app.config['DATABASE_URL'])
+    return AsyncApp(app, create_async_engine(url, **async_engine_options(url)))
@@ -0,0 +1,288 @@
+from collections import OrderedDict
+from functools import wraps
+import os, json, threading, time
+from flask import request, abort
+from urllib.request import urlopen
+from instrumentation import metric_collectors, phase, prefixed
+
+# set from the app config by init_auth()
+AUTH0_DOMAIN = os.environ.get('AUTH0_DOMAIN')
+API_AUDIENCE = os.environ.get('API_AUDIENCE')
+ALGORITHMS = ['RS256']
+
+# JWKS_URL can point at a local file (file:///path/jwks.json) for offline testing
+JWKS_URL = os.environ.get('JWKS_URL', f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+JWKS_TTL = int(os.environ.get('JWKS_TTL', 3600))
+JWKS_MIN_REFRESH_INTERVAL = int(os.environ.get('JWKS_MIN_REFRESH_INTERVAL', 30))
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 1024))
+
+
+class AuthError(Exception):
+    def __init__(self, error, status_code):
+        self.error = error
+        self.status_code = status_code
+
+
+class JWKSCache:
+    """Keeps the JSON Web Key Set in memory, indexed by `kid`.
+
+    The document is refetched when it is older than `ttl` seconds, or when a
+    token references a `kid` we have not seen. Refetches are never issued more
+    often than `min_refresh_interval` seconds, so a stream of tokens with bogus
+    key ids can't turn into a stream of requests against the identity provider.
+    """
+
+    def __init__(self, url, ttl=JWKS_TTL, min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL):
+        self.url = url
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.keys = {}
+        self.fetched_at = None
+        self.last_attempt = None
+        self.hits = 0
+        self.misses = 0
+        self.fetches = 0
+        self._lock = threading.Lock()
+
+    def fetch(self):
+        with phase('jwks'), urlopen(self.url) as jsonurl:
+            jwks = json.loads(jsonurl.read())
+        return {key['kid']: key for key in jwks['keys'] if 'kid' in key}
+
+    def refresh(self, force=False):
+        with self._lock:
+            now = time.monotonic()
+            if not force and self.last_attempt is not None \
+                    and now - self.last_attempt < self.min_refresh_interval:
+                return False
+            self.last_attempt = now
+            self.fetches += 1
+            self.keys = self.fetch()
+            self.fetched_at = now
+            return True
+
+    def expired(self):
+        return self.fetched_at is None or time.monotonic() - self.fetched_at >= self.ttl
+
+    def get_key(self, kid):
+        if self.expired():
+            try:
+                self.refresh()
+            except Exception:
+                # keep serving the stale keys if the provider is unreachable
+                if not self.keys:
+                    raise
+
+        key = self.keys.get(kid)
+        if key is not None:
+            self.hits += 1
+            return key
+
+        self.misses += 1
+        if self.refresh():
+            return self.keys.get(kid)
+        return None
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'fetches': self.fetches,
+            'keys': len(self.keys)
+        }
+
+
+class TokenCache:
+    """Bounded LRU of verified token payloads, each kept until its `exp`."""
+
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        with self._lock:
+            entry = self.entries.get(token)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            payload, expires_at = entry
+            if expires_at is not None and time.time() >= expires_at:
+                del self.entries[token]
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(token)
+            self.hits += 1
+            return payload
+
+    def put(self, token, payload):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self.entries[token] = (payload, payload.get('exp'))
+            self.entries.move_to_end(token)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self.entries)
+        }
+
+
+jwks_cache = JWKSCache(JWKS_URL)
+token_cache = TokenCache()
+metric_collectors.append(lambda: dict(prefixed('jwks_cache', jwks_cache.stats()),
+                                      **prefixed('token_cache', token_cache.stats())))
+
+
+def init_auth(app):
+    """Takes the Auth0 settings from the app config, where they are set."""
+    global AUTH0_DOMAIN, API_AUDIENCE
+    AUTH0_DOMAIN = app.config.get('AUTH0_DOMAIN') or AUTH0_DOMAIN
+    API_AUDIENCE = app.config.get('API_AUDIENCE') or API_AUDIENCE
+    if app.config.get('JWKS_URL'):
+        jwks_cache.url = app.config['JWKS_URL']
+    elif app.config.get('AUTH0_DOMAIN'):
+        jwks_cache.url = f'https://{AUTH0_DOMAIN}/.well-known/jwks.json'
+
+
+def get_token_auth_header():
+    """Obtains the Access Token from the Authorization Header
+    """
+    return parse_auth_header(request.headers.get('Authorization', None))
+
+
+def parse_auth_header(auth):
+    """The token of an `Authorization: Bearer <token>` header value."""
+    if not auth:
+        raise AuthError({
+            'code': 'authorization_header_missing',
+            'description': 'Authorization header is expected.'
+        }, 401)
+
+    parts = auth.split()
+
+    if parts[0].lower() != 'bearer':
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Authorization header must start with "Bearer".'
+        }, 401)
+    elif len(parts) == 1:
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Token not found.'
+        }, 401)
+    elif len(parts) > 2:
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Authorization header must be bearer token.'
+        }, 401)
+
+    token = parts[1]
+    return token
+
+
+def verify_decode_jwt(token):
+    payload = token_cache.get(token)
+    if payload is not None:
+        return payload
+    return decode_jwt(token)
+
+
+def decode_jwt(token):
+    """Verifies a token missing from the token cache and caches its payload.
+    May block on fetching the JWKS."""
+    # python-jose is slow to import, cached tokens never need it
+    from jose import jwt
+
+    unverified_header = jwt.get_unverified_header(token)
+    rsa_key = {}
+    if 'kid' not in unverified_header:
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Authorization malformed.'
+        }, 401)
+
+    key = jwks_cache.get_key(unverified_header['kid'])
+    if key:
+        rsa_key = {
+            'kty': key['kty'],
+            'kid': key['kid'],
+            'use': key['use'],
+            'n': key['n'],
+            'e': key['e']
+        }
+
+    if rsa_key:
+        try:
+            payload = jwt.decode(
+                token,
+                rsa_key,
+                algorithms=ALGORITHMS,
+                audience=API_AUDIENCE,
+                issuer='https://' + AUTH0_DOMAIN + '/'
+            )
+        except jwt.ExpiredSignatureError:
+            raise AuthError({
+                'code': 'token_expired',
+                'description': 'Token expired.'
+            }, 401)
+        except jwt.JWTClaimsError:
+            raise AuthError({
+                'code': 'invalid_claims',
+                'description': 'Incorrect claims. Please, check the audience and issuer.'
+            }, 401)
+        except Exception:
+            raise AuthError({
+                'code': 'invalid_header',
+                'description': 'Unable to parse authentication token.'
+            }, 400)
+        token_cache.put(token, payload)
+        return payload
+    raise AuthError({
+        'code': 'invalid_header',
+                'description': 'Unable to find the appropriate key.'
+    }, 400)
+
+
+def check_permissions(permission, payload):
+    if 'permissions' not in payload:
+        raise AuthError({
+            'code': 'invalid_claims',
+            'description': 'Permissions not included in JWT.'
+        }, 400)
+
+    if permission not in payload['permissions']:
+        raise AuthError({
+            'code': 'unauthorized',
+            'description': 'Permission not found.'
+        }, 403)
+    return True
+
+
+def requires_auth(permission=''):
+    def requires_auth_decorater(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            token = get_token_auth_header()
+            try:
+                with phase('auth'):
+                    payload = verify_decode_jwt(token)
+                    check_permissions(permission, payload)
+            except Exception:
+                abort(401)
+            return f(payload, *args, **kwargs)
+
+        return wrapper
+    return requires_auth_decorater
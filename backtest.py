@@ -0,0 +1,194 @@
+import itertools, math, os
+import numpy as np
+from analytics import TRADING_DAYS, load_allocation, performance_stats, to_float
+from serialization import format_dates
+from workers import PROCESS_POOL_WORKERS, SharedArrays, get_process_pool
+
+BACKTEST_SCHEDULES = ('none', 'monthly', 'quarterly', 'annually', 'threshold')
+CALENDAR_UNITS = {'monthly': 'M', 'quarterly': 'Q', 'annually': 'Y'}
+# rows of drifted weights checked at a time while looking for a band breach
+BACKTEST_SCAN_ROWS = int(os.environ.get('BACKTEST_SCAN_ROWS', 256))
+MAX_SWEEP_RUNS = int(os.environ.get('MAX_SWEEP_RUNS', 1000))
+
+
+def calendar_rebalances(dates, schedule):
+    """Indices of the first trading day of every month, quarter or year after
+    the first one."""
+    unit = CALENDAR_UNITS[schedule]
+    periods = dates.astype('datetime64[M]').astype(np.int64)
+    if unit == 'Q':
+        periods = periods // 3
+    elif unit == 'Y':
+        periods = periods // 12
+    return np.flatnonzero(periods[1:] != periods[:-1]) + 1
+
+
+def first_breach(prices, units, targets, band, start, scan_rows=BACKTEST_SCAN_ROWS):
+    """First index from `start` on where a weight of the drifting holdings is
+    more than `band` away from its target, len(prices) when there is none.
+    The weights are evaluated `scan_rows` days at a time."""
+    for first in range(start, len(prices), scan_rows):
+        values = prices[first:first + scan_rows] * units
+        weights = values / values.sum(axis=1, keepdims=True)
+        breaches = np.flatnonzero(np.abs(weights - targets).max(axis=1) > band)
+        if len(breaches):
+            return first + int(breaches[0])
+    return len(prices)
+
+
+def simulate(prices, targets, schedule='monthly', band=0.05, cost=0.0, calendar=None):
+    """Simulates holdings of `targets` weights over the `prices` (dates x
+    series), starting with a NAV of 1 invested at the targets.
+
+    Between two rebalances the holdings don't change, so the NAV of the whole
+    stretch is one matrix-vector product. Calendar schedules rebalance on the
+    `calendar` indices, `threshold` on the first close where a weight drifted
+    more than `band` away from its target. A rebalance trades back to the
+    targets at the close and pays `cost` per unit of traded value.
+    Returns (nav, rebalance indices, turnover of every rebalance, costs).
+    """
+    targets = targets / targets.sum()
+    nav = np.empty(len(prices))
+    nav[0] = 1.0
+    units = targets / prices[0]
+    rebalances, turnover = [], []
+    costs = 0.0
+
+    day = 0
+    while day < len(prices) - 1:
+        if schedule == 'none':
+            following = len(prices)
+        elif schedule == 'threshold':
+            following = first_breach(prices, units, targets, band, day + 1)
+        else:
+            position = np.searchsorted(calendar, day, side='right')
+            following = int(calendar[position]) if position < len(calendar) else len(prices)
+
+        nav[day + 1:following] = prices[day + 1:following] @ units
+        if following == len(prices):
+            break
+
+        values = units * prices[following]
+        value = values.sum()
+        traded = np.abs(targets * value - values).sum()
+        nav[following] = value - cost * traded
+        units = targets * nav[following] / prices[following]
+        rebalances.append(following)
+        turnover.append(traded / value)
+        costs += cost * traded
+        day = following
+    return nav, rebalances, turnover, costs
+
+
+def summary(nav, rebalances, turnover, costs, periods_per_year=TRADING_DAYS):
+    years = (len(nav) - 1) / periods_per_year
+    return {
+        'rebalances': len(rebalances),
+        'turnover': to_float(sum(turnover)),
+        'annualized_turnover': to_float(sum(turnover) / years) if years else None,
+        'transaction_costs': to_float(costs),
+        'stats': performance_stats(nav, periods_per_year)
+    }
+
+
+def load_backtest_allocation(portfolio_ids, start, end):
+    """Prices and target weights of the portfolios' own series (benchmarks
+    left out), see `load_allocation`."""
+    allocation = load_allocation(portfolio_ids, start, end)
+    if allocation is None or allocation.benchmark.all() or len(allocation.dates) < 2:
+        return None
+    assets = ~allocation.benchmark
+    return allocation, allocation.prices[:, assets], allocation.weights[assets]
+
+
+def backtest(portfolio_ids=None, start=None, end=None, schedule='monthly', band=0.05, cost_bps=0.0,
+             periods_per_year=TRADING_DAYS):
+    """Backtests the portfolios' target weights under one rebalancing
+    schedule. The dates and NAVs are arrays. Returns None when there is no
+    price history."""
+    loaded = load_backtest_allocation(portfolio_ids, start, end)
+    if loaded is None:
+        return None
+
+    allocation, prices, targets = loaded
+    calendar = calendar_rebalances(allocation.dates, schedule) if schedule in CALENDAR_UNITS else None
+    nav, rebalances, turnover, costs = simulate(prices, targets, schedule, band, cost_bps / 10000.0, calendar)
+    assets = ~allocation.benchmark
+    return {
+        'schedule': schedule,
+        'band': band if schedule == 'threshold' else None,
+        'cost_bps': cost_bps,
+        'dates': allocation.dates,
+        'nav': nav,
+        'rebalance_dates': allocation.dates[rebalances],
+        'series': [{
+            'portfolio_id': int(portfolio_id),
+            'asset_type': asset_type,
+            'weight': to_float(weight)
+        } for portfolio_id, asset_type, weight in zip(
+            allocation.portfolio_ids[assets], allocation.asset_types[assets], targets / targets.sum())],
+        **summary(nav, rebalances, turnover, costs, periods_per_year)
+    }
+
+
+def run_sweep_batch(spec, calendars, runs, periods_per_year):
+    """Simulates a batch of sweep runs on the shared prices. Runs in the
+    process pool."""
+    arrays = SharedArrays.attach(spec)
+    try:
+        results = []
+        for run in runs:
+            simulation = simulate(arrays['prices'], arrays['targets'], run['schedule'], run['band'],
+                                  run['cost_bps'] / 10000.0, calendars.get(run['schedule']))
+            results.append(dict(run, **summary(*simulation, periods_per_year)))
+        return results
+    finally:
+        arrays.close()
+
+
+def sweep_runs(schedules, bands, costs_bps):
+    """Every combination of schedule and cost, threshold schedules once per
+    band."""
+    runs = []
+    for schedule, cost_bps in itertools.product(schedules, costs_bps):
+        for band in (bands if schedule == 'threshold' else [None]):
+            runs.append({'schedule': schedule, 'band': band, 'cost_bps': cost_bps})
+    return runs
+
+
+def sweep(prices, targets, dates, runs, periods_per_year=TRADING_DAYS):
+    """Simulates the `runs` (see `sweep_runs`). The prices are put in shared
+    memory once and the runs are spread over the process pool in batches.
+    Returns the summary of every run, in order, without the NAV paths."""
+    schedules = {run['schedule'] for run in runs}
+    calendars = {schedule: calendar_rebalances(dates, schedule) for schedule in schedules & set(CALENDAR_UNITS)}
+    # a few batches per worker evens out slow (e.g. tight band) runs
+    batch_size = max(1, math.ceil(len(runs) / (PROCESS_POOL_WORKERS * 4)))
+
+    with SharedArrays.create(prices=prices.shape, targets=targets.shape) as arrays:
+        arrays['prices'][:] = prices
+        arrays['targets'][:] = targets
+        pool = get_process_pool()
+        futures = [pool.submit(run_sweep_batch, arrays.spec, calendars, runs[first:first + batch_size],
+                               periods_per_year)
+                   for first in range(0, len(runs), batch_size)]
+        return [result for future in futures for result in future.result()]
+
+
+def backtest_sweep(portfolio_ids=None, start=None, end=None, schedules=BACKTEST_SCHEDULES, bands=(0.05,),
+                   costs_bps=(0.0,), periods_per_year=TRADING_DAYS):
+    """Backtests every combination of the schedules, bands and costs on the
+    portfolios' target weights."""
+    loaded = load_backtest_allocation(portfolio_ids, start, end)
+    if loaded is None:
+        raise ValueError('no price history for the selected portfolios')
+
+    allocation, prices, targets = loaded
+    runs = sweep_runs(schedules, bands, costs_bps)
+    assets = ~allocation.benchmark
+    return {
+        'start': format_dates(allocation.dates[:1])[0],
+        'end': format_dates(allocation.dates[-1:])[0],
+        'portfolio_ids': sorted(set(allocation.portfolio_ids[assets].tolist())),
+        'runs': sweep(prices, targets, allocation.dates, runs, periods_per_year)
+    }
@@ -0,0 +1,300 @@
+"""Benchmark suite for every route of the HTTP API.
+
+Seeds a database with synthetic portfolios and price histories (in-memory
+SQLite by default, set DATABASE_URL for a local PostgreSQL), signs tokens
+with a throwaway RSA key served from a local JWKS file, then measures every
+route in two ways:
+
+    micro  rounds of single requests through the Flask test client, after a
+           few warmup rounds (pytest-benchmark style min/mean/stddev/percentiles)
+    load   `--clients` threads sending requests back to back to a local
+           threaded server for `--seconds` (throughput and p50/p95/p99).
+           On SQLite the write routes are driven by a single client.
+
+Results are written as JSON. `--compare` checks them against an earlier
+run and exits with status 1 when a route got slower by more than
+`--threshold`.
+
+    python benchmarks/bench_api.py --portfolios 50 --days 1260 --output results.json
+    python benchmarks/bench_api.py --compare results.json --mode micro
+"""
+import argparse, json, platform, random, re, subprocess, sys, time
+from datetime import date, datetime, timezone
+import common, loadgen
+
+PERMISSIONS = ('get:portfolios', 'get:asset_price_histories', 'post:portfolios', 'post:asset_price_histories',
+               'patch:asset_price_histories', 'delete:portfolios')
+HEADERS = common.local_auth(PERMISSIONS)
+BATCH_SIZE = 100
+
+
+class Case:
+    """One benchmarked request. `path` and `body` may contain `{name}`
+    fields filled from `prepare()` (run once) and `setup()` (run before every
+    micro round, outside the timing)."""
+
+    def __init__(self, name, method, path, body=None, content_type='application/json', ok=(200,),
+                 prepare=None, setup=None, load=True):
+        self.name = name
+        self.method = method
+        self.path = path
+        self.body = body
+        self.content_type = content_type
+        self.ok = ok
+        self.prepare = prepare
+        self.setup = setup
+        self.load = load
+        self.context = {}
+
+    def request(self):
+        """Returns (method, path, headers, body) for the next request."""
+        context = dict(self.context)
+        if self.setup is not None:
+            context.update(self.setup())
+        body = self.body(context) if callable(self.body) else self.body
+        headers = dict(HEADERS, **{'Content-Type': self.content_type}) if body is not None else HEADERS
+        return self.method, self.path.format(**context), headers, body
+
+
+def random_patches(context):
+    ids = random.sample(range(1, context['rows'] + 1), BATCH_SIZE)
+    return json.dumps({'patches': [{'id': id, 'price': round(random.uniform(50, 150), 4)} for id in ids]})
+
+
+def csv_batch(context):
+    lines = ['asset_type,price,date,portfolio_id']
+    for day in range(BATCH_SIZE):
+        lines.append('Bench,{},{},1'.format(round(random.uniform(50, 150), 4), date.fromordinal(730000 + day)))
+    return '\n'.join(lines) + '\n'
+
+
+def tick_batch(context):
+    return json.dumps([{'asset_type': 'Tick', 'price': round(random.uniform(50, 150), 4),
+                        'date': date.fromordinal(730000 + day).isoformat(), 'portfolio_id': 1}
+                       for day in range(10)])
+
+
+def new_portfolio():
+    from models import Portfolio
+
+    portfolio = Portfolio('Bench', 0.1, 'Bench benchmark', 1, 'QRY')
+    portfolio.insert()
+    return {'portfolio_id': portfolio.id}
+
+
+def submitted_risk_job():
+    from workers import jobs
+    from risk import portfolio_risk
+
+    return {'job_id': jobs.submit('risk', portfolio_risk, [1], method='historical')}
+
+
+def submitted_backtest_sweep():
+    from workers import jobs
+    from backtest import backtest_sweep
+
+    return {'job_id': jobs.submit('backtest', backtest_sweep, [1], schedules=['monthly'])}
+
+
+def cases():
+    portfolio = json.dumps({'asset_class_desc': 'Bench', 'weight': 0.1, 'benchmark_desc': 'Bench benchmark',
+                            'sort_id': 1, 'bloomberg_qry': 'QRY'})
+    edit = json.dumps({'asset_type': 'Bond', 'price': 101.5, 'date': '2000-01-03', 'portfolio_id': 1})
+    return [
+        Case('list portfolios', 'GET', '/portfolios'),
+        Case('list portfolios page', 'GET', '/portfolios?limit=10&fields=weight'),
+        Case('portfolios as of', 'GET', '/portfolios?as_of=2001-06-01'),
+        Case('aggregate portfolios', 'GET', '/portfolios/aggregate'),
+        Case('portfolio analytics (cached)', 'GET', '/portfolios/1/analytics'),
+        Case('portfolio analytics (range)', 'GET', '/portfolios/1/analytics?start=2001-01-01'),
+        Case('analytics cache stats', 'GET', '/portfolios/analytics/cache'),
+        Case('metrics', 'GET', '/metrics'),
+        Case('submit risk job', 'POST', '/portfolios/risk', json.dumps({'ids': [1], 'method': 'historical'}),
+             ok=(202,), load=False),
+        Case('poll risk job', 'GET', '/risk_jobs/{job_id}', prepare=submitted_risk_job),
+        Case('backtest monthly', 'POST', '/portfolios/backtest', json.dumps({'ids': [1, 2], 'cost_bps': 10})),
+        Case('backtest threshold', 'POST', '/portfolios/backtest',
+             json.dumps({'ids': [1, 2], 'schedule': 'threshold', 'band': 0.02})),
+        Case('submit backtest sweep', 'POST', '/portfolios/backtest/sweep',
+             json.dumps({'ids': [1], 'bands': [0.01, 0.05], 'costs_bps': [0, 10]}), ok=(202,), load=False),
+        Case('poll backtest sweep', 'GET', '/backtest_jobs/{job_id}', prepare=submitted_backtest_sweep),
+        Case('list prices page', 'GET', '/asset_price_histories?limit=1000'),
+        Case('list prices range', 'GET', '/asset_price_histories?portfolio_id=1&asset_type=Bond&start=2001-01-01'),
+        Case('resample prices weekly', 'GET', '/asset_price_histories/resample?portfolio_id=1&asset_type=Bond&interval=week'),
+        Case('resample prices daily', 'GET', '/asset_price_histories/resample?portfolio_id=1&asset_type=Bond'),
+        Case('rolling stats', 'GET', '/asset_price_histories/rolling?ids=1,2,3&benchmark=1:Equity'),
+        Case('covariance matrices', 'GET', '/asset_price_histories/covariance?ids=1,2,3'),
+        Case('export prices ndjson', 'GET', '/asset_price_histories/export?portfolio_id=1'),
+        Case('export prices csv gzip', 'GET', '/asset_price_histories/export?portfolio_id=1&format=csv&gzip=true'),
+        Case('create portfolio', 'POST', '/portfolios', portfolio),
+        Case('bulk create prices', 'POST', '/asset_price_histories/bulk', csv_batch, content_type='text/csv'),
+        Case('enqueue price ticks', 'POST', '/asset_price_histories/queue', tick_batch, ok=(202,)),
+        Case('ingest queue stats', 'GET', '/asset_price_histories/queue'),
+        Case('bulk edit prices', 'PATCH', '/asset_price_histories/bulk', random_patches),
+        Case('edit price', 'PATCH', '/asset_price_histories/1/edit', edit),
+        Case('delete portfolio', 'DELETE', '/portfolios/{portfolio_id}', setup=new_portfolio, load=False)
+    ]
+
+
+def uncovered_routes(app, cases):
+    """Method and rule of every route no case exercises."""
+    adapter = app.url_map.bind('localhost')
+    covered = set()
+    for case in cases:
+        path = re.sub(r'{\w+}', '1', case.path.split('?')[0])
+        covered.add((adapter.match(path, method=case.method)[0], case.method))
+    return sorted('{} {}'.format(method, rule.rule) for rule in app.url_map.iter_rules()
+                  if rule.endpoint != 'static'
+                  for method in rule.methods - {'HEAD', 'OPTIONS'}
+                  if (rule.endpoint, method) not in covered)
+
+
+def run_micro(app, case, rounds, warmup, max_time):
+    client = app.test_client()
+    latencies = []
+    statuses = {}
+    started = time.perf_counter()
+    for round in range(warmup + rounds):
+        with app.app_context():
+            method, path, headers, body = case.request()
+        start = time.perf_counter()
+        response = client.open(path, method=method, headers=headers, data=body)
+        response.get_data()
+        elapsed = time.perf_counter() - start
+        response.close()
+        if round < warmup:
+            continue
+        latencies.append(elapsed)
+        statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+        if time.perf_counter() - started > max_time:
+            break
+    return loadgen.summarize(latencies, sum(latencies), statuses, case.ok)
+
+
+def metadata(args):
+    from instrumentation import INSTRUMENTATION, PROFILE_SAMPLE_RATE
+    from models import db
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=common.ROOT, check=True,
+                                capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'database': db.engine.dialect.name,
+        'instrumentation': INSTRUMENTATION,
+        'profile_sample_rate': PROFILE_SAMPLE_RATE,
+        'portfolios': args.portfolios,
+        'days': args.days,
+        'rows': args.rows,
+        'rounds': args.rounds,
+        'clients': args.clients,
+        'seconds': args.seconds
+    }
+
+
+def compare(results, baseline, threshold):
+    """Returns the regressions of `results` against `baseline`: a higher p50
+    for micro runs, a lower throughput for load runs."""
+    previous = {(result['name'], result['mode']): result for result in baseline['results']}
+    regressions = []
+    for result in results['results']:
+        before = previous.get((result['name'], result['mode']))
+        if before is None or not before.get('requests') or not result.get('requests'):
+            continue
+        if result['mode'] == 'micro':
+            change = result['p50_ms'] / before['p50_ms'] - 1.0
+        else:
+            change = before['ops_per_sec'] / result['ops_per_sec'] - 1.0
+        if change > threshold:
+            regressions.append((result['name'], result['mode'], change))
+    return regressions
+
+
+def print_results(results):
+    print('{:<32} {:<6} {:>8} {:>10} {:>10} {:>10} {:>10} {:>7}'.format(
+        'route', 'mode', 'requests', 'ops/sec', 'p50 ms', 'p95 ms', 'p99 ms', 'errors'))
+    for result in results:
+        if not result['requests']:
+            continue
+        print('{name:<32} {mode:<6} {requests:>8} {ops_per_sec:>10} {p50_ms:>10} {p95_ms:>10} {p99_ms:>10} '
+              '{errors:>7}'.format(**result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--portfolios', type=int, default=20)
+    parser.add_argument('--days', type=int, default=1260, help='trading days of history, 1260 is about 5 years')
+    parser.add_argument('--mode', choices=('micro', 'load', 'both'), default='both')
+    parser.add_argument('--rounds', type=int, default=50)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--max-time', type=float, default=10.0, help='seconds per route in micro mode')
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=5.0, help='seconds per route in load mode')
+    parser.add_argument('--filter', help='only run routes whose name contains this')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--compare', help='results JSON of an earlier run')
+    parser.add_argument('--threshold', type=float, default=0.2, help='tolerated slowdown, 0.2 = 20%%')
+    args = parser.parse_args()
+
+    from app import create_app
+    from ingest_queue import ingest_queue
+    from models import db
+    from snapshots import snapshots
+    from workers import shutdown_process_pool
+
+    app = create_app()
+
+    random.seed(42)
+    with app.app_context():
+        args.rows = common.seed(db, args.portfolios, args.days)
+        snapshots.refresh(full=True)
+        suite = [case for case in cases() if not args.filter or args.filter in case.name]
+        for case in suite:
+            case.context['rows'] = args.rows
+            if case.prepare is not None:
+                case.context.update(case.prepare())
+        results = {'meta': metadata(args), 'results': []}
+
+    for route in uncovered_routes(app, cases()):
+        print('not benchmarked: ' + route, file=sys.stderr)
+
+    if args.mode in ('micro', 'both'):
+        for case in suite:
+            result = run_micro(app, case, args.rounds, args.warmup, args.max_time)
+            results['results'].append(dict(result, name=case.name, mode='micro', method=case.method, path=case.path))
+
+    if args.mode in ('load', 'both'):
+        with loadgen.serve(app) as port:
+            for case in suite:
+                if not case.load:
+                    continue
+                # the in-memory SQLite database is one connection shared by all threads
+                clients = 1 if case.method != 'GET' and results['meta']['database'] == 'sqlite' else args.clients
+                result = loadgen.run_load(port, case.request, clients, args.seconds, case.ok)
+                results['results'].append(dict(result, name=case.name, mode='load', method=case.method,
+                                               path=case.path, clients=clients))
+
+    shutdown_process_pool()
+    ingest_queue.stop()
+    print_results(results['results'])
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for name, mode, change in regressions:
+            print('REGRESSION {} ({}): {:.0%} slower'.format(name, mode, change))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
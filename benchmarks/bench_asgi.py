@@ -0,0 +1,116 @@
+"""Read traffic against the two ways of serving the API, side by side:
+
+    wsgi    gunicorn sync workers running `app:create_app()`, one request
+            per worker at a time
+    asgi    uvicorn workers running `asgi:create_asgi_app`, the reads on an
+            asyncio engine (asyncpg / aiosqlite)
+
+Both servers get `--workers` processes and the same mix of reads, a page of
+portfolios, a page of one series' prices and a valuation as of a random
+date, from `--clients` closed-loop clients. The database is a SQLite file
+by default; set DATABASE_URL to a PostgreSQL database to see what the event
+loop buys while the queries wait on the network.
+
+    python benchmarks/bench_asgi.py --workers 2 --clients 1,16,64 --seconds 10
+"""
+import argparse, importlib.util, os, random, socket, subprocess, sys, tempfile, time
+from datetime import timedelta
+import common, loadgen
+
+PERMISSIONS = ('get:portfolios', 'get:asset_price_histories')
+HEADERS = common.local_auth(PERMISSIONS)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(command, port, timeout=30.0):
+    """Starts `command` and waits until it answers on `port`."""
+    process = subprocess.Popen(command, cwd=common.ROOT, stdout=subprocess.DEVNULL)
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('{} exited with status {}'.format(command[2], process.returncode))
+        try:
+            loadgen.send(port, 'GET', '/portfolios', HEADERS)
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError('{} did not start'.format(command[2]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--portfolios', type=int, default=20)
+    parser.add_argument('--days', type=int, default=1260)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--clients', default='1,16,64')
+    parser.add_argument('--seconds', type=float, default=10.0)
+    args = parser.parse_args()
+
+    if os.environ['DATABASE_URL'] == 'sqlite://':
+        # the servers run in their own processes
+        os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='bench-asgi-'), 'bench.db')
+
+    from sqlalchemy import func, select
+    from app import create_app
+    from asgi import async_database_url
+    from models import AssetPriceHistory, db
+    from snapshots import snapshots
+
+    app = create_app()
+    table = AssetPriceHistory.__table__
+    with app.app_context():
+        rows = common.seed(db, args.portfolios, args.days)
+        snapshots.refresh(full=True)
+        first, last = db.session.execute(select(func.min(table.c.date), func.max(table.c.date))).one()
+        portfolio_ids = [row[0] for row in db.session.execute(select(table.c.portfolio_id).distinct())]
+    print('{} price rows, {} workers per server'.format(rows, args.workers))
+
+    def make_request():
+        kind = random.randrange(3)
+        if kind == 0:
+            path = '/portfolios'
+        elif kind == 1:
+            path = '/asset_price_histories?portfolio_id={}&limit=200'.format(random.choice(portfolio_ids))
+        else:
+            path = '/portfolios?as_of={}'.format(first + timedelta(days=random.randrange((last - first).days)))
+        return 'GET', path, HEADERS, None
+
+    servers = [('wsgi', lambda port: [sys.executable, '-m', 'gunicorn', '--workers', str(args.workers),
+                                      '--bind', '127.0.0.1:{}'.format(port), '--log-level', 'warning',
+                                      'app:create_app()'])]
+    driver = async_database_url(os.environ['DATABASE_URL']).split('://', 1)[0].partition('+')[2]
+    missing = [name for name in ('uvicorn', driver) if name and importlib.util.find_spec(name) is None]
+    if missing:
+        print('skipping asgi: pip install {}'.format(' '.join(missing)))
+    else:
+        servers.append(('asgi', lambda port: [sys.executable, '-m', 'uvicorn', '--factory', 'asgi:create_asgi_app',
+                                              '--workers', str(args.workers), '--port', str(port),
+                                              '--log-level', 'warning', '--no-access-log']))
+
+    results = {}
+    for name, command in servers:
+        port = free_port()
+        process = start_server(command(port), port)
+        try:
+            loadgen.run_load(port, make_request, clients=4, seconds=1.0)
+            for clients in (int(value) for value in args.clients.split(',')):
+                results[name, clients] = loadgen.run_load(port, make_request, clients, args.seconds)
+        finally:
+            process.terminate()
+            process.wait()
+
+    print('{:>8} {:<6} {:>10} {:>10} {:>10} {:>8}'.format('clients', 'server', 'req/s', 'p50 ms', 'p99 ms', 'errors'))
+    for (name, clients), result in sorted(results.items(), key=lambda item: (item[0][1], item[0][0])):
+        print('{:>8} {:<6} {:>10.1f} {:>10.2f} {:>10.2f} {:>8}'.format(
+            clients, name, result['ops_per_sec'], result.get('p50_ms', 0.0), result.get('p99_ms', 0.0),
+            result['errors']))
+
+
+if __name__ == '__main__':
+    main()
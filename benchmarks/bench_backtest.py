@@ -0,0 +1,90 @@
+"""Backtests of `--series` random price series over `--days` days.
+
+One run per schedule:
+
+    daily       day by day loop revaluing the holdings, the obvious version
+    vectorized  backtest.simulate, one matrix-vector product per stretch
+                between two rebalances
+
+and a sweep of `--bands` threshold bands x `--costs` cost levels over all
+schedules, run serially in this process and spread over the process pool
+(`PROCESS_POOL_WORKERS`) by backtest.sweep. The daily NAVs are checked
+against the vectorized ones.
+
+    python benchmarks/bench_backtest.py --series 20 --days 5040 --bands 40 --costs 5
+"""
+import argparse
+import numpy as np
+import common
+
+
+def daily(prices, targets, rebalance_days, cost):
+    targets = targets / targets.sum()
+    units = targets / prices[0]
+    nav = np.empty(len(prices))
+    nav[0] = 1.0
+    for day in range(1, len(prices)):
+        values = units * prices[day]
+        value = values.sum()
+        if rebalance_days is None:
+            rebalance = np.abs(values / value - targets).max() > 0.05
+        else:
+            rebalance = day in rebalance_days
+        if rebalance:
+            value -= cost * np.abs(targets * value - values).sum()
+            units = targets * value / prices[day]
+        nav[day] = value
+    return nav
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--series', type=int, default=20)
+    parser.add_argument('--days', type=int, default=5040)
+    parser.add_argument('--bands', type=int, default=40)
+    parser.add_argument('--costs', type=int, default=5)
+    args = parser.parse_args()
+
+    from backtest import BACKTEST_SCHEDULES, calendar_rebalances, run_sweep_batch, simulate, sweep, sweep_runs
+    from workers import PROCESS_POOL_WORKERS, SharedArrays, shutdown_process_pool
+
+    rng = np.random.default_rng(42)
+    prices = 100.0 * np.cumprod(1.0 + rng.normal(0.0003, 0.01, size=(args.days, args.series)), axis=0)
+    targets = rng.uniform(0.5, 1.5, args.series)
+    targets /= targets.sum()
+    dates = np.datetime64('2000-01-03') + np.arange(args.days)
+    cost = 0.001
+
+    print('{} series x {} days'.format(args.series, args.days))
+    print('{:<12} {:>11} {:>12} {:>10}'.format('schedule', 'rebalances', 'daily (s)', 'speedup'))
+    for schedule in ('monthly', 'quarterly', 'threshold'):
+        calendar = calendar_rebalances(dates, schedule) if schedule != 'threshold' else None
+        with common.Timer() as fast:
+            nav, rebalances, _, _ = simulate(prices, targets, schedule, 0.05, cost, calendar)
+        with common.Timer() as slow:
+            expected = daily(prices, targets, set(calendar.tolist()) if calendar is not None else None, cost)
+        np.testing.assert_allclose(nav, expected, rtol=1e-10)
+        print('{:<12} {:>11} {:>12.3f} {:>9.1f}x'.format(schedule, len(rebalances), slow.elapsed,
+                                                         slow.elapsed / fast.elapsed))
+
+    runs = sweep_runs(BACKTEST_SCHEDULES, list(np.linspace(0.005, 0.2, args.bands)),
+                      list(np.linspace(0.0, 50.0, args.costs)))
+    calendars = {schedule: calendar_rebalances(dates, schedule) for schedule in ('monthly', 'quarterly', 'annually')}
+    with common.Timer() as serial:
+        with SharedArrays.create(prices=prices.shape, targets=targets.shape) as arrays:
+            arrays['prices'][:] = prices
+            arrays['targets'][:] = targets
+            expected = run_sweep_batch(arrays.spec, calendars, runs, 252)
+    # start the workers (and their imports) outside the timing
+    sweep(prices[:10], targets, dates[:10], runs[:PROCESS_POOL_WORKERS * 4])
+    with common.Timer() as pooled:
+        results = sweep(prices, targets, dates, runs)
+    shutdown_process_pool()
+    assert [result['turnover'] for result in results] == [result['turnover'] for result in expected]
+
+    print('sweep of {} runs: serial {:.3f}s, pool of {} {:.3f}s ({:.1f}x)'.format(
+        len(runs), serial.elapsed, PROCESS_POOL_WORKERS, pooled.elapsed, serial.elapsed / pooled.elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""Payload size and encode/decode time of the columnar binary format against
+JSON, for a large asset price history listing.
+
+    jsonify     keyset_page() dicts, jsonify (the default response)
+    json        keyset_page() dicts, serialization.dumps (orjson when installed)
+    columnar    keyset_rows() tuples, row_columns(), columnar.encode
+
+Encoding includes the query. Decoding is json.loads to a list of dicts, or
+columnar.decode to one array per column. Sizes are given raw and gzipped.
+The routes are then requested through the test client with both `Accept`
+headers, response cache off.
+
+    python benchmarks/bench_columnar.py --rows 100000
+"""
+import argparse, gzip, json, math, os
+import common
+
+os.environ['RESPONSE_CACHE_SIZE'] = '0'
+HEADERS = common.local_auth(['get:asset_price_histories', 'get:portfolios'])
+ROUTES = ('/asset_price_histories', '/asset_price_histories/rolling?ids=1,2&windows=30,90,252',
+          '/portfolios/aggregate')
+
+
+def best_of(repeat, function):
+    best = math.inf
+    for _ in range(repeat):
+        with common.Timer() as timer:
+            result = function()
+        best = min(best, timer.elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    from flask import jsonify
+    from app import create_app
+    from columnar import COLUMNAR_MIMETYPE, decode, encode, row_columns
+    from models import AssetPriceHistory, db
+    from pagination import keyset_page, keyset_rows
+    from serialization import dumps, format_dates, orjson
+
+    app = create_app()
+    portfolios = max(3, args.rows // 2000)
+    with app.app_context():
+        rows = common.seed(db, portfolios, math.ceil(args.rows / portfolios / 2))
+
+    table = AssetPriceHistory.__table__
+    fields = [column.name for column in table.columns]
+
+    def dicts():
+        items, next_cursor = keyset_page(AssetPriceHistory, fields)
+        return {'success': True, 'asset_price_histories': items, 'next_cursor': next_cursor}
+
+    def columns():
+        tuples, next_cursor = keyset_rows(AssetPriceHistory, fields)
+        return {'success': True, 'asset_price_histories': row_columns(table, fields, tuples),
+                'next_cursor': next_cursor}
+
+    encoders = [
+        ('jsonify', lambda: jsonify(dicts()).get_data(), json.loads),
+        ('json', lambda: dumps(dicts()), json.loads),
+        ('columnar', lambda: encode(columns()), decode)
+    ]
+
+    print('{} rows, JSON encoder: {}'.format(rows, 'orjson' if orjson is not None else 'json (stdlib)'))
+    print('{:<10} {:>10} {:>10} {:>11} {:>11}'.format('format', 'encode s', 'decode s', 'bytes', 'gzip bytes'))
+    documents = {}
+    for name, encoder, decoder in encoders:
+        with app.test_request_context():
+            encode_seconds, body = best_of(args.repeat, encoder)
+        decode_seconds, documents[name] = best_of(args.repeat, lambda: decoder(body))
+        print('{:<10} {:>10.3f} {:>10.3f} {:>11,} {:>11,}'.format(name, encode_seconds, decode_seconds, len(body),
+                                                                  len(gzip.compress(body, compresslevel=5))))
+
+    # the columnar document holds the same rows
+    expected = documents['jsonify']['asset_price_histories']
+    decoded = documents['columnar']['asset_price_histories']
+    assert decoded['price'].tolist() == [item['price'] for item in expected]
+    assert format_dates(decoded['date']) == [item['date'] for item in expected]
+    assert decoded['asset_type'].tolist() == [item['asset_type'] for item in expected]
+
+    print()
+    print('{:<58} {:>10} {:>11} {:>10} {:>11}'.format('route', 'json s', 'json bytes', 'columnar s', 'bytes'))
+    client = app.test_client()
+    for route in ROUTES:
+        timings = []
+        for accept in ('application/json', COLUMNAR_MIMETYPE):
+            seconds, response = best_of(args.repeat, lambda: client.get(route, headers=dict(HEADERS, Accept=accept)))
+            assert response.status_code == 200, (route, response.status_code)
+            timings += [seconds, len(response.data)]
+        print('{:<58} {:>10.3f} {:>11,} {:>10.3f} {:>11,}'.format(route, *timings))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""Covariance and correlation matrices of `--series` random return series over
+`--days` days.
+
+    pairs       one np.cov per pair of series, O(n^2 * T) in Python calls
+    sklearn     sklearn.covariance.LedoitWolf, when installed
+    blas        covariance.covariance_estimates: sample and Ledoit-Wolf
+                matrices from one matrix product of the centred returns
+
+The results are checked against each other. Then GET
+/asset_price_histories/covariance is timed on a seeded database, the first
+request computing the matrices and the next ones served from the covariance
+cache (response cache off).
+
+    python benchmarks/bench_covariance.py --series 200 --days 2520 --portfolios 50
+"""
+import argparse, os
+import numpy as np
+import common
+
+try:
+    from sklearn.covariance import LedoitWolf
+except ImportError:  # optional, the scikit-learn baseline is skipped without it
+    LedoitWolf = None
+
+os.environ['RESPONSE_CACHE_SIZE'] = '0'
+HEADERS = common.local_auth(['get:asset_price_histories'])
+
+
+def pairs(returns):
+    size = returns.shape[1]
+    covariance = np.empty((size, size))
+    for first in range(size):
+        for second in range(first, size):
+            covariance[first, second] = covariance[second, first] = \
+                np.cov(returns[:, first], returns[:, second])[0, 1]
+    deviations = np.sqrt(np.diag(covariance))
+    return covariance, covariance / np.outer(deviations, deviations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--series', type=int, default=200)
+    parser.add_argument('--days', type=int, default=2520)
+    parser.add_argument('--portfolios', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=20)
+    args = parser.parse_args()
+
+    from covariance import covariance_estimates
+
+    rng = np.random.default_rng(42)
+    factors = rng.normal(0.0, 0.01, size=(args.days, 5))
+    returns = factors @ rng.normal(0.0, 1.0, size=(5, args.series)) \
+        + rng.normal(0.0, 0.01, size=(args.days, args.series))
+
+    with common.Timer() as fast:
+        estimates = covariance_estimates(returns, periods_per_year=1)
+    timings = [('blas', fast.elapsed)]
+
+    with common.Timer() as timer:
+        covariance, correlation = pairs(returns)
+    timings.append(('pairs', timer.elapsed))
+    np.testing.assert_allclose(covariance, estimates['sample']['covariance'], rtol=1e-8, atol=1e-14)
+    np.testing.assert_allclose(correlation, estimates['sample']['correlation'], rtol=1e-8, atol=1e-12)
+
+    if LedoitWolf is not None:
+        with common.Timer() as timer:
+            model = LedoitWolf().fit(returns)
+        timings.append(('sklearn', timer.elapsed))
+        np.testing.assert_allclose(model.covariance_, estimates['ledoit_wolf']['covariance'], rtol=1e-8)
+        np.testing.assert_allclose(model.shrinkage_, estimates['shrinkage'], rtol=1e-8)
+
+    print('{} series x {} days, shrinkage {:.3f}{}'.format(args.series, args.days, estimates['shrinkage'],
+                                                           '' if LedoitWolf is not None else ' (sklearn not installed)'))
+    print('{:<10} {:>10} {:>10}'.format('path', 'seconds', 'vs blas'))
+    for name, seconds in timings:
+        print('{:<10} {:>10.4f} {:>9.1f}x'.format(name, seconds, seconds / fast.elapsed))
+
+    from app import create_app
+    from models import db
+
+    app = create_app()
+    with app.app_context():
+        common.seed(db, args.portfolios, args.days)
+    client = app.test_client()
+    latencies = []
+    for _ in range(args.requests):
+        with common.Timer() as timer:
+            response = client.get('/asset_price_histories/covariance', headers=HEADERS)
+        assert response.status_code == 200, response.status_code
+        latencies.append(timer.elapsed)
+    print()
+    print('GET /asset_price_histories/covariance, {} series: first {:.1f}ms, cached p50 {:.1f}ms'.format(
+        len(response.get_json()['series']), latencies[0] * 1000, common.percentile(latencies[1:], 0.5) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""Compares the streaming export with the old `.all()` + `.format()` path.
+
+Every mode runs in its own process so the peak RSS numbers don't leak into
+each other.
+
+    python benchmarks/bench_export.py --portfolios 50 --days 2000
+"""
+import argparse, json, subprocess, sys
+import common
+
+MODES = ('legacy', 'ndjson', 'csv', 'ndjson+gzip')
+
+
+def run_mode(mode, portfolios, days):
+    from flask import jsonify
+    from app import create_app
+    from export import export_price_rows
+    from models import AssetPriceHistory, db
+
+    app = create_app()
+
+    with app.test_request_context():
+        rows = common.seed(db, portfolios, days)
+        baseline = common.peak_rss_mb()
+
+        with common.Timer() as timer:
+            if mode == 'legacy':
+                asset_price_histories = AssetPriceHistory.query.all()
+                size = len(jsonify({
+                    'success': True,
+                    'asset_price_histories': [history.format() for history in asset_price_histories]
+                }).get_data())
+            else:
+                export_format, _, gzip = mode.partition('+')
+                size = sum(len(chunk) for chunk in export_price_rows(export_format, gzip=bool(gzip)))
+
+    return {
+        'mode': mode,
+        'rows': rows,
+        'seconds': round(timer.elapsed, 3),
+        'rows_per_sec': round(rows / timer.elapsed),
+        'bytes': size,
+        'baseline_rss_mb': round(baseline, 1),
+        'peak_rss_mb': round(common.peak_rss_mb(), 1),
+        'peak_over_baseline_mb': round(common.peak_rss_mb() - baseline, 1)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--portfolios', type=int, default=50)
+    parser.add_argument('--days', type=int, default=2000)
+    parser.add_argument('--mode', choices=MODES)
+    args = parser.parse_args()
+
+    if args.mode:
+        print(json.dumps(run_mode(args.mode, args.portfolios, args.days)))
+        return
+
+    print('{:<12} {:>10} {:>12} {:>10} {:>16}'.format('mode', 'rows', 'rows/sec', 'MB out', 'peak RSS +MB'))
+    for mode in MODES:
+        output = subprocess.run(
+            [sys.executable, __file__, '--mode', mode,
+             '--portfolios', str(args.portfolios), '--days', str(args.days)],
+            check=True, capture_output=True, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print('{mode:<12} {rows:>10} {rows_per_sec:>12} {mb:>10.1f} {peak_over_baseline_mb:>16}'.format(
+            mb=result['bytes'] / 1e6, **result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""Compares the bulk ingest path and the ingest queue with one `insert()`
+(and one commit) per row. The queue is fed `--tick-batch` ticks per submit
+and timed until the writer has flushed the last one.
+
+    python benchmarks/bench_ingest.py --rows 50000
+"""
+import argparse, time
+from datetime import date
+import common
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--chunk-size', type=int, default=5000)
+    parser.add_argument('--tick-batch', type=int, default=10)
+    args = parser.parse_args()
+
+    from app import create_app
+    from ingest import ingest_records
+    from ingest_queue import ingest_queue
+    from models import AssetPriceHistory, Portfolio, db
+
+    app = create_app()
+
+    with app.app_context():
+        db.create_all()
+        portfolio = Portfolio('Bench', 1.0, 'Bench benchmark', 1, 'QRY')
+        portfolio.insert()
+
+        days = common.trading_days(date(2000, 1, 3), args.rows)
+        records = list(common.price_rows([portfolio.id], days, asset_types=('Bond',)))
+
+        with common.Timer() as per_row:
+            for record in records:
+                AssetPriceHistory(**record).insert()
+
+        with common.Timer() as bulk:
+            result = ingest_records(enumerate(records, start=1), args.chunk_size)
+
+        assert result['accepted'] == len(records)
+
+        ingest_queue.init_app(app)
+        ticks = [dict(record, date=record['date'].isoformat()) for record in records]
+        with common.Timer() as queued:
+            for start in range(0, len(ticks), args.tick_batch):
+                _, last = ingest_queue.submit(ticks[start:start + args.tick_batch])
+            while ingest_queue.flushed_sequence < last:
+                time.sleep(0.001)
+        ingest_queue.stop()
+
+        assert ingest_queue.written == len(records)
+
+    print('{:<10} {:>10} {:>10} {:>12}'.format('path', 'rows', 'seconds', 'rows/sec'))
+    for name, timer in (('insert()', per_row), ('bulk', bulk), ('queue', queued)):
+        print('{:<10} {:>10} {:>10.2f} {:>12.0f}'.format(name, len(records), timer.elapsed, len(records) / timer.elapsed))
+    print('speedup: bulk {:.1f}x, queue {:.1f}x'.format(per_row.elapsed / bulk.elapsed,
+                                                     per_row.elapsed / queued.elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""Loads the aligned price matrix of every portfolio (what the aggregate and
+risk endpoints start from) from the database and from the memory-mapped
+price cube, and checks both give the same result.
+
+    query    load_series_matrix() with the cube off: select, pivot, forward-fill
+    cube     load_series_matrix() with the cube on: slice, forward-fill
+    window   PriceCube.window() alone for one portfolio, a zero-copy slice
+
+    python benchmarks/bench_price_cube.py --portfolios 50 --days 2520
+"""
+import argparse, math, os, tempfile
+import common
+
+os.environ['PRICE_CUBE_DIR'] = tempfile.mkdtemp(prefix='bench-cube-')
+
+
+def best_of(repeat, function):
+    best = math.inf
+    for _ in range(repeat):
+        with common.Timer() as timer:
+            result = function()
+        best = min(best, timer.elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--portfolios', type=int, default=50)
+    parser.add_argument('--days', type=int, default=2520)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    import numpy as np
+    from app import create_app
+    from analytics import load_series_matrix
+    from models import db
+    from price_cube import price_cube
+
+    app = create_app()
+
+    with app.app_context():
+        rows = common.seed(db, args.portfolios, args.days)
+        portfolio_ids = list(range(1, args.portfolios + 1))
+
+        with common.Timer() as rebuild:
+            price_cube.rebuild()
+
+        directory, price_cube.directory = price_cube.directory, None
+        query, expected = best_of(args.repeat, lambda: load_series_matrix(portfolio_ids))
+        price_cube.directory = directory
+        cube, result = best_of(args.repeat, lambda: load_series_matrix(portfolio_ids))
+        keys = price_cube.keys({1})
+        window, _ = best_of(args.repeat, lambda: price_cube.window(keys))
+
+    for left, right in zip(expected, result):
+        np.testing.assert_array_equal(left, right)
+
+    print('{} price rows, cube rebuilt in {:.2f}s'.format(rows, rebuild.elapsed))
+    print('{:<10} {:>12} {:>10}'.format('path', 'ms', 'speedup'))
+    for name, seconds in (('query', query), ('cube', cube), ('window', window)):
+        print('{:<10} {:>12.3f} {:>9.1f}x'.format(name, seconds * 1000, query / seconds))
+
+
+if __name__ == '__main__':
+    main()
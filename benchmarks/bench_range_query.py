@@ -0,0 +1,133 @@
+"""Range query latency on asset price history, before and after the typed
+date column.
+
+`before` is the old layout: a DD-MM-YYYY string column and no index on
+(portfolio_id, asset_type), so a date range means a full scan that rewrites
+every string into a sortable form. `after` is the current layout: a DATE
+column and the composite (portfolio_id, asset_type, date) index.
+
+The default scale is 1000 portfolios x 2 asset types x 5000 days = 10M rows
+per table (in a temporary SQLite file), use --portfolios/--days to shrink it.
+
+    python benchmarks/bench_range_query.py --portfolios 100 --days 5000
+"""
+import argparse, os, random, statistics, tempfile
+from datetime import date
+import common
+
+from sqlalchemy import (Column, Date, Float, Integer, MetaData, String, Table, and_, create_engine, func,
+                        select)
+
+ASSET_TYPES = ('Bond', 'Equity')
+
+
+def tables():
+    metadata = MetaData()
+    before = Table(
+        'prices_before', metadata,
+        Column('id', Integer, primary_key=True),
+        Column('asset_type', String, nullable=False),
+        Column('price', Float, nullable=False),
+        Column('date', String, nullable=False),
+        Column('portfolio_id', Integer))
+    after = Table(
+        'prices_after', metadata,
+        Column('id', Integer, primary_key=True),
+        Column('asset_type', String, nullable=False),
+        Column('price', Float, nullable=False),
+        Column('date', Date, nullable=False),
+        Column('portfolio_id', Integer))
+    return metadata, before, after
+
+
+def load(connection, before, after, portfolios, days):
+    chunk_before, chunk_after = [], []
+    for row in common.price_rows(range(1, portfolios + 1), days, ASSET_TYPES):
+        chunk_after.append(row)
+        chunk_before.append(dict(row, date=row['date'].strftime('%d-%m-%Y')))
+        if len(chunk_after) == 50000:
+            connection.execute(before.insert(), chunk_before)
+            connection.execute(after.insert(), chunk_after)
+            chunk_before, chunk_after = [], []
+    if chunk_after:
+        connection.execute(before.insert(), chunk_before)
+        connection.execute(after.insert(), chunk_after)
+
+    connection.exec_driver_sql(
+        'CREATE INDEX ix_prices_after_portfolio_asset_date ON prices_after (portfolio_id, asset_type, date)')
+    connection.exec_driver_sql('ANALYZE')
+
+
+def sortable(column):
+    return (func.substr(column, 7, 4, type_=String)
+            + func.substr(column, 4, 2, type_=String)
+            + func.substr(column, 1, 2, type_=String))
+
+
+def time_queries(connection, statements):
+    latencies = []
+    for statement in statements:
+        with common.Timer() as timer:
+            connection.execute(statement).fetchall()
+        latencies.append(timer.elapsed * 1000)
+    latencies.sort()
+    return {
+        'p50_ms': statistics.median(latencies),
+        'p95_ms': latencies[int(len(latencies) * 0.95) - 1] if len(latencies) > 1 else latencies[0],
+        'mean_ms': statistics.mean(latencies)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--portfolios', type=int, default=1000)
+    parser.add_argument('--days', type=int, default=5000)
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--window', type=int, default=90, help='range length in trading days')
+    args = parser.parse_args()
+
+    days = common.trading_days(date(2000, 1, 3), args.days)
+    path = os.path.join(tempfile.mkdtemp(), 'range_query.db')
+    engine = create_engine('sqlite:///' + path)
+    metadata, before, after = tables()
+    metadata.create_all(engine)
+
+    with engine.begin() as connection:
+        with common.Timer() as load_timer:
+            load(connection, before, after, args.portfolios, days)
+    rows = args.portfolios * len(ASSET_TYPES) * len(days)
+    print('loaded {} rows per table in {:.1f}s'.format(rows, load_timer.elapsed))
+
+    rng = random.Random(7)
+    ranges = []
+    for _ in range(args.queries):
+        start = rng.randrange(0, len(days) - args.window)
+        ranges.append((rng.randint(1, args.portfolios), rng.choice(ASSET_TYPES), days[start], days[start + args.window]))
+
+    before_statements = [
+        select(before).where(and_(
+            before.c.portfolio_id == portfolio_id,
+            before.c.asset_type == asset_type,
+            sortable(before.c.date) >= start.strftime('%Y%m%d'),
+            sortable(before.c.date) <= end.strftime('%Y%m%d')))
+        for portfolio_id, asset_type, start, end in ranges]
+    after_statements = [
+        select(after).where(and_(
+            after.c.portfolio_id == portfolio_id,
+            after.c.asset_type == asset_type,
+            after.c.date >= start,
+            after.c.date <= end)).order_by(after.c.date)
+        for portfolio_id, asset_type, start, end in ranges]
+
+    with engine.connect() as connection:
+        results = [('before', time_queries(connection, before_statements)),
+                   ('after', time_queries(connection, after_statements))]
+
+    print('{:<8} {:>10} {:>10} {:>10}'.format('layout', 'p50 ms', 'p95 ms', 'mean ms'))
+    for name, result in results:
+        print('{:<8} {p50_ms:>10.2f} {p95_ms:>10.2f} {mean_ms:>10.2f}'.format(name, **result))
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
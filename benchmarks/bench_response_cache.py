@@ -0,0 +1,61 @@
+"""Load test of the polled read endpoints with and without the response cache.
+
+Serves the app on a local threaded server and hammers it from `--clients`
+threads, every mode for `--seconds` seconds:
+
+    nocache      body cache disabled, every request hits the database
+    cache        bodies served from the in-process cache
+    conditional  clients send If-None-Match and get 304s
+
+    python benchmarks/bench_response_cache.py --portfolios 20 --days 1000 --clients 8
+"""
+import argparse
+import common, loadgen
+
+HEADERS = common.local_auth(['get:portfolios', 'get:asset_price_histories'])
+
+MODES = ('nocache', 'cache', 'conditional')
+PATHS = ('/portfolios', '/asset_price_histories?limit=1000', '/asset_price_histories?portfolio_id=1')
+
+
+def run_mode(mode, port, path, clients, seconds):
+    from response_cache import RESPONSE_CACHE_SIZE, response_cache
+
+    response_cache.clear()
+    response_cache.maxsize = 0 if mode == 'nocache' else RESPONSE_CACHE_SIZE
+    headers = dict(HEADERS)
+    if mode == 'conditional':
+        headers['If-None-Match'] = loadgen.send(port, 'GET', path, headers)[1]['ETag']
+
+    result = loadgen.run_load(port, lambda: ('GET', path, headers, None), clients, seconds, ok=(200, 304))
+    if result['errors']:
+        raise RuntimeError('{} failed: {}'.format(path, result['statuses']))
+    return dict(result, mode=mode, path=path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--portfolios', type=int, default=20)
+    parser.add_argument('--days', type=int, default=1000)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=5.0)
+    args = parser.parse_args()
+
+    from app import create_app
+    from models import db
+
+    app = create_app()
+
+    with app.app_context():
+        common.seed(db, args.portfolios, args.days)
+
+    print('{:<12} {:<40} {:>10} {:>10} {:>10}'.format('mode', 'path', 'req/sec', 'p50 ms', 'p99 ms'))
+    with loadgen.serve(app) as port:
+        for path in PATHS:
+            for mode in MODES:
+                result = run_mode(mode, port, path, args.clients, args.seconds)
+                print('{mode:<12} {path:<40} {ops_per_sec:>10} {p50_ms:>10} {p99_ms:>10}'.format(**result))
+
+
+if __name__ == '__main__':
+    main()
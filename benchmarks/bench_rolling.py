@@ -0,0 +1,92 @@
+"""Rolling volatility, pairwise correlation and beta of `--series` random
+return series over `--days` days, for several window sizes at once.
+
+    naive    every window recomputed with std / corrcoef / cov, O(n*w)
+    pandas   DataFrame.rolling(...).std() / .corr() / .cov(), when installed
+    sums     rolling.rolling_moments, running sums, O(n) per window size
+
+The results of every baseline are checked against `sums`.
+
+    python benchmarks/bench_rolling.py --series 20 --days 2520 --windows 30,90,252
+"""
+import argparse
+import numpy as np
+import common
+
+try:
+    import pandas
+except ImportError:  # optional, the pandas baseline is skipped without it
+    pandas = None
+
+
+def naive(returns, benchmark, windows):
+    results = {}
+    first, second = np.triu_indices(returns.shape[1], 1)
+    for window in windows:
+        volatility = np.full(returns.shape, np.nan)
+        correlation = np.full((len(returns), len(first)), np.nan)
+        beta = np.full(returns.shape, np.nan)
+        for end in range(window, len(returns) + 1):
+            rows = returns[end - window:end]
+            benchmark_rows = benchmark[end - window:end]
+            volatility[end - 1] = rows.std(axis=0, ddof=1)
+            correlation[end - 1] = np.corrcoef(rows, rowvar=False)[first, second]
+            beta[end - 1] = np.cov(rows, benchmark_rows, rowvar=False)[-1, :-1] / benchmark_rows.var(ddof=1)
+        results[window] = {'volatility': volatility * np.sqrt(252), 'correlation': correlation, 'beta': beta}
+    return results
+
+
+def with_pandas(returns, benchmark, windows):
+    frame = pandas.DataFrame(returns)
+    benchmark = pandas.Series(benchmark)
+    first, second = np.triu_indices(returns.shape[1], 1)
+    results = {}
+    for window in windows:
+        rolling = frame.rolling(window)
+        correlation = rolling.corr().to_numpy().reshape(len(returns), returns.shape[1], returns.shape[1])
+        results[window] = {
+            'volatility': rolling.std().to_numpy() * np.sqrt(252),
+            'correlation': correlation[:, first, second],
+            'beta': np.column_stack([frame[column].rolling(window).cov(benchmark) for column in frame])
+            / benchmark.rolling(window).var().to_numpy()[:, None]
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--series', type=int, default=20)
+    parser.add_argument('--days', type=int, default=2520)
+    parser.add_argument('--windows', default='30,90,252')
+    args = parser.parse_args()
+
+    from rolling import rolling_moments
+
+    windows = [int(window) for window in args.windows.split(',')]
+    rng = np.random.default_rng(42)
+    returns = rng.normal(0.0003, 0.01, size=(args.days, args.series))
+    benchmark = returns.mean(axis=1) + rng.normal(0.0, 0.002, size=args.days)
+    metrics = ('volatility', 'correlation', 'beta')
+
+    with common.Timer() as fast:
+        expected = rolling_moments(returns, windows, metrics, benchmark)
+
+    paths = [('naive', naive)] + ([('pandas', with_pandas)] if pandas is not None else [])
+    timings = [('sums', fast.elapsed)]
+    for name, function in paths:
+        with common.Timer() as timer:
+            result = function(returns, benchmark, windows)
+        timings.append((name, timer.elapsed))
+        for window in windows:
+            for metric in metrics:
+                np.testing.assert_allclose(result[window][metric], expected[window][metric], rtol=1e-7, atol=1e-10)
+
+    print('{} series x {} days, windows {}{}'.format(args.series, args.days, args.windows,
+                                                    '' if pandas is not None else ' (pandas not installed)'))
+    print('{:<10} {:>10} {:>10}'.format('path', 'seconds', 'vs sums'))
+    for name, seconds in timings:
+        print('{:<10} {:>10.3f} {:>9.1f}x'.format(name, seconds, seconds / fast.elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""Serialization throughput of a large asset price history listing.
+
+    orm+jsonify    Query.all(), format() per instance, jsonify (the original path)
+    core+jsonify   Core select() tuples, jsonify
+    core+fast      Core select() tuples, serialization.dumps (orjson when installed)
+    http           GET /asset_price_histories through the test client, response cache off
+
+    python benchmarks/bench_serialization.py --rows 100000
+"""
+import argparse, json, math, os
+import common
+
+os.environ['RESPONSE_CACHE_SIZE'] = '0'
+HEADERS = common.local_auth(['get:asset_price_histories'])
+
+MODES = ('orm+jsonify', 'core+jsonify', 'core+fast', 'http')
+
+
+def run(mode, app, repeat):
+    from flask import jsonify
+    from models import AssetPriceHistory
+    from pagination import keyset_page
+    from serialization import dumps
+
+    fields = [column.name for column in AssetPriceHistory.__table__.columns]
+    best = math.inf
+    for _ in range(repeat):
+        with app.test_request_context(), common.Timer() as timer:
+            if mode == 'orm+jsonify':
+                body = jsonify({
+                    'success': True,
+                    'asset_price_histories': [history.format() for history in AssetPriceHistory.query.all()],
+                    'next_cursor': None
+                }).get_data()
+            elif mode == 'http':
+                body = app.test_client().get('/asset_price_histories', headers=HEADERS).get_data()
+            else:
+                rows, next_cursor = keyset_page(AssetPriceHistory, fields)
+                payload = {'success': True, 'asset_price_histories': rows, 'next_cursor': next_cursor}
+                body = jsonify(payload).get_data() if mode == 'core+jsonify' else dumps(payload)
+        best = min(best, timer.elapsed)
+    return best, body
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    from app import create_app
+    from models import db
+    from serialization import orjson
+
+    app = create_app()
+
+    portfolios = max(1, args.rows // 2000)
+    with app.app_context():
+        rows = common.seed(db, portfolios, math.ceil(args.rows / portfolios / 2))
+
+    print('{} rows, encoder: {}'.format(rows, 'orjson' if orjson is not None else 'json (stdlib)'))
+    print('{:<14} {:>10} {:>12} {:>10}'.format('mode', 'seconds', 'rows/sec', 'speedup'))
+    baseline = None
+    bodies = {}
+    for mode in MODES:
+        seconds, bodies[mode] = run(mode, app, args.repeat)
+        baseline = baseline or seconds
+        print('{:<14} {:>10.3f} {:>12.0f} {:>9.1f}x'.format(mode, seconds, rows / seconds, baseline / seconds))
+
+    # every path must produce the same document
+    documents = {mode: json.loads(body) for mode, body in bodies.items()}
+    assert all(document == documents['orm+jsonify'] for document in documents.values())
+
+
+if __name__ == '__main__':
+    main()
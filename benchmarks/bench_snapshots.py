@@ -0,0 +1,93 @@
+"""Valuation of every portfolio "as of" a date, from the raw prices and from
+the portfolio_snapshots table, then the cost of keeping the snapshots up to
+date.
+
+    scan        latest price at or before the date of every series, a
+                GROUP BY over asset_price_histories joined back to the rows
+    snapshot    snapshots.snapshot_as_of, one primary key lookup
+
+Both are checked to return the same prices. Then the snapshots are
+refreshed after a new day of prices, after a correction `--backfill` days
+back in one series, and rebuilt from scratch.
+
+    python benchmarks/bench_snapshots.py --portfolios 50 --days 2520
+"""
+import argparse, random
+from datetime import timedelta
+import common
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--portfolios', type=int, default=50)
+    parser.add_argument('--days', type=int, default=2520)
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--backfill', type=int, default=250)
+    args = parser.parse_args()
+
+    from sqlalchemy import and_, func, select
+    from app import create_app
+    from models import AssetPriceHistory, db, log_write
+    from snapshots import snapshot_as_of, snapshots
+
+    app = create_app()
+    table = AssetPriceHistory.__table__
+    with app.app_context():
+        rows = common.seed(db, args.portfolios, args.days)
+        with common.Timer() as rebuild:
+            result = snapshots.refresh(full=True)
+        print('{} price rows, {} snapshot rows'.format(rows, result['rows']))
+
+        first, last = db.session.execute(select(func.min(table.c.date), func.max(table.c.date))).one()
+        random.seed(42)
+        dates = [first + timedelta(days=random.randrange((last - first).days + 30)) for _ in range(args.queries)]
+
+        def scan(as_of):
+            latest = select(table.c.portfolio_id, table.c.asset_type, func.max(table.c.date).label('date')) \
+                .where(table.c.portfolio_id.isnot(None), table.c.date <= as_of) \
+                .group_by(table.c.portfolio_id, table.c.asset_type) \
+                .subquery()
+            statement = select(table.c.portfolio_id, table.c.asset_type, table.c.price) \
+                .join(latest, and_(table.c.portfolio_id == latest.c.portfolio_id,
+                                   table.c.asset_type == latest.c.asset_type, table.c.date == latest.c.date)) \
+                .order_by(table.c.portfolio_id, table.c.asset_type)
+            return [tuple(row) for row in db.session.execute(statement)]
+
+        timings = {}
+        for name, query in (('scan', scan),
+                            ('snapshot', lambda as_of: [(row.portfolio_id, row.asset_type, row.price)
+                                                        for row in snapshot_as_of(as_of)])):
+            latencies, results = [], []
+            for as_of in dates:
+                with common.Timer() as timer:
+                    results.append(query(as_of))
+                latencies.append(timer.elapsed)
+            timings[name] = (latencies, results)
+        assert timings['scan'][1] == timings['snapshot'][1]
+
+        print('{:<10} {:>10} {:>10}'.format('as of', 'p50 ms', 'p95 ms'))
+        for name, (latencies, _) in timings.items():
+            print('{:<10} {:>10.2f} {:>10.2f}'.format(name, common.percentile(latencies, 0.5) * 1000,
+                                                       common.percentile(latencies, 0.95) * 1000))
+
+        series = db.session.execute(select(table.c.portfolio_id, table.c.asset_type).distinct()).fetchall()
+        new_day = [{'portfolio_id': portfolio_id, 'asset_type': asset_type, 'price': 100.0,
+                    'date': last + timedelta(days=1)} for portfolio_id, asset_type in series]
+        portfolio_id, asset_type = series[0]
+        correction = [{'portfolio_id': portfolio_id, 'asset_type': asset_type, 'price': 100.0,
+                       'date': last - timedelta(days=args.backfill)}]
+
+        print()
+        print('{:<28} {:>10} {:>8} {:>10}'.format('refresh', 'seconds', 'days', 'rows'))
+        for name, changes in (('new day of prices', new_day), ('{} days back'.format(args.backfill), correction)):
+            db.session.execute(table.insert(), changes)
+            log_write(table.name, 'insert', changes)
+            db.session.commit()
+            with common.Timer() as timer:
+                result = snapshots.refresh()
+            print('{:<28} {:>10.3f} {:>8} {:>10}'.format(name, timer.elapsed, result['days'], result['rows']))
+        print('{:<28} {:>10.3f} {:>8} {:>10}'.format('full rebuild', rebuild.elapsed, '', ''))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""Measures cold start: each run is a fresh interpreter that imports the app
+module, builds the app with `create_app()`, creates the schema and serves
+one authenticated request. Prints the median of every phase over `--runs` runs, and with
+`--importtime` the slowest imports of one run (from `python -X importtime`).
+
+    python benchmarks/bench_startup.py --runs 10 --importtime 15
+"""
+import argparse, json, os, statistics, subprocess, sys, time
+import common
+
+CHILD = """
+import json, os, sys, time
+started = time.perf_counter()
+sys.path.insert(0, {root!r})
+import app
+imported = time.perf_counter()
+application = app.create_app()
+created = time.perf_counter()
+from models import Portfolio, db
+with application.app_context():
+    db.create_all()
+    Portfolio('Bench', 1.0, 'Bench benchmark', 1, 'QRY').insert()
+schema = time.perf_counter()
+response = application.test_client().get('/portfolios', headers={{'Authorization': os.environ['BENCH_AUTHORIZATION']}})
+assert response.status_code == 200, response.status_code
+answered = time.perf_counter()
+print(json.dumps({{
+    'import': imported - started,
+    'create_app': created - imported,
+    'schema': schema - created,
+    'first_request': answered - schema
+}}))
+"""
+
+PHASES = ('import', 'create_app', 'schema', 'first_request')
+
+
+def run_child(env, flags=()):
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, *flags, '-c', CHILD.format(root=common.ROOT)],
+                            env=env, capture_output=True, text=True)
+    if result.returncode:
+        sys.exit(result.stderr)
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+    timings['process'] = time.perf_counter() - started
+    return timings, result.stderr
+
+
+def slowest_imports(stderr, count):
+    """(cumulative microseconds, module) of the top level imports."""
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # nested imports are indented below their parent
+        if not name[1:].startswith(' '):
+            imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--importtime', type=int, default=0, metavar='N',
+                        help='show the N slowest top level imports')
+    args = parser.parse_args()
+
+    headers = common.local_auth(['get:portfolios'])
+    env = dict(os.environ, BENCH_AUTHORIZATION=headers['Authorization'])
+
+    runs = [run_child(env)[0] for _ in range(args.runs)]
+
+    print('{:<14} {:>10} {:>10}'.format('phase', 'median ms', 'max ms'))
+    for phase in PHASES + ('process',):
+        values = [run[phase] * 1000 for run in runs]
+        print('{:<14} {:>10.1f} {:>10.1f}'.format(phase, statistics.median(values), max(values)))
+
+    if args.importtime:
+        _, stderr = run_child(env, ('-X', 'importtime'))
+        print('\n{:<40} {:>10}'.format('import', 'ms'))
+        for cumulative, name in slowest_imports(stderr, args.importtime):
+            print('{:<40} {:>10.1f}'.format(name, cumulative / 1000))
+
+
+if __name__ == '__main__':
+    main()
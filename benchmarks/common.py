@@ -0,0 +1,123 @@
+"""Shared helpers for the benchmark scripts.
+
+The scripts run against an in-memory SQLite database by default, set
+DATABASE_URL to benchmark against PostgreSQL instead.
+"""
+import json, os, random, resource, sys, tempfile, time
+from datetime import date, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+os.environ.setdefault('AUTH0_DOMAIN', 'bench.local')
+os.environ.setdefault('API_AUDIENCE', 'bench-api')
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+os.environ.setdefault('INGEST_SPOOL_DIR', tempfile.mkdtemp(prefix='bench-spool-'))
+
+SEED_CHUNK_SIZE = 10000
+
+
+def peak_rss_mb():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes on Linux
+    return usage / (1024 * 1024) if sys.platform == 'darwin' else usage / 1024
+
+
+def trading_days(start, count):
+    day = start
+    days = []
+    while len(days) < count:
+        if day.weekday() < 5:
+            days.append(day)
+        day += timedelta(days=1)
+    return days
+
+
+def price_rows(portfolio_ids, days, asset_types=('Bond', 'Equity'), seed=42):
+    """Yields synthetic random-walk price rows for every portfolio and asset type."""
+    rng = random.Random(seed)
+    for portfolio_id in portfolio_ids:
+        for asset_type in asset_types:
+            price = 100.0
+            for day in days:
+                price *= 1 + rng.gauss(0.0002, 0.01)
+                yield {
+                    'asset_type': asset_type,
+                    'price': round(price, 4),
+                    'date': day,
+                    'portfolio_id': portfolio_id
+                }
+
+
+def seed(db, portfolios=10, days=1000, asset_types=('Bond', 'Equity')):
+    """Fills the database with `portfolios` portfolios and a price history of
+    `days` trading days per asset type. Returns the number of price rows."""
+    from models import AssetPriceHistory, Portfolio
+    from price_cube import price_cube
+    from resample import rollups
+
+    db.create_all()
+    db.session.execute(Portfolio.__table__.insert(), [{
+        'asset_class_desc': 'Asset class {}'.format(i),
+        'weight': 1.0 / portfolios,
+        'benchmark_desc': 'Benchmark {}'.format(i),
+        'sort_id': i,
+        'bloomberg_qry': 'QRY{}'.format(i)
+    } for i in range(portfolios)])
+    db.session.commit()
+
+    portfolio_ids = [row[0] for row in db.session.query(Portfolio.id).order_by(Portfolio.id)]
+    count = 0
+    chunk = []
+    for row in price_rows(portfolio_ids, trading_days(date(2000, 1, 3), days), asset_types):
+        chunk.append(row)
+        if len(chunk) == SEED_CHUNK_SIZE:
+            db.session.execute(AssetPriceHistory.__table__.insert(), chunk)
+            count += len(chunk)
+            chunk = []
+    if chunk:
+        db.session.execute(AssetPriceHistory.__table__.insert(), chunk)
+        count += len(chunk)
+    db.session.commit()
+    # the rows bypassed the write listeners
+    rollups.rebuild()
+    if price_cube.enabled:
+        price_cube.rebuild()
+    return count
+
+
+def local_auth(permissions):
+    """Points the app at a throwaway JWKS file and returns request headers
+    holding a token with `permissions`. Must run before `auth` is imported."""
+    handle, path = tempfile.mkstemp(suffix='.json')
+    os.environ['JWKS_URL'] = 'file://' + path
+
+    from jose import jwt
+    from signing_keys import make_key
+
+    pem, jwk = make_key('bench')
+    with os.fdopen(handle, 'w') as f:
+        json.dump({'keys': [jwk]}, f)
+
+    token = jwt.encode({
+        'iss': 'https://{}/'.format(os.environ['AUTH0_DOMAIN']),
+        'aud': os.environ['API_AUDIENCE'],
+        'exp': int(time.time()) + 24 * 3600,
+        'permissions': list(permissions)
+    }, pem, algorithm='RS256', headers={'kid': 'bench'})
+    return {'Authorization': 'Bearer ' + token}
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class Timer:
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
@@ -0,0 +1,92 @@
+"""A small closed-loop HTTP load generator.
+
+`serve(app)` runs a WSGI app on a local threaded server, `run_load` keeps
+`clients` threads sending requests back to back for a fixed time and
+collects the latency of every request.
+"""
+from contextlib import contextmanager
+import http.client, logging, statistics, threading, time
+import common
+
+
+@contextmanager
+def serve(app):
+    """Yields the port of a local threaded server running `app`."""
+    from werkzeug.serving import make_server
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server.server_port
+    finally:
+        server.shutdown()
+        thread.join()
+
+
+def send(port, method, path, headers=None, body=None):
+    """Sends one request on a fresh connection, returns (status, headers, body)."""
+    connection = http.client.HTTPConnection('127.0.0.1', port)
+    try:
+        connection.request(method, path, body=body, headers=headers or {})
+        response = connection.getresponse()
+        return response.status, dict(response.getheaders()), response.read()
+    finally:
+        connection.close()
+
+
+def run_load(port, make_request, clients=8, seconds=5.0, ok=(200,)):
+    """Runs `clients` threads for `seconds`, each sending the (method, path,
+    headers, body) returned by `make_request()` back to back. Returns a
+    summary with throughput and latency percentiles."""
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def client():
+        local_latencies = []
+        local_statuses = {}
+        while time.perf_counter() < deadline:
+            method, path, headers, body = make_request()
+            start = time.perf_counter()
+            try:
+                status = send(port, method, path, headers, body)[0]
+            except OSError:
+                status = 'connection error'
+            local_latencies.append(time.perf_counter() - start)
+            local_statuses[status] = local_statuses.get(status, 0) + 1
+        with lock:
+            latencies.extend(local_latencies)
+            for status, count in local_statuses.items():
+                statuses[status] = statuses.get(status, 0) + count
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    return summarize(latencies, elapsed, statuses, ok)
+
+
+def summarize(latencies, elapsed, statuses, ok=(200,)):
+    """Latency statistics in milliseconds plus throughput and error counts."""
+    if not latencies:
+        return {'requests': 0, 'errors': 0, 'ops_per_sec': 0.0, 'statuses': statuses}
+    return {
+        'requests': len(latencies),
+        'errors': sum(count for status, count in statuses.items() if status not in ok),
+        'ops_per_sec': round(len(latencies) / elapsed, 1),
+        'mean_ms': round(statistics.mean(latencies) * 1000, 3),
+        'min_ms': round(min(latencies) * 1000, 3),
+        'max_ms': round(max(latencies) * 1000, 3),
+        'stddev_ms': round(statistics.pstdev(latencies) * 1000, 3),
+        'p50_ms': round(common.percentile(latencies, 0.50) * 1000, 3),
+        'p95_ms': round(common.percentile(latencies, 0.95) * 1000, 3),
+        'p99_ms': round(common.percentile(latencies, 0.99) * 1000, 3),
+        'statuses': {str(status): count for status, count in sorted(statuses.items(), key=str)}
+    }
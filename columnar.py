@@ -0,0 +1,132 @@
+from datetime import date
+import json, struct
+import numpy as np
+from sqlalchemy import Boolean, Date, Float, Integer
+
+COLUMNAR_MIMETYPE = 'application/vnd.portfolio.columnar'
+MAGIC = b'COL1'
+ALIGNMENT = 8
+INT32 = np.iinfo(np.int32)
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+def padding(size):
+    return -size % ALIGNMENT
+
+
+def smallest_index_dtype(size):
+    for dtype in ('<i1', '<i2'):
+        if size <= np.iinfo(dtype).max:
+            return dtype
+    return '<i4'
+
+
+def pack(array):
+    """Returns (column description, buffer) for one array."""
+    if np.issubdtype(array.dtype, np.datetime64):
+        return {'dtype': '<i4', 'encoding': 'days'}, array.astype('datetime64[D]').astype('<i4')
+    if np.issubdtype(array.dtype, np.floating):
+        return {'dtype': '<f8'}, array.astype('<f8', copy=False)
+    if np.issubdtype(array.dtype, np.bool_):
+        return {'dtype': '|b1'}, array
+    if np.issubdtype(array.dtype, np.integer):
+        fits = not array.size or (INT32.min <= array.min() and array.max() <= INT32.max)
+        dtype = '<i4' if fits else '<i8'
+        return {'dtype': dtype}, array.astype(dtype, copy=False)
+    dictionary, codes = np.unique(array.astype(str), return_inverse=True)
+    dtype = smallest_index_dtype(len(dictionary))
+    return ({'dtype': dtype, 'encoding': 'dictionary', 'dictionary': dictionary.tolist()},
+            codes.reshape(array.shape).astype(dtype))
+
+
+def split_arrays(payload, path=()):
+    """Copies the nested dicts of `payload` without the arrays, and lists
+    (path, array) of the arrays taken out."""
+    meta, arrays = {}, []
+    for key, value in payload.items():
+        if isinstance(value, np.ndarray):
+            arrays.append((path + (key,), value))
+        elif isinstance(value, dict):
+            meta[key], nested = split_arrays(value, path + (key,))
+            arrays += nested
+        else:
+            meta[key] = value
+    return meta, arrays
+
+
+def scalar(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError('{!r} is not JSON serializable'.format(value))
+
+
+def encode(payload):
+    """Encodes `payload`, a dict whose values (at any depth of nested dicts)
+    may be NumPy arrays, as b'COL1', a uint32 header length, a JSON header
+    {"meta": payload without the arrays, "columns": [...]} and the packed
+    little-endian buffers of the arrays, each 8-byte aligned. Dates are
+    int32 days since 1970-01-01, strings are dictionary encoded."""
+    meta, arrays = split_arrays(payload)
+    columns, buffers, offset = [], [], 0
+    for path, array in arrays:
+        column, buffer = pack(array)
+        data = np.ascontiguousarray(buffer).tobytes()
+        columns.append(dict(column, path=list(path), shape=list(array.shape), offset=offset))
+        buffers += [data, b'\0' * padding(len(data))]
+        offset += len(data) + padding(len(data))
+
+    header = json.dumps({'meta': meta, 'columns': columns}, default=scalar, separators=(',', ':')).encode('utf-8')
+    prefix = MAGIC + struct.pack('<I', len(header)) + header
+    return b''.join([prefix, b'\0' * padding(len(prefix))] + buffers)
+
+
+def decode(data):
+    """Inverse of `encode`. The numeric arrays are read-only views on `data`,
+    dates come back as datetime64[D] and strings as object arrays."""
+    if data[:4] != MAGIC:
+        raise ValueError('not a columnar payload')
+    size, = struct.unpack_from('<I', data, 4)
+    header = json.loads(bytes(data[8:8 + size]))
+    start = 8 + size + padding(8 + size)
+
+    payload = header['meta']
+    for column in header['columns']:
+        count = int(np.prod(column['shape'], dtype=np.int64))
+        values = np.frombuffer(data, dtype=column['dtype'], count=count,
+                               offset=start + column['offset']).reshape(column['shape'])
+        encoding = column.get('encoding')
+        if encoding == 'days':
+            values = values.astype('datetime64[D]')
+        elif encoding == 'dictionary':
+            values = np.array(column['dictionary'], dtype=object)[values]
+        target = payload
+        for key in column['path'][:-1]:
+            target = target.setdefault(key, {})
+        target[column['path'][-1]] = values
+    return payload
+
+
+def row_columns(table, names, rows):
+    """Transposes row tuples of `table` into one array per column, typed
+    after the column: float64, datetime64[D], int64 (float64 with NaN when
+    a nullable integer column holds nulls), bool or strings."""
+    values = list(zip(*rows)) if rows else [()] * len(names)
+    columns = {}
+    for name, column in zip(names, values):
+        column_type = table.c[name].type
+        if isinstance(column_type, Float):
+            columns[name] = np.fromiter(column, dtype=np.float64, count=len(column))
+        elif isinstance(column_type, Date):
+            # much faster than letting NumPy convert the date objects
+            ordinals = np.fromiter(map(date.toordinal, column), dtype=np.int64, count=len(column))
+            columns[name] = (ordinals - EPOCH_ORDINAL).astype('datetime64[D]')
+        elif isinstance(column_type, Boolean):
+            columns[name] = np.fromiter(column, dtype=bool, count=len(column))
+        elif isinstance(column_type, Integer):
+            if None in column:
+                columns[name] = np.array([np.nan if value is None else value for value in column])
+            else:
+                columns[name] = np.fromiter(column, dtype=np.int64, count=len(column))
+        else:
+            columns[name] = np.array(column, dtype=object)
+    return columns
@@ -0,0 +1,158 @@
+from sqlalchemy import Date, Float, Integer, String, bindparam, cast, column, func, select, values
+from models import AssetPriceHistory, Portfolio, bump_versions, db, log_write, notify_write, parse_date
+
+PATCH_MODES = ('atomic', 'best_effort')
+PATCH_COLUMNS = ('asset_type', 'price', 'date', 'portfolio_id')
+MAX_PATCH_ITEMS = 10000
+# rows per UPDATE statement, keeps the bind parameter count under the driver limits
+PATCH_CHUNK_SIZE = 1000
+
+price_table = AssetPriceHistory.__table__
+column_types = {'id': Integer, 'asset_type': String, 'price': Float, 'date': Date, 'portfolio_id': Integer}
+
+
+def validate_patch(patch):
+    """Returns (id, changes) for one patch, raises ValueError when it can't be
+    applied. Only the fields present in the patch are changed."""
+    if not isinstance(patch, dict):
+        raise ValueError('malformed patch')
+
+    unknown = set(patch) - set(PATCH_COLUMNS) - {'id'}
+    if unknown:
+        raise ValueError('unknown fields: ' + ', '.join(sorted(unknown)))
+
+    id = patch.get('id')
+    if not isinstance(id, int) or isinstance(id, bool):
+        raise ValueError('id must be an integer')
+
+    changes = {name: patch[name] for name in PATCH_COLUMNS if name in patch}
+    if not changes:
+        raise ValueError('nothing to update')
+    if any(value is None for value in changes.values()):
+        raise ValueError('fields can\'t be null')
+
+    try:
+        if 'asset_type' in changes:
+            changes['asset_type'] = str(changes['asset_type'])
+        if 'price' in changes:
+            changes['price'] = float(changes['price'])
+        if 'portfolio_id' in changes:
+            changes['portfolio_id'] = int(changes['portfolio_id'])
+    except (TypeError, ValueError):
+        raise ValueError('price and portfolio_id must be numbers')
+    if 'date' in changes:
+        changes['date'] = parse_date(changes['date'])
+
+    return id, changes
+
+
+def chunked(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def load_rows(ids):
+    rows = {}
+    for chunk in chunked(sorted(ids), PATCH_CHUNK_SIZE):
+        statement = select(price_table).where(price_table.c.id.in_(chunk))
+        rows.update((row.id, dict(row._mapping)) for row in db.session.execute(statement))
+    return rows
+
+
+def update_rows(patches):
+    """Applies the (id, changes) pairs with one set-based UPDATE per chunk,
+    the caller commits.
+
+    On PostgreSQL the patches are joined in as `UPDATE ... FROM (VALUES ...)`,
+    fields missing from a patch are sent as NULL and COALESCE keeps the
+    current value. Other databases get the same statement as an executemany.
+    """
+    if db.session.connection().dialect.name == 'postgresql':
+        for chunk in chunked(patches, PATCH_CHUNK_SIZE):
+            patch_values = values(*[column(name, column_types[name]) for name in ('id',) + PATCH_COLUMNS],
+                                  name='patches') \
+                .data([(id,) + tuple(changes.get(name) for name in PATCH_COLUMNS) for id, changes in chunk])
+            statement = price_table.update() \
+                .where(price_table.c.id == patch_values.c.id) \
+                .values({
+                    name: func.coalesce(cast(patch_values.c[name], column_types[name]), price_table.c[name])
+                    for name in PATCH_COLUMNS
+                })
+            db.session.execute(statement)
+    else:
+        statement = price_table.update() \
+            .where(price_table.c.id == bindparam('patch_id')) \
+            .values({
+                name: func.coalesce(bindparam('patch_' + name, type_=column_types[name]), price_table.c[name])
+                for name in PATCH_COLUMNS
+            })
+        for chunk in chunked(patches, PATCH_CHUNK_SIZE):
+            db.session.execute(statement, [
+                dict({'patch_id': id}, **{'patch_' + name: changes.get(name) for name in PATCH_COLUMNS})
+                for id, changes in chunk
+            ])
+
+
+def apply_patches(patches, mode='atomic'):
+    """Validates and applies a list of price history patches in one
+    transaction.
+
+    In `atomic` mode nothing is written if any patch is rejected, in
+    `best_effort` mode the valid patches are written and the others reported.
+    Errors carry the index of the patch in the request.
+    """
+    valid = []
+    errors = []
+    seen = set()
+    for index, patch in enumerate(patches):
+        try:
+            id, changes = validate_patch(patch)
+            if id in seen:
+                raise ValueError('duplicate id {}'.format(id))
+            seen.add(id)
+            valid.append((index, id, changes))
+        except ValueError as e:
+            errors.append({'index': index, 'id': patch.get('id') if isinstance(patch, dict) else None,
+                           'error': str(e)})
+
+    current = load_rows({id for _, id, _ in valid}) if valid else {}
+    portfolio_ids = {changes['portfolio_id'] for _, _, changes in valid if 'portfolio_id' in changes}
+    known_portfolios = {portfolio_id for portfolio_id, in db.session.query(Portfolio.id)
+                        .filter(Portfolio.id.in_(portfolio_ids))} if portfolio_ids else set()
+
+    accepted = []
+    for index, id, changes in valid:
+        if id not in current:
+            errors.append({'index': index, 'id': id, 'error': 'asset price history {} not found'.format(id)})
+        elif 'portfolio_id' in changes and changes['portfolio_id'] not in known_portfolios:
+            errors.append({'index': index, 'id': id,
+                           'error': 'unknown portfolio_id {}'.format(changes['portfolio_id'])})
+        else:
+            accepted.append((id, changes))
+
+    errors.sort(key=lambda error: error['index'])
+    if mode == 'atomic' and errors:
+        accepted = []
+
+    if accepted:
+        updates = [dict(current[id], previous={name: current[id][name] for name in changes
+                                               if current[id][name] != changes[name]}, **changes)
+                   for id, changes in accepted]
+        try:
+            update_rows(accepted)
+            version = bump_versions(price_table.name)[price_table.name]
+            log_write(price_table.name, 'update', updates)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            errors.append({'index': None, 'id': None, 'error': 'batch not written: {}'.format(e.__class__.__name__)})
+            accepted = []
+        else:
+            notify_write(price_table.name, 'update', updates, version)
+
+    return {
+        'mode': mode,
+        'updated': len(accepted),
+        'rejected': len(patches) - len(accepted),
+        'errors': errors
+    }
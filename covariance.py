@@ -0,0 +1,186 @@
+from collections import OrderedDict
+import os, threading
+import numpy as np
+from analytics import TRADING_DAYS, load_series_matrix, simple_returns, to_float
+from instrumentation import metric_collectors, prefixed
+from models import AssetPriceHistory, Portfolio, db, format_date, table_versions
+from price_cube import price_cube
+
+COVARIANCE_CACHE_SIZE = int(os.environ.get('COVARIANCE_CACHE_SIZE', 64))
+COVARIANCE_CACHE_MAX_BYTES = int(os.environ.get('COVARIANCE_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+# the matrices grow with the square of the number of series
+MAX_COVARIANCE_SERIES = int(os.environ.get('MAX_COVARIANCE_SERIES', 500))
+
+
+def ledoit_wolf(centred, covariance):
+    """Ledoit-Wolf shrinkage of the maximum likelihood `covariance` of the
+    `centred` returns (dates x series) towards a multiple of the identity.
+    Returns (shrunk covariance, shrinkage intensity). Only needs the squared
+    norms of the observations on top of the covariance, O(n*T)."""
+    observations, size = centred.shape
+    mu = np.trace(covariance) / size
+    # ||S - mu I||^2 and the mean squared distance of x x' to S, both / size
+    delta = ((covariance ** 2).sum() - 2.0 * mu * np.trace(covariance) + size * mu ** 2) / size
+    norms = (centred ** 2).sum(axis=1)
+    beta = ((norms ** 2).sum() / observations - (covariance ** 2).sum()) / (observations * size)
+    shrinkage = min(beta, delta) / delta if delta > 0 else 0.0
+    shrunk = (1.0 - shrinkage) * covariance
+    shrunk.flat[::size + 1] += shrinkage * mu
+    return shrunk, shrinkage
+
+
+def correlation(covariance):
+    deviations = np.sqrt(np.diag(covariance))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = covariance / np.outer(deviations, deviations)
+    np.clip(result, -1.0, 1.0, out=result)
+    result.flat[::len(result) + 1] = np.where(deviations > 0, 1.0, np.nan)
+    return result
+
+
+def covariance_estimates(returns, periods_per_year=TRADING_DAYS):
+    """Sample and Ledoit-Wolf covariance and correlation matrices of the
+    columns of `returns` (dates x series, no NaN). The cross products come
+    from a single matrix product of the centred returns. Covariances are
+    annualized with `periods_per_year`."""
+    observations = len(returns)
+    centred = returns - returns.mean(axis=0)
+    products = centred.T @ centred
+    sample = products / (observations - 1)
+    shrunk, shrinkage = ledoit_wolf(centred, products / observations)
+    return {
+        'shrinkage': to_float(shrinkage),
+        'sample': {'covariance': sample * periods_per_year, 'correlation': correlation(sample)},
+        'ledoit_wolf': {'covariance': shrunk * periods_per_year, 'correlation': correlation(shrunk)}
+    }
+
+
+def select_series(portfolio_ids=None, series=None, asset_type=None, start=None, end=None):
+    """Loads the aligned prices of the series of the portfolios (or exactly
+    the (portfolio id, asset type) pairs in `series`), of `asset_type` only
+    when it is set. Returns (keys, dates, prices) from the first date where
+    every series has a price, None when there is nothing or a requested
+    series doesn't exist. Raises ValueError when more than
+    MAX_COVARIANCE_SERIES series match."""
+    if series is not None:
+        portfolio_ids = {portfolio_id for portfolio_id, _ in series}
+    elif portfolio_ids is None:
+        portfolio_ids = [portfolio_id for portfolio_id, in db.session.query(Portfolio.id)]
+    loaded = load_series_matrix(sorted(portfolio_ids), start, end)
+    if loaded is None:
+        return None
+
+    column_portfolios, column_types, dates, matrix = loaded
+    keys = list(zip(column_portfolios.tolist(), column_types.tolist()))
+    wanted = set(series) if series is not None else None
+    columns = [column for column, key in enumerate(keys)
+               if (wanted is None or key in wanted) and (asset_type is None or key[1] == asset_type)]
+    if not columns or (wanted is not None and len(columns) < len(wanted)):
+        return None
+    if len(columns) > MAX_COVARIANCE_SERIES:
+        raise ValueError('{} series, at most {} are allowed'.format(len(columns), MAX_COVARIANCE_SERIES))
+
+    prices = matrix[:, columns]
+    complete = np.flatnonzero(~np.isnan(prices).any(axis=1))
+    if len(complete) == 0:
+        return None
+    return [keys[column] for column in columns], dates[complete[0]:], prices[complete[0]:]
+
+
+def compute_covariance(portfolio_ids=None, series=None, asset_type=None, start=None, end=None,
+                       periods_per_year=TRADING_DAYS):
+    selected = select_series(portfolio_ids, series, asset_type, start, end)
+    if selected is None or len(selected[1]) < 3:
+        return None
+
+    keys, dates, prices = selected
+    return {
+        'start': format_date(dates[0].item()),
+        'end': format_date(dates[-1].item()),
+        'observations': len(dates) - 1,
+        'series': [{'portfolio_id': portfolio_id, 'asset_type': name} for portfolio_id, name in keys],
+        **covariance_estimates(simple_returns(prices), periods_per_year)
+    }
+
+
+def data_versions():
+    """The shared write versions of the price and portfolio tables and, when
+    the prices are read from the cube, its version counter."""
+    versions = table_versions(AssetPriceHistory.__tablename__, Portfolio.__tablename__)
+    if price_cube.enabled:
+        versions += (price_cube.shared_version(),)
+    return versions
+
+
+def payload_bytes(payload):
+    if payload is None:
+        return 0
+    return sum(matrix.nbytes for name in ('sample', 'ledoit_wolf') for matrix in payload[name].values())
+
+
+class CovarianceCache:
+    """Bounded LRU of covariance results, keyed by the date window, the
+    series selection and `version()`, the shared versions of the data by
+    default. A write of any process moves readers on to a new key, the old
+    entries age out.
+    The cached arrays are shared by every response and must not be changed.
+    """
+
+    def __init__(self, maxsize=COVARIANCE_CACHE_SIZE, max_bytes=COVARIANCE_CACHE_MAX_BYTES,
+                 compute=compute_covariance, version=data_versions):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.compute = compute
+        self.version = version
+        self.entries = OrderedDict()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def get(self, portfolio_ids=None, series=None, asset_type=None, start=None, end=None,
+            periods_per_year=TRADING_DAYS):
+        versions = self.version()
+        key = (frozenset(portfolio_ids) if portfolio_ids is not None else None,
+               frozenset(series) if series is not None else None,
+               asset_type, start, end, periods_per_year, versions)
+        with self._lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+
+        payload = self.compute(portfolio_ids, series, asset_type, start, end, periods_per_year)
+        size = payload_bytes(payload)
+        if self.maxsize < 1 or size > self.max_bytes:
+            return payload
+
+        with self._lock:
+            self.size_bytes -= payload_bytes(self.entries.pop(key, None))
+            self.entries[key] = payload
+            self.size_bytes += size
+            while len(self.entries) > self.maxsize or self.size_bytes > self.max_bytes:
+                _, old = self.entries.popitem(last=False)
+                self.size_bytes -= payload_bytes(old)
+                self.evictions += 1
+        return payload
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            self.size_bytes = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self.entries),
+            'bytes': self.size_bytes
+        }
+
+
+covariance_cache = CovarianceCache()
+metric_collectors.append(lambda: prefixed('covariance_cache', covariance_cache.stats()))
@@ -0,0 +1,248 @@
+import math, os, threading, time
+from flask import request
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import create_engine, event, orm, text
+from sqlalchemy.pool import NullPool
+from instrumentation import metric_collectors, prefixed
+
+# QueuePool sizing, ignored for SQLite (FSA uses a static or null pool there)
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', '1').lower() in ('1', 'true')
+# per statement limit in milliseconds, 0 disables it
+DB_STATEMENT_TIMEOUT_MS = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 0))
+
+# GET requests read from this database when it is set
+REPLICA_DATABASE_URL = os.environ.get('REPLICA_DATABASE_URL')
+# seconds of replication lag tolerated, and for how long after a write of
+# this process reads stay on the primary
+REPLICA_MAX_LAG = float(os.environ.get('REPLICA_MAX_LAG', 5))
+REPLICA_CHECK_INTERVAL = float(os.environ.get('REPLICA_CHECK_INTERVAL', 1))
+
+READ_METHODS = ('GET', 'HEAD')
+
+# seconds the replica is behind, 0 when it is caught up or not a standby
+LAG_QUERIES = {
+    'postgresql': """
+        SELECT CASE
+            WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+            ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+        END
+    """
+}
+
+
+def engine_options(url, statement_timeout=DB_STATEMENT_TIMEOUT_MS):
+    """create_engine() keyword arguments for `url` from the DB_* settings."""
+    if url.startswith('sqlite'):
+        # recycling the connection would drop an in-memory database
+        return {}
+    options = {
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE,
+        'pool_pre_ping': DB_POOL_PRE_PING
+    }
+    if statement_timeout and url.startswith('postgresql'):
+        options['connect_args'] = {'options': '-c statement_timeout={}'.format(statement_timeout)}
+    return options
+
+
+def sqlite_statement_timeout(engine, milliseconds):
+    """Interrupts SQLite statements that run longer than `milliseconds` until
+    their first row, through the progress handler."""
+
+    @event.listens_for(engine, 'connect')
+    def install_handler(dbapi_connection, connection_record):
+        deadline = connection_record.info['statement_deadline'] = [math.inf]
+        dbapi_connection.set_progress_handler(lambda: time.monotonic() > deadline[0], 1000)
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def start_deadline(conn, cursor, statement, parameters, context, executemany):
+        deadline = conn.connection.info.get('statement_deadline')
+        if deadline is not None:
+            deadline[0] = time.monotonic() + milliseconds / 1000.0
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def clear_deadline(conn, cursor, statement, parameters, context, executemany):
+        deadline = conn.connection.info.get('statement_deadline')
+        if deadline is not None:
+            deadline[0] = math.inf
+
+
+class PoolCounters:
+    """Checkouts and new connections of an engine's pool."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.checkouts = 0
+        self.connects = 0
+        event.listen(engine, 'checkout', self.on_checkout)
+        event.listen(engine, 'connect', self.on_connect)
+
+    def on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        self.checkouts += 1
+
+    def on_connect(self, dbapi_connection, connection_record):
+        self.connects += 1
+
+    def stats(self):
+        pool = self.engine.pool
+        stats = {'checkouts': self.checkouts, 'connects': self.connects}
+        for name in ('size', 'checkedin', 'checkedout', 'overflow'):
+            if hasattr(pool, name):
+                stats[name] = getattr(pool, name)()
+        if 'size' in stats and 'checkedout' in stats and hasattr(pool, '_max_overflow'):
+            capacity = stats['size'] + max(pool._max_overflow, 0)
+            stats['utilization'] = round(stats['checkedout'] / capacity, 4) if capacity else 0.0
+        return stats
+
+
+class ReplicaRouter:
+    """Decides, once per request, whether the session reads from the replica.
+
+    Only GET and HEAD requests go to the replica, and only while its lag
+    (checked at most every `check_interval` seconds) is within `max_lag` and
+    this process hasn't written anything in the last `max_lag` seconds, so a
+    client reading its own write doesn't get a stale answer. Everything else,
+    including flushes during a read request, stays on the primary.
+    """
+
+    def __init__(self, max_lag=REPLICA_MAX_LAG, check_interval=REPLICA_CHECK_INTERVAL):
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.primary = None
+        self.replica = None
+        self.pools = {}
+        self.lag = None
+        self.checked_at = -math.inf
+        self.last_write = -math.inf
+        self.replica_reads = 0
+        self.primary_reads = 0
+        self.lag_fallbacks = 0
+        self.write_fallbacks = 0
+        self.lag_check_failures = 0
+        self._local = threading.local()
+        self._check_lock = threading.Lock()
+
+    def check_lag(self):
+        """Refreshes the replica lag, None when the replica can't be reached.
+        Concurrent callers keep using the previous value."""
+        if not self._check_lock.acquire(blocking=False):
+            return
+        try:
+            query = LAG_QUERIES.get(self.replica.dialect.name, 'SELECT 0')
+            with self.replica.connect() as connection:
+                self.lag = float(connection.execute(text(query)).scalar() or 0.0)
+        except Exception:
+            self.lag = None
+            self.lag_check_failures += 1
+        finally:
+            self.checked_at = time.monotonic()
+            self._check_lock.release()
+
+    def route(self, method):
+        """Picks the engine for the current request's reads."""
+        self._local.engine = None
+        if self.replica is None or method not in READ_METHODS:
+            return
+        now = time.monotonic()
+        if now - self.last_write < self.max_lag:
+            self.write_fallbacks += 1
+            self.primary_reads += 1
+            return
+        if now - self.checked_at >= self.check_interval:
+            self.check_lag()
+        if self.lag is None or self.lag > self.max_lag:
+            self.lag_fallbacks += 1
+            self.primary_reads += 1
+            return
+        self.replica_reads += 1
+        self._local.engine = self.replica
+
+    def read_engine(self):
+        return getattr(self._local, 'engine', None)
+
+    def clear(self):
+        self._local.engine = None
+
+    def on_write(self, table_name, action, changes, version=None):
+        self.last_write = time.monotonic()
+
+    def stats(self):
+        return {
+            'replica_reads': self.replica_reads,
+            'primary_reads': self.primary_reads,
+            'lag_fallbacks': self.lag_fallbacks,
+            'write_fallbacks': self.write_fallbacks,
+            'lag_check_failures': self.lag_check_failures,
+            'replica_lag_seconds': self.lag if self.lag is not None else -1
+        }
+
+
+router = ReplicaRouter()
+
+
+def pool_metrics():
+    gauges = prefixed('db_routing', router.stats()) if router.replica is not None else {}
+    for name, counters in router.pools.items():
+        gauges.update(prefixed('db_pool_' + name, counters.stats()))
+    return gauges
+
+
+metric_collectors.append(pool_metrics)
+
+
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is not None:
+            return bind
+        engine = router.read_engine()
+        if engine is not None and not self._flushing:
+            return engine
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """flask_sqlalchemy.SQLAlchemy whose sessions are routed by `router`."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        if sa_url.drivername == 'sqlite' and sa_url.database and os.path.isabs(sa_url.database):
+            # the stock hack rewrites the file path in place, which the immutable
+            # URL of SQLAlchemy 1.4 refuses; absolute paths need no rewriting
+            if not options.get('pool_size'):
+                options['poolclass'] = NullPool
+            return
+        super().apply_driver_hacks(app, sa_url, options)
+
+
+def init_routing(app, primary, replica_url=None, statement_timeout=DB_STATEMENT_TIMEOUT_MS):
+    """Sets up the primary engine's statement timeout and pool metrics and,
+    with `replica_url`, the replica engine and the per request routing."""
+    router.primary = primary
+    router.pools['primary'] = PoolCounters(primary)
+    if statement_timeout and primary.dialect.name == 'sqlite':
+        sqlite_statement_timeout(primary, statement_timeout)
+
+    if not replica_url:
+        return
+    if replica_url.startswith('postgres://'):
+        replica_url = replica_url.replace('postgres://', 'postgresql://', 1)
+    router.replica = create_engine(replica_url, **engine_options(replica_url, statement_timeout))
+    router.pools['replica'] = PoolCounters(router.replica)
+    if statement_timeout and router.replica.dialect.name == 'sqlite':
+        sqlite_statement_timeout(router.replica, statement_timeout)
+
+    @app.before_request
+    def route_request():
+        router.route(request.method)
+
+    @app.teardown_request
+    def clear_route(error):
+        router.clear()
@@ -0,0 +1,69 @@
+import csv, io, json, zlib
+from sqlalchemy import select
+from models import DATE_OUTPUT_FORMAT, AssetPriceHistory, db
+
+EXPORT_CHUNK_SIZE = 5000
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv'
+}
+
+price_table = AssetPriceHistory.__table__
+EXPORT_COLUMNS = tuple(column.name for column in price_table.columns)
+
+
+def iter_price_rows(filters=(), chunk_size=EXPORT_CHUNK_SIZE):
+    """Yields lists of row tuples read through a server-side cursor, so at most
+    `chunk_size` rows are held in memory at any time. Dates are already
+    formatted as strings."""
+    columns = [price_table.c[name] for name in EXPORT_COLUMNS]
+    date_index = EXPORT_COLUMNS.index('date')
+    statement = select(*columns) \
+        .where(*filters) \
+        .order_by(price_table.c.id)
+    result = db.session.execute(statement, execution_options={'stream_results': True})
+    try:
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield [row[:date_index] + (row[date_index].strftime(DATE_OUTPUT_FORMAT),) + row[date_index + 1:]
+                   for row in rows]
+    finally:
+        result.close()
+
+
+def ndjson_chunks(row_chunks):
+    dumps = json.dumps
+    for rows in row_chunks:
+        yield ''.join([dumps(dict(zip(EXPORT_COLUMNS, row))) + '\n' for row in rows]).encode('utf-8')
+
+
+def csv_chunks(row_chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for rows in row_chunks:
+        writer.writerows(rows)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_price_rows(export_format, filters=(), gzip=False, chunk_size=EXPORT_CHUNK_SIZE):
+    encode = ndjson_chunks if export_format == 'ndjson' else csv_chunks
+    chunks = encode(iter_price_rows(filters, chunk_size))
+    if gzip:
+        chunks = gzip_chunks(chunks)
+    return chunks
@@ -0,0 +1,158 @@
+import csv, io, json, math
+from itertools import islice
+from models import AssetPriceHistory, Portfolio, bump_versions, db, log_write, notify_write, parse_date
+
+INGEST_CHUNK_SIZE = 5000
+# only the first errors of every chunk are reported back
+MAX_ERRORS_PER_CHUNK = 50
+INGEST_FORMATS = ('ndjson', 'csv')
+INGEST_COLUMNS = ('asset_type', 'price', 'date', 'portfolio_id')
+# portfolios.id is a 32-bit integer column, larger ids fail the lookup on PostgreSQL
+MAX_PORTFOLIO_ID = 2 ** 31 - 1
+
+price_table = AssetPriceHistory.__table__
+
+
+def parse_ndjson(lines):
+    """Yields (line number, record) pairs, the record is None when the line
+    isn't a JSON object."""
+    for line_number, line in enumerate(lines, start=1):
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        yield line_number, record if isinstance(record, dict) else None
+
+
+def parse_csv(lines):
+    """Yields (line number, record) pairs, the first line must be a header."""
+    decoded = (line.decode('utf-8') if isinstance(line, bytes) else line for line in lines)
+    reader = csv.DictReader(decoded)
+    for record in reader:
+        yield reader.line_num, record
+
+
+def validate_record(record):
+    """Returns the row to insert, raises ValueError when the record can't be
+    stored."""
+    if record is None:
+        raise ValueError('malformed record')
+
+    missing = [name for name in INGEST_COLUMNS if record.get(name) in (None, '')]
+    if missing:
+        raise ValueError('missing fields: ' + ', '.join(missing))
+
+    try:
+        price = float(record['price'])
+        portfolio_id = int(record['portfolio_id'])
+    except (TypeError, ValueError):
+        raise ValueError('price and portfolio_id must be numbers')
+    if not math.isfinite(price):
+        raise ValueError('price must be finite')
+    if not 0 < portfolio_id <= MAX_PORTFOLIO_ID:
+        raise ValueError('portfolio_id out of range')
+
+    return {
+        'asset_type': str(record['asset_type']),
+        'price': price,
+        'date': parse_date(record['date']),
+        'portfolio_id': portfolio_id
+    }
+
+
+def copy_rows(rows):
+    """Writes the rows with COPY FROM STDIN on the session's connection."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([row[name] for name in INGEST_COLUMNS])
+    buffer.seek(0)
+
+    cursor = db.session.connection().connection.cursor()
+    try:
+        cursor.copy_expert(
+            'COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(price_table.name, ', '.join(INGEST_COLUMNS)),
+            buffer)
+    finally:
+        cursor.close()
+
+
+def write_rows(rows):
+    """Inserts the rows in a single round trip, the caller commits."""
+    if not rows:
+        return
+    if db.session.connection().dialect.name == 'postgresql':
+        copy_rows(rows)
+    else:
+        db.session.execute(price_table.insert(), rows)
+
+
+def ingest_chunk(records):
+    """Validates and writes one chunk of (line number, record) pairs in its own
+    transaction."""
+    rows = []
+    errors = []
+    for line_number, record in records:
+        try:
+            rows.append((line_number, validate_record(record)))
+        except ValueError as e:
+            errors.append({'line': line_number, 'error': str(e)})
+
+    try:
+        portfolio_ids = {row['portfolio_id'] for _, row in rows}
+        known_ids = {portfolio_id for portfolio_id, in db.session.query(Portfolio.id)
+                     .filter(Portfolio.id.in_(portfolio_ids))} if portfolio_ids else set()
+        for line_number, row in rows:
+            if row['portfolio_id'] not in known_ids:
+                errors.append({'line': line_number, 'error': 'unknown portfolio_id {}'.format(row['portfolio_id'])})
+        rows = [row for _, row in rows if row['portfolio_id'] in known_ids]
+
+        write_rows(rows)
+        version = None
+        if rows:
+            version = bump_versions(price_table.name)[price_table.name]
+            log_write(price_table.name, 'insert', rows)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        errors.append({'line': None, 'error': 'chunk not written: {}'.format(e.__class__.__name__)})
+        rows = []
+    else:
+        if rows:
+            notify_write(price_table.name, 'insert', rows, version)
+
+    errors.sort(key=lambda error: error['line'] or 0)
+    return {
+        'accepted': len(rows),
+        'rejected': len(records) - len(rows),
+        'errors': errors[:MAX_ERRORS_PER_CHUNK]
+    }
+
+
+def ingest_records(records, chunk_size=INGEST_CHUNK_SIZE):
+    """Ingests an iterable of (line number, record) pairs chunk by chunk and
+    returns the per-chunk accept/reject counts."""
+    records = iter(records)
+    chunks = []
+    while True:
+        chunk = list(islice(records, chunk_size))
+        if not chunk:
+            break
+        result = ingest_chunk(chunk)
+        result['chunk'] = len(chunks)
+        chunks.append(result)
+
+    return {
+        'accepted': sum(chunk['accepted'] for chunk in chunks),
+        'rejected': sum(chunk['rejected'] for chunk in chunks),
+        'chunks': chunks
+    }
+
+
+def ingest_lines(lines, ingest_format, chunk_size=INGEST_CHUNK_SIZE):
+    parse = parse_ndjson if ingest_format == 'ndjson' else parse_csv
+    return ingest_records(parse(lines), chunk_size)
@@ -0,0 +1,345 @@
+from collections import deque
+import atexit, fcntl, glob, json, os, threading, time, uuid
+from ingest import ingest_chunk, validate_record
+from instrumentation import metric_collectors, prefixed
+
+# ticks buffered per process before POST /asset_price_histories/queue answers 429
+INGEST_QUEUE_SIZE = int(os.environ.get('INGEST_QUEUE_SIZE', 100000))
+# the writer flushes when this many ticks are waiting ...
+INGEST_FLUSH_SIZE = int(os.environ.get('INGEST_FLUSH_SIZE', 1000))
+# ... or when the oldest one has waited this many seconds
+INGEST_FLUSH_INTERVAL = float(os.environ.get('INGEST_FLUSH_INTERVAL', 0.5))
+INGEST_SPOOL_DIR = os.environ.get('INGEST_SPOOL_DIR', 'spool')
+# fsync the spool before acknowledging, turning it off trades durability on
+# power loss (not on process crash) for throughput
+INGEST_SPOOL_FSYNC = os.environ.get('INGEST_SPOOL_FSYNC', '1').lower() in ('1', 'true')
+# a batch failing as a whole this many times in a row is split in half, a
+# single tick failing that often is moved to the dead-letter file
+INGEST_MAX_ATTEMPTS = int(os.environ.get('INGEST_MAX_ATTEMPTS', 5))
+
+SPOOL_PATTERN = 'ingest-*.ndjson'
+DEAD_LETTER_FILE = 'dead-letter.ndjson'
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Spool:
+    """Append-only NDJSON log of the accepted ticks, plus "flushed" markers
+    recording how far the writer got. The file is flock'ed by its process,
+    so spools left behind by a dead process can be told apart and replayed.
+    """
+
+    def __init__(self, directory, fsync=INGEST_SPOOL_FSYNC):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.fsync = fsync
+        self.path = os.path.join(directory, 'ingest-{}-{}.ndjson'.format(os.getpid(), uuid.uuid4().hex[:8]))
+        self.file = self._open_locked(self.path)
+        self.appended = 0
+
+    @staticmethod
+    def _open_locked(path):
+        spool = open(path, 'a', encoding='utf-8')
+        fcntl.flock(spool, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return spool
+
+    def append(self, lines):
+        self.file.write(''.join(json.dumps(line, separators=(',', ':')) + '\n' for line in lines))
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+        self.appended += len(lines)
+
+    def mark_flushed(self, sequence):
+        self.append([{'flushed': sequence}])
+
+    def rewrite(self, ticks):
+        """Replaces the spool with the still pending `ticks`, through a locked
+        temporary file renamed over it. The old file stays locked until the
+        rename is done, a process that opened it before only gets the lock
+        once the path leads elsewhere, which `orphans()` checks for."""
+        temporary = self.path + '.tmp'
+        spool = self._open_locked(temporary)
+        spool.write(''.join(json.dumps(tick, separators=(',', ':')) + '\n' for tick in ticks))
+        spool.flush()
+        os.fsync(spool.fileno())
+        os.replace(temporary, self.path)
+        directory = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        self.file.close()
+        self.file = spool
+        self.appended = len(ticks)
+
+    def close(self):
+        self.file.close()
+        os.remove(self.path)
+
+    def orphans(self):
+        """Yields (path, locked file) for every spool no live process holds.
+        A file that was renamed over (the owner rewrote it) or removed while
+        waiting for its lock is skipped, it is no longer the spool."""
+        for path in sorted(glob.glob(os.path.join(self.directory, SPOOL_PATTERN))):
+            if path == self.path:
+                continue
+            try:
+                orphan = open(path, 'r+', encoding='utf-8')
+            except FileNotFoundError:
+                continue
+            try:
+                fcntl.flock(orphan, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                orphan.close()
+                continue
+            try:
+                replaced = os.stat(path).st_ino != os.fstat(orphan.fileno()).st_ino
+            except FileNotFoundError:
+                replaced = True
+            if replaced:
+                orphan.close()
+                continue
+            yield path, orphan
+
+    def dead_letter(self, ticks):
+        """Appends ticks that could not be written to the dead-letter file,
+        which is left for an operator to inspect and resubmit."""
+        with open(os.path.join(self.directory, DEAD_LETTER_FILE), 'a', encoding='utf-8') as f:
+            f.write(''.join(json.dumps(tick, separators=(',', ':')) + '\n' for tick in ticks))
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def pending_ticks(lines):
+    """The ticks of a spool that were never marked as flushed, a torn last
+    line (crash mid-write) is skipped."""
+    ticks = []
+    flushed = 0
+    for line in lines:
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            continue
+        if 'flushed' in entry:
+            flushed = max(flushed, entry['flushed'])
+        else:
+            ticks.append(entry)
+    return [tick for tick in ticks if tick['sequence'] > flushed]
+
+
+class IngestQueue:
+    """Bounded in-process buffer of price ticks with a background writer.
+
+    `submit()` validates the ticks, appends them to the spool and returns
+    their sequence numbers. The writer thread drains the buffer in batches
+    of `flush_size`, or earlier once the oldest tick waited `flush_interval`
+    seconds, through the same chunked insert as the bulk endpoint. Ticks are
+    written at least once: after a crash the spool is replayed from the last
+    "flushed" marker.
+
+    A batch that fails as a whole `max_attempts` times in a row is halved,
+    down to a single tick which is then moved to the dead-letter file, so a
+    tick the database refuses can't hold up the ones behind it. Every
+    successful flush doubles the batch back towards `flush_size`.
+    """
+
+    def __init__(self, maxsize=INGEST_QUEUE_SIZE, flush_size=INGEST_FLUSH_SIZE,
+                 flush_interval=INGEST_FLUSH_INTERVAL, spool_dir=INGEST_SPOOL_DIR,
+                 max_attempts=INGEST_MAX_ATTEMPTS):
+        self.maxsize = maxsize
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.spool_dir = spool_dir
+        self.max_attempts = max_attempts
+        self.batch_size = flush_size
+        self.attempts = 0
+        self.app = None
+        self.spool = None
+        self.buffer = deque()
+        self.sequence = 0
+        self.flushed_sequence = 0
+        self.submitted = 0
+        self.written = 0
+        self.rejected = 0
+        self.flushes = 0
+        self.flush_failures = 0
+        self.dead_lettered = 0
+        self.flush_seconds_total = 0.0
+        self.last_flush_seconds = 0.0
+        self.last_lag_seconds = 0.0
+        self.last_errors = []
+        self._thread = None
+        self._stopping = False
+        self._condition = threading.Condition()
+
+    def init_app(self, app):
+        self.app = app
+        if glob.glob(os.path.join(self.spool_dir, SPOOL_PATTERN)):
+            self.start()
+
+    def start(self):
+        """Opens the spool, takes over the spools of dead processes and starts
+        the writer. Called on the first submit."""
+        with self._condition:
+            if self._thread is not None:
+                return
+            self.spool = Spool(self.spool_dir)
+            for path, orphan in self.spool.orphans():
+                self._enqueue([dict(tick, sequence=None) for tick in pending_ticks(orphan)])
+                os.remove(path)
+                orphan.close()
+            self._thread = threading.Thread(target=self._run, name='ingest-writer', daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def _enqueue(self, ticks):
+        now = time.monotonic()
+        for tick in ticks:
+            self.sequence += 1
+            tick['sequence'] = self.sequence
+        self.spool.append(ticks)
+        self.buffer.extend((tick, now) for tick in ticks)
+        self.submitted += len(ticks)
+        self._condition.notify()
+
+    def submit(self, records):
+        """Validates and enqueues the records, returns the first and last
+        sequence number. Raises ValueError (with the index of the bad
+        record) before enqueuing anything, QueueFull when there's no room for
+        all of them."""
+        ticks = []
+        for index, record in enumerate(records):
+            try:
+                row = validate_record(record if isinstance(record, dict) else None)
+            except ValueError as e:
+                raise ValueError('record {}: {}'.format(index, e))
+            ticks.append(dict(row, date=row['date'].isoformat()))
+
+        if self._thread is None:
+            self.start()
+        with self._condition:
+            if len(self.buffer) + len(ticks) > self.maxsize:
+                raise QueueFull()
+            self._enqueue(ticks)
+            return self.sequence - len(ticks) + 1, self.sequence
+
+    def _next_batch(self):
+        with self._condition:
+            while True:
+                if self.buffer:
+                    waited = time.monotonic() - self.buffer[0][1]
+                    if len(self.buffer) >= self.flush_size or waited >= self.flush_interval or self._stopping:
+                        break
+                    self._condition.wait(self.flush_interval - waited)
+                elif self._stopping:
+                    return None
+                else:
+                    self._condition.wait()
+            # the ticks stay in the buffer (and count against maxsize) until written
+            return [self.buffer[index] for index in range(min(self.batch_size, len(self.buffer)))]
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            if not self.flush(batch):
+                if self._stopping:
+                    # left in the spool for the next start
+                    return
+                time.sleep(self.flush_interval)
+
+    def flush(self, batch):
+        """Writes a batch from the head of the buffer. Returns False, leaving
+        the batch queued for a retry, when the chunk could not be written."""
+        started = time.monotonic()
+        try:
+            with self.app.app_context():
+                result = ingest_chunk([(tick['sequence'], tick) for tick, _ in batch])
+        except Exception:
+            result = None
+        finished = time.monotonic()
+
+        with self._condition:
+            if result is None or any(error['line'] is None for error in result['errors']):
+                self.flush_failures += 1
+                self.attempts += 1
+                if self.attempts < self.max_attempts:
+                    return False
+                self.attempts = 0
+                if len(batch) > 1:
+                    self.batch_size = len(batch) // 2
+                    return False
+                self._dead_letter(batch[0][0])
+                return True
+            self.attempts = 0
+            self.batch_size = min(self.flush_size, 2 * self.batch_size)
+            for _ in batch:
+                self.buffer.popleft()
+            self.flushed_sequence = batch[-1][0]['sequence']
+            self.written += result['accepted']
+            self.rejected += result['rejected']
+            self.flushes += 1
+            self.last_flush_seconds = finished - started
+            self.flush_seconds_total += self.last_flush_seconds
+            self.last_lag_seconds = finished - batch[0][1]
+            if result['errors']:
+                self.last_errors = [{'sequence': error['line'], 'error': error['error']}
+                                    for error in result['errors']]
+            self.spool.mark_flushed(self.flushed_sequence)
+            self._compact_spool()
+            return True
+
+    def _dead_letter(self, tick):
+        self.spool.dead_letter([tick])
+        self.buffer.popleft()
+        self.flushed_sequence = tick['sequence']
+        self.dead_lettered += 1
+        self.last_errors = [{'sequence': tick['sequence'], 'error': 'moved to {}'.format(DEAD_LETTER_FILE)}]
+        self.spool.mark_flushed(self.flushed_sequence)
+        self._compact_spool()
+
+    def _compact_spool(self):
+        # keep the spool about as small as the buffer
+        if self.spool.appended > 2 * self.maxsize:
+            self.spool.rewrite([tick for tick, _ in self.buffer])
+
+    def stop(self):
+        """Flushes what's left and stops the writer, the spool is removed once
+        it holds nothing pending."""
+        with self._condition:
+            if self._thread is None:
+                return
+            self._stopping = True
+            self._condition.notify()
+        self._thread.join()
+        with self._condition:
+            if not self.buffer:
+                self.spool.close()
+            self._thread = None
+            self._stopping = False
+
+    def stats(self):
+        with self._condition:
+            return {
+                'depth': len(self.buffer),
+                'capacity': self.maxsize,
+                'last_sequence': self.sequence,
+                'flushed_sequence': self.flushed_sequence,
+                'submitted': self.submitted,
+                'written': self.written,
+                'rejected': self.rejected,
+                'flushes': self.flushes,
+                'flush_failures': self.flush_failures,
+                'dead_lettered': self.dead_lettered,
+                'flush_seconds_total': round(self.flush_seconds_total, 6),
+                'last_flush_seconds': round(self.last_flush_seconds, 6),
+                'last_lag_seconds': round(self.last_lag_seconds, 6)
+            }
+
+
+ingest_queue = IngestQueue()
+metric_collectors.append(lambda: prefixed('ingest_queue', ingest_queue.stats()))
@@ -0,0 +1,298 @@
+from contextlib import nullcontext
+import cProfile, os, random, threading, time, uuid
+from flask import Response, abort, request
+
+# per request phase timings and SQL counters, Server-Timing header and /metrics histograms
+INSTRUMENTATION = os.environ.get('INSTRUMENTATION', '0').lower() in ('1', 'true')
+# fraction of requests run under cProfile, the dumps land in PROFILE_DIR
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+# when set, /metrics requires "Authorization: Bearer <METRICS_TOKEN>"
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PHASES = ('auth', 'jwks', 'db', 'serialize', 'view')
+
+"""
+metric_collectors
+    callables returning a {name: value} dict of gauges, exported on /metrics
+    as `<name>` (names should carry their subsystem prefix, e.g.
+    "jwks_cache_hits").
+"""
+
+metric_collectors = []
+
+_local = threading.local()
+_null_phase = nullcontext()
+
+
+class RequestTimings:
+    __slots__ = ('started', 'phases', 'statements', 'rows', 'instances', 'profiler')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.statements = 0
+        self.rows = 0
+        self.instances = 0
+        self.profiler = None
+
+
+class Phase:
+    __slots__ = ('timings', 'name', 'start')
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.timings.phases[self.name] += time.perf_counter() - self.start
+
+
+def set_timings(timings):
+    """Makes `timings` the current request's, for requests the before_request
+    hook doesn't see (the async handlers of asgi.py). The after_request hook
+    clears it."""
+    _local.timings = timings
+
+
+def prefixed(prefix, stats):
+    """Turns a stats() dict into metric_collectors gauges."""
+    return {'{}_{}'.format(prefix, name): value for name, value in stats.items()}
+
+
+def phase(name):
+    """Context manager adding the time spent in the block to the current
+    request's `name` phase. A shared no-op outside instrumented requests."""
+    timings = getattr(_local, 'timings', None)
+    if timings is None:
+        return _null_phase
+    return Phase(timings, name)
+
+
+class Metrics:
+    """Aggregated request metrics, per endpoint."""
+
+    def __init__(self):
+        self.requests = {}
+        self.latency = {}
+        self.phases = {}
+        self.statements = {}
+        self.rows = {}
+        self.instances = {}
+        self._lock = threading.Lock()
+
+    def observe(self, endpoint, method, status, duration, timings):
+        with self._lock:
+            key = (endpoint, method, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+            buckets, total, count = self.latency.get(endpoint, ([0] * len(LATENCY_BUCKETS), 0.0, 0))
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if duration <= bound:
+                    buckets[index] += 1
+            self.latency[endpoint] = (buckets, total + duration, count + 1)
+
+            for name, seconds in timings.phases.items():
+                self.phases[endpoint, name] = self.phases.get((endpoint, name), 0.0) + seconds
+            self.statements[endpoint] = self.statements.get(endpoint, 0) + timings.statements
+            self.rows[endpoint] = self.rows.get(endpoint, 0) + timings.rows
+            self.instances[endpoint] = self.instances.get(endpoint, 0) + timings.instances
+
+    def render(self):
+        """Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            lines += ['# HELP http_requests_total Requests served.', '# TYPE http_requests_total counter']
+            for (endpoint, method, status), count in sorted(self.requests.items()):
+                lines.append('http_requests_total{{endpoint="{}",method="{}",status="{}"}} {}'.format(
+                    endpoint, method, status, count))
+
+            lines += ['# HELP http_request_duration_seconds Request latency.',
+                      '# TYPE http_request_duration_seconds histogram']
+            for endpoint, (buckets, total, count) in sorted(self.latency.items()):
+                for bound, bucket in zip(LATENCY_BUCKETS, buckets):
+                    lines.append('http_request_duration_seconds_bucket{{endpoint="{}",le="{}"}} {}'.format(
+                        endpoint, bound, bucket))
+                lines.append('http_request_duration_seconds_bucket{{endpoint="{}",le="+Inf"}} {}'.format(endpoint, count))
+                lines.append('http_request_duration_seconds_sum{{endpoint="{}"}} {}'.format(endpoint, total))
+                lines.append('http_request_duration_seconds_count{{endpoint="{}"}} {}'.format(endpoint, count))
+
+            lines += ['# HELP http_request_phase_seconds_total Time spent per request phase.',
+                      '# TYPE http_request_phase_seconds_total counter']
+            for (endpoint, name), seconds in sorted(self.phases.items()):
+                lines.append('http_request_phase_seconds_total{{endpoint="{}",phase="{}"}} {}'.format(
+                    endpoint, name, seconds))
+
+            lines += ['# HELP db_statements_total SQL statements executed.', '# TYPE db_statements_total counter']
+            for endpoint, count in sorted(self.statements.items()):
+                lines.append('db_statements_total{{endpoint="{}"}} {}'.format(endpoint, count))
+
+            lines += ['# HELP db_rows_total Rows fetched from the database.', '# TYPE db_rows_total counter']
+            for endpoint, count in sorted(self.rows.items()):
+                lines.append('db_rows_total{{endpoint="{}"}} {}'.format(endpoint, count))
+
+            lines += ['# HELP orm_instances_total ORM instances loaded from rows.', '# TYPE orm_instances_total counter']
+            for endpoint, count in sorted(self.instances.items()):
+                lines.append('orm_instances_total{{endpoint="{}"}} {}'.format(endpoint, count))
+
+        for collector in metric_collectors:
+            for name, value in sorted(collector().items()):
+                lines.append('# TYPE {} gauge'.format(name))
+                lines.append('{} {}'.format(name, value))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+class CountingCursor:
+    """Wraps a DBAPI cursor to count the rows fetched from it and add the
+    fetch time to the db phase."""
+
+    def __init__(self, cursor, timings):
+        self._cursor = cursor
+        self._timings = timings
+
+    def _fetch(self, fetch, *args):
+        start = time.perf_counter()
+        rows = fetch(*args)
+        self._timings.phases['db'] += time.perf_counter() - start
+        return rows
+
+    def fetchone(self):
+        row = self._fetch(self._cursor.fetchone)
+        if row is not None:
+            self._timings.rows += 1
+        return row
+
+    def fetchmany(self, *args):
+        rows = self._fetch(self._cursor.fetchmany, *args)
+        self._timings.rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._fetch(self._cursor.fetchall)
+        self._timings.rows += len(rows)
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    timings = getattr(_local, 'timings', None)
+    if timings is not None:
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    timings = getattr(_local, 'timings', None)
+    started = conn.info.get('query_started')
+    if timings is not None and started:
+        timings.phases['db'] += time.perf_counter() - started.pop()
+        timings.statements += 1
+        # the result is built from context.cursor right after this event
+        if context is not None and cursor.description is not None:
+            context.cursor = CountingCursor(cursor, timings)
+
+
+def on_instance_load(target, context):
+    timings = getattr(_local, 'timings', None)
+    if timings is not None:
+        timings.instances += 1
+
+
+def timed_json_encoder(encoder):
+    class TimedJSONEncoder(encoder):
+        def encode(self, o):
+            with phase('serialize'):
+                return super().encode(o)
+    return TimedJSONEncoder
+
+
+def server_timing(timings, total):
+    entries = ['{};dur={:.2f}'.format(name, seconds * 1000) for name, seconds in timings.phases.items() if seconds]
+    entries.append('total;dur={:.2f};desc="{} queries, {} rows, {} instances"'.format(
+        total * 1000, timings.statements, timings.rows, timings.instances))
+    return ', '.join(entries)
+
+
+def start_profile(timings):
+    timings.profiler = cProfile.Profile()
+    timings.profiler.enable()
+
+
+def dump_profile(timings, endpoint):
+    timings.profiler.disable()
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    name = '{}-{}-{}.prof'.format(time.strftime('%Y%m%dT%H%M%S'), endpoint or 'unknown', uuid.uuid4().hex[:8])
+    timings.profiler.dump_stats(os.path.join(PROFILE_DIR, name))
+
+
+def init_instrumentation(app, enabled=INSTRUMENTATION, profile_sample_rate=PROFILE_SAMPLE_RATE):
+    """Registers the /metrics endpoint and, when enabled, the request hooks
+    and SQLAlchemy events. Nothing is hooked in when both instrumentation and
+    profiling are off."""
+
+    @app.route('/metrics')
+    def get_metrics():
+        if METRICS_TOKEN and request.headers.get('Authorization') != 'Bearer ' + METRICS_TOKEN:
+            abort(401)
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+    if not enabled and not profile_sample_rate:
+        return
+
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    from sqlalchemy.orm import Mapper
+
+    if enabled:
+        # the listeners are global, a second app must not count twice
+        if not event.contains(Engine, 'before_cursor_execute', before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+            event.listen(Mapper, 'load', on_instance_load)
+        app.json_encoder = timed_json_encoder(app.json_encoder)
+
+    @app.before_request
+    def start_timings():
+        timings = RequestTimings()
+        if enabled:
+            _local.timings = timings
+        else:
+            _local.profile_timings = timings
+        if profile_sample_rate and random.random() < profile_sample_rate:
+            start_profile(timings)
+
+    @app.after_request
+    def finish_timings(response):
+        timings = getattr(_local, 'timings', None) or getattr(_local, 'profile_timings', None)
+        if timings is None:
+            return response
+        _local.timings = _local.profile_timings = None
+
+        total = time.perf_counter() - timings.started
+        # labelled by view name, without the blueprint prefix
+        endpoint = (request.endpoint or 'unknown').rpartition('.')[2]
+        if timings.profiler is not None:
+            dump_profile(timings, endpoint)
+        if enabled:
+            timings.phases['view'] = max(0.0, total - sum(timings.phases.values()) + timings.phases['jwks'])
+            metrics.observe(endpoint, request.method, response.status_code, total, timings)
+            response.headers['Server-Timing'] = server_timing(timings, total)
+        return response
+
+    @app.teardown_request
+    def clear_timings(error):
+        timings = getattr(_local, 'timings', None) or getattr(_local, 'profile_timings', None)
+        if timings is not None and timings.profiler is not None:
+            timings.profiler.disable()
+        _local.timings = _local.profile_timings = None
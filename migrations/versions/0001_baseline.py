@@ -0,0 +1,44 @@
+"""baseline schema from capstone.psql
+
+Revision ID: 0001_baseline
+Revises: 
+Create Date: 2026-10-17 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0001_baseline'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'portfolios',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('asset_class_desc', sa.String(), nullable=False),
+        sa.Column('weight', sa.Float(), nullable=False),
+        sa.Column('benchmark_desc', sa.String(), nullable=False),
+        sa.Column('sort_id', sa.Integer(), nullable=False),
+        sa.Column('bloomberg_qry', sa.String(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table(
+        'asset_price_histories',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('asset_type', sa.String(), nullable=False),
+        sa.Column('price', sa.Float(), nullable=False),
+        sa.Column('date', sa.String(), nullable=False),
+        sa.Column('portfolio_id', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['portfolio_id'], ['portfolios.id']),
+        sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('asset_price_histories')
+    op.drop_table('portfolios')
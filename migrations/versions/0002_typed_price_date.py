@@ -0,0 +1,66 @@
+"""store asset price dates as DATE and index (portfolio_id, asset_type, date)
+
+Revision ID: 0002_typed_price_date
+Revises: 0001_baseline
+Create Date: 2026-10-17 09:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0002_typed_price_date'
+down_revision = '0001_baseline'
+branch_labels = None
+depends_on = None
+
+INDEX_NAME = 'ix_asset_price_histories_portfolio_asset_date'
+
+# The strings are DD-MM-YYYY, but ISO dates may have been sent through the
+# edit endpoint, so both are converted.
+BACKFILL = {
+    'postgresql': """
+        UPDATE asset_price_histories SET date_value = CASE
+            WHEN date ~ '^\\d{4}-\\d{2}-\\d{2}$' THEN date::date
+            ELSE to_date(date, 'DD-MM-YYYY')
+        END
+    """,
+    'sqlite': """
+        UPDATE asset_price_histories SET date_value = CASE
+            WHEN date GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]' THEN date
+            ELSE substr(date, 7, 4) || '-' || substr(date, 4, 2) || '-' || substr(date, 1, 2)
+        END
+    """
+}
+
+RESTORE = {
+    'postgresql': "UPDATE asset_price_histories SET date_value = to_char(date, 'DD-MM-YYYY')",
+    'sqlite': "UPDATE asset_price_histories SET date_value = strftime('%d-%m-%Y', date)"
+}
+
+
+def upgrade():
+    with op.batch_alter_table('asset_price_histories') as batch_op:
+        batch_op.add_column(sa.Column('date_value', sa.Date(), nullable=True))
+
+    op.execute(BACKFILL[op.get_bind().dialect.name])
+
+    with op.batch_alter_table('asset_price_histories') as batch_op:
+        batch_op.drop_column('date')
+        batch_op.alter_column('date_value', new_column_name='date', nullable=False, existing_type=sa.Date())
+
+    op.create_index(INDEX_NAME, 'asset_price_histories', ['portfolio_id', 'asset_type', 'date'])
+
+
+def downgrade():
+    op.drop_index(INDEX_NAME, table_name='asset_price_histories')
+
+    with op.batch_alter_table('asset_price_histories') as batch_op:
+        batch_op.add_column(sa.Column('date_value', sa.String(), nullable=True))
+
+    op.execute(RESTORE[op.get_bind().dialect.name])
+
+    with op.batch_alter_table('asset_price_histories') as batch_op:
+        batch_op.drop_column('date')
+        batch_op.alter_column('date_value', new_column_name='date', nullable=False, existing_type=sa.String())
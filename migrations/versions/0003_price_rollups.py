@@ -0,0 +1,71 @@
+"""weekly, monthly and quarterly OHLC rollups of the asset price histories
+
+Revision ID: 0003_price_rollups
+Revises: 0002_typed_price_date
+Create Date: 2026-10-17 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003_price_rollups'
+down_revision = '0002_typed_price_date'
+branch_labels = None
+depends_on = None
+
+INTERVALS = ('week', 'month', 'quarter')
+
+# first day of the bucket, weeks start on Monday
+BUCKETS = {
+    'postgresql': {
+        'week': "date_trunc('week', date)::date",
+        'month': "date_trunc('month', date)::date",
+        'quarter': "date_trunc('quarter', date)::date"
+    },
+    'sqlite': {
+        'week': "date(date, 'weekday 0', '-6 days')",
+        'month': "date(date, 'start of month')",
+        'quarter': "printf('%04d-%02d-01', strftime('%Y', date), (strftime('%m', date) - 1) / 3 * 3 + 1)"
+    }
+}
+
+BACKFILL = """
+    INSERT INTO asset_price_rollups (portfolio_id, asset_type, "interval", bucket, open, high, low, close, count)
+    SELECT portfolio_id, asset_type, '{interval}', bucket, min(open), max(price), min(price), min(close), count(*)
+    FROM (
+        SELECT portfolio_id, asset_type, price, {bucket} AS bucket,
+               first_value(price) OVER w AS open,
+               last_value(price) OVER w AS close
+        FROM asset_price_histories
+        WHERE portfolio_id IS NOT NULL
+        WINDOW w AS (PARTITION BY portfolio_id, asset_type, {bucket} ORDER BY date, id
+                     ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING)
+    ) AS bars
+    GROUP BY portfolio_id, asset_type, bucket
+"""
+
+
+def upgrade():
+    op.create_table(
+        'asset_price_rollups',
+        sa.Column('portfolio_id', sa.Integer(), nullable=False),
+        sa.Column('asset_type', sa.String(), nullable=False),
+        sa.Column('interval', sa.String(), nullable=False),
+        sa.Column('bucket', sa.Date(), nullable=False),
+        sa.Column('open', sa.Float(), nullable=False),
+        sa.Column('high', sa.Float(), nullable=False),
+        sa.Column('low', sa.Float(), nullable=False),
+        sa.Column('close', sa.Float(), nullable=False),
+        sa.Column('count', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('portfolio_id', 'asset_type', 'interval', 'bucket')
+    )
+
+    buckets = BUCKETS[op.get_bind().dialect.name]
+    for interval in INTERVALS:
+        op.execute(BACKFILL.format(interval=interval, bucket=buckets[interval]))
+
+
+def downgrade():
+    op.drop_table('asset_price_rollups')
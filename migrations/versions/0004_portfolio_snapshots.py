@@ -0,0 +1,52 @@
+"""daily portfolio snapshots, their change log and an index on the price dates
+
+Revision ID: 0004_portfolio_snapshots
+Revises: 0003_price_rollups
+Create Date: 2026-10-17 11:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0004_portfolio_snapshots'
+down_revision = '0003_price_rollups'
+branch_labels = None
+depends_on = None
+
+INDEX_NAME = 'ix_asset_price_histories_date'
+
+
+def upgrade():
+    op.create_table(
+        'portfolio_snapshots',
+        sa.Column('date', sa.Date(), nullable=False),
+        sa.Column('portfolio_id', sa.Integer(), nullable=False),
+        sa.Column('asset_type', sa.String(), nullable=False),
+        sa.Column('price', sa.Float(), nullable=False),
+        sa.Column('price_date', sa.Date(), nullable=False),
+        sa.Column('weight', sa.Float(), nullable=False),
+        sa.Column('benchmark', sa.Boolean(), nullable=False),
+        sa.PrimaryKeyConstraint('date', 'portfolio_id', 'asset_type')
+    )
+    changes = op.create_table(
+        'portfolio_snapshot_changes',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('portfolio_id', sa.Integer(), nullable=True),
+        sa.Column('asset_type', sa.String(), nullable=True),
+        sa.Column('first', sa.Date(), nullable=True),
+        sa.Column('last', sa.Date(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    # the incremental refresh reads the prices of a few days
+    op.create_index(INDEX_NAME, 'asset_price_histories', ['date'])
+
+    # a change of every portfolio, the first `flask refresh-snapshots` fills the table
+    op.bulk_insert(changes, [{'portfolio_id': None, 'asset_type': None, 'first': None, 'last': None}])
+
+
+def downgrade():
+    op.drop_index(INDEX_NAME, table_name='asset_price_histories')
+    op.drop_table('portfolio_snapshot_changes')
+    op.drop_table('portfolio_snapshots')
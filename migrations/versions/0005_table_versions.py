@@ -0,0 +1,34 @@
+"""write versions of the tables behind the ETags and response caches
+
+Revision ID: 0005_table_versions
+Revises: 0004_portfolio_snapshots
+Create Date: 2026-10-17 12:00:00.000000
+
+"""
+import random
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0005_table_versions'
+down_revision = '0004_portfolio_snapshots'
+branch_labels = None
+depends_on = None
+
+TABLES = ('portfolios', 'asset_price_histories', 'asset_price_rollups')
+
+
+def upgrade():
+    versions = op.create_table(
+        'table_versions',
+        sa.Column('table_name', sa.String(), nullable=False),
+        sa.Column('version', sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint('table_name')
+    )
+    # random, like models.initial_version, so no ETag handed out before matches
+    op.bulk_insert(versions, [{'table_name': name, 'version': random.getrandbits(48)} for name in TABLES])
+
+
+def downgrade():
+    op.drop_table('table_versions')
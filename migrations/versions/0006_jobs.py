@@ -0,0 +1,38 @@
+"""background jobs, polled from any worker process
+
+Revision ID: 0006_jobs
+Revises: 0005_table_versions
+Create Date: 2026-10-17 13:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0006_jobs'
+down_revision = '0005_table_versions'
+branch_labels = None
+depends_on = None
+
+INDEX_NAME = 'ix_jobs_submitted_at'
+
+
+def upgrade():
+    op.create_table(
+        'jobs',
+        sa.Column('id', sa.String(), nullable=False),
+        sa.Column('kind', sa.String(), nullable=False),
+        sa.Column('status', sa.String(), nullable=False),
+        sa.Column('submitted_at', sa.Float(), nullable=False),
+        sa.Column('finished_at', sa.Float(), nullable=True),
+        sa.Column('result', sa.Text(), nullable=True),
+        sa.Column('error', sa.Text(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(INDEX_NAME, 'jobs', ['submitted_at'])
+
+
+def downgrade():
+    op.drop_index(INDEX_NAME, table_name='jobs')
+    op.drop_table('jobs')
@@ -0,0 +1,30 @@
+"""series whose price rollups haven't caught up with their writes
+
+Revision ID: 0007_rollup_changes
+Revises: 0006_jobs
+Create Date: 2026-10-17 14:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0007_rollup_changes'
+down_revision = '0006_jobs'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'asset_price_rollup_changes',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('portfolio_id', sa.Integer(), nullable=False),
+        sa.Column('asset_type', sa.String(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('asset_price_rollup_changes')
@@ -0,0 +1,28 @@
+"""owner and heartbeat of the background jobs, to tell interrupted ones
+
+Revision ID: 0008_job_heartbeats
+Revises: 0007_rollup_changes
+Create Date: 2026-10-17 15:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0008_job_heartbeats'
+down_revision = '0007_rollup_changes'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('jobs') as batch_op:
+        batch_op.add_column(sa.Column('owner', sa.String(), nullable=True))
+        batch_op.add_column(sa.Column('heartbeat_at', sa.Float(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('jobs') as batch_op:
+        batch_op.drop_column('heartbeat_at')
+        batch_op.drop_column('owner')
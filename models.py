@@ -1,6 +1,10 @@
-import os
-from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import Column, Float, ForeignKey, Integer, String
+import os, random
+from datetime import date, datetime
+import click
+from sqlalchemy import event
+from sqlalchemy import BigInteger, Boolean, Column, Date, Float, ForeignKey, Index, Integer, String, Text, inspect, select
+from sqlalchemy.orm import validates
+from db_routing import REPLICA_DATABASE_URL, RoutingSQLAlchemy, engine_options, init_routing, router
 
 ### If you are running app locally you will need this
 
@@ -12,27 +16,189 @@ from sqlalchemy import Column, Float, ForeignKey, Integer, String
 #     DATABASE_USER, DATABASE_PASS, DATABASE_HOST, DATABASE_NAME
 # )
 
-### If you want to deploy app to render/heroku/aws you will need this
-DATABASE_PATH = os.environ['DATABASE_URL']
-if DATABASE_PATH.startswith("postgres://"):
-  DATABASE_PATH = DATABASE_PATH.replace("postgres://", "postgresql://", 1)
+### If you want to deploy app to render/heroku/aws set DATABASE_URL, create_app() reads it
 
 
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
+MIGRATIONS_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+
+# Dates are returned as DD-MM-YYYY, ISO dates are accepted on input as well
+DATE_OUTPUT_FORMAT = '%d-%m-%Y'
+DATE_FORMATS = (DATE_OUTPUT_FORMAT, '%Y-%m-%d')
+
+
+def parse_date(value):
+    if isinstance(value, date):
+        return value
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format).date()
+        except (TypeError, ValueError):
+            continue
+    raise ValueError('invalid date: {!r}'.format(value))
+
+
+def format_date(value):
+    return value.strftime(DATE_OUTPUT_FORMAT) if value is not None else None
+
+
+def price_history_filters(args):
+    """Builds the WHERE conditions for asset price history queries from a
+    mapping with optional `portfolio_id`, `asset_type`, `start` and `end`
+    keys, raises ValueError on malformed values."""
+    filters = []
+    if args.get('portfolio_id') is not None:
+        filters.append(AssetPriceHistory.portfolio_id == int(args['portfolio_id']))
+    if args.get('asset_type') is not None:
+        filters.append(AssetPriceHistory.asset_type == args['asset_type'])
+    if args.get('start') is not None:
+        filters.append(AssetPriceHistory.date >= parse_date(args['start']))
+    if args.get('end') is not None:
+        filters.append(AssetPriceHistory.date <= parse_date(args['end']))
+    return filters
+
+
+"""
+write_listeners
+    callables notified after a write has been committed, called as
+    listener(table_name, action, changes, version) where action is "insert",
+    "update" or "delete" and changes is a list of dicts with the column values
+    of the affected rows. For updates every dict also holds the previous
+    values of the changed columns under "previous", empty when they aren't
+    known. version is the write version of the table the write committed
+    (see bump_versions), None when it isn't known.
+"""
+
+write_listeners = []
+
+
+def notify_write(table_name, action, changes, version=None):
+    for listener in write_listeners:
+        listener(table_name, action, changes, version)
+
+
+"""
+write_loggers
+    callables called inside the transaction of a write, before it commits,
+    as logger(table_name, action, changes) with the changes the write
+    listeners get. What they write commits or rolls back with the write,
+    the caller commits
+"""
+
+write_loggers = []
+
+
+def log_write(table_name, action, changes):
+    for logger in write_loggers:
+        logger(table_name, action, changes)
+
+
+"""
+bump_versions(*table_names)
+    increments the write versions of the tables in the current transaction,
+    the caller commits. Every write to a table the read endpoints cache
+    must bump it, in the transaction of the write, so that every worker and
+    process sees a new version as soon as it sees the new rows. Returns
+    {table_name: version} as set by this transaction, the row stays locked
+    until it commits, so that is the version the write is committed at
+"""
+
+
+def bump_versions(*table_names):
+    table = TableVersion.__table__
+    for table_name in table_names:
+        result = db.session.execute(table.update()
+                                    .where(table.c.table_name == table_name)
+                                    .values(version=table.c.version + 1))
+        if result.rowcount == 0:
+            db.session.execute(table.insert().values(table_name=table_name, version=initial_version()))
+    statement = table_versions_statement(table_names)
+    return dict(db.session.execute(statement, bind_arguments={'bind': db.engine}).fetchall())
+
+
+def initial_version():
+    # random, so a recreated database never hands out the ETags of the old one
+    return random.getrandbits(48)
+
+
+def table_versions_statement(table_names):
+    table = TableVersion.__table__
+    return select(table.c.table_name, table.c.version).where(table.c.table_name.in_(table_names))
+
+
+def table_versions(*table_names):
+    """The write versions of `table_names`, 0 for a table never written."""
+    versions = dict(db.session.execute(table_versions_statement(table_names)).fetchall())
+    return tuple(versions.get(table_name, 0) for table_name in table_names)
+
+
+def column_values(instance):
+    return {column.name: getattr(instance, column.name) for column in instance.__table__.columns}
+
+
+def remember_previous_values(mapper, connection, instance):
+    # an autoflush in the middle of an edit resets the attribute history, the
+    # previous values are kept until the changes are committed
+    state = inspect(instance)
+    previous = state.info.setdefault('previous', {})
+    unloaded = []
+    for column in instance.__table__.columns:
+        history = state.attrs[column.name].history
+        if history.added and column.name not in previous:
+            if history.deleted:
+                previous[column.name] = (history.deleted[0],)
+            else:
+                unloaded.append(column)
+    if unloaded:
+        # set while expired, the row still holds the old values until this
+        # flush writes it. None stands for "unknown"
+        keys = zip(instance.__table__.primary_key.columns, state.identity)
+        row = connection.execute(select(*unloaded).where(*(column == value for column, value in keys))).first()
+        for column in unloaded:
+            previous[column.name] = (row._mapping[column],) if row is not None else None
+
+
+def forget_previous_values(instance, attrs):
+    inspect(instance).info.pop('previous', None)
+
+
+def previous_values(instance):
+    """The committed values of the changed columns, empty when any of them
+    was changed before it was loaded."""
+    db.session.flush()
+    previous = inspect(instance).info.pop('previous', {})
+    if None in previous.values():
+        return {}
+    return {name: value for name, (value,) in previous.items() if value != getattr(instance, name)}
+
+
+event.listen(db.Model, "before_update", remember_previous_values, propagate=True)
+event.listen(db.Model, "expire", forget_previous_values, propagate=True)
 
 
 """
 setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service, with the pool and
+    statement timeout settings of db_routing.py and, when `replica_path` is
+    set, GET requests routed to that read replica. The schema isn't created
+    here, run `flask db upgrade` (or db.create_all() in tests)
 """
 
 
-def setup_db(app, database_path=DATABASE_PATH):
+def setup_db(app, database_path, replica_path=REPLICA_DATABASE_URL):
+    if database_path.startswith("postgres://"):
+        database_path = database_path.replace("postgres://", "postgresql://", 1)
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-    db.app = app
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(database_path)
     db.init_app(app)
-    db.create_all()
+    # Flask-Migrate pulls in alembic, only the `flask` command needs it
+    if app.config.get("MIGRATIONS", click.get_current_context(silent=True) is not None):
+        from flask_migrate import Migrate
+        Migrate(app, db, directory=MIGRATIONS_DIRECTORY)
+    init_routing(app, db.get_engine(app), replica_path)
+    if router.on_write not in write_listeners:
+        write_listeners.append(router.on_write)
 
 
 class Portfolio(db.Model):
@@ -71,7 +237,12 @@ class Portfolio(db.Model):
 
     def insert(self):
         db.session.add(self)
+        db.session.flush()
+        values = column_values(self)
+        version = bump_versions(self.__tablename__)[self.__tablename__]
+        log_write(self.__tablename__, "insert", [values])
         db.session.commit()
+        notify_write(self.__tablename__, "insert", [values], version)
 
     """
     update()
@@ -84,7 +255,11 @@ class Portfolio(db.Model):
     """
 
     def update(self):
+        values = dict(column_values(self), previous=previous_values(self))
+        version = bump_versions(self.__tablename__)[self.__tablename__]
+        log_write(self.__tablename__, "update", [values])
         db.session.commit()
+        notify_write(self.__tablename__, "update", [values], version)
 
     """
     delete()
@@ -100,8 +275,12 @@ class Portfolio(db.Model):
     """
 
     def delete(self):
+        values = column_values(self)
         db.session.delete(self)
+        version = bump_versions(self.__tablename__)[self.__tablename__]
+        log_write(self.__tablename__, "delete", [values])
         db.session.commit()
+        notify_write(self.__tablename__, "delete", [values], version)
 
     def format(self):
         return {
@@ -116,11 +295,15 @@ class Portfolio(db.Model):
 
 class AssetPriceHistory(db.Model):
     __tablename__ = "asset_price_histories"
+    __table_args__ = (
+        Index("ix_asset_price_histories_portfolio_asset_date", "portfolio_id", "asset_type", "date"),
+        Index("ix_asset_price_histories_date", "date"),
+    )
 
     id = Column(Integer, primary_key=True)                        # A unique identifier for each price history entry
     asset_type = Column(String, nullable=False)                   # The type of underlying asset (bond, shares, commodity, etc.)
     price = Column(Float, nullable=False)                         # The price of the asset
-    date = Column(String, nullable=False)                         # The date associated with the asset price
+    date = Column(Date, nullable=False)                           # The date associated with the asset price
     portfolio_id = Column(Integer, ForeignKey("portfolios.id"))   # The foreign key referencing the portfolio
 
 
@@ -133,6 +316,11 @@ class AssetPriceHistory(db.Model):
 
     def __repr__(self):
         return self.format()
+
+
+    @validates("date")
+    def validate_date(self, key, value):
+        return parse_date(value)
     
     
     """
@@ -148,7 +336,12 @@ class AssetPriceHistory(db.Model):
 
     def insert(self):
         db.session.add(self)
+        db.session.flush()
+        values = column_values(self)
+        version = bump_versions(self.__tablename__)[self.__tablename__]
+        log_write(self.__tablename__, "insert", [values])
         db.session.commit()
+        notify_write(self.__tablename__, "insert", [values], version)
 
     """
     update()
@@ -161,7 +354,11 @@ class AssetPriceHistory(db.Model):
     """
 
     def update(self):
+        values = dict(column_values(self), previous=previous_values(self))
+        version = bump_versions(self.__tablename__)[self.__tablename__]
+        log_write(self.__tablename__, "update", [values])
         db.session.commit()
+        notify_write(self.__tablename__, "update", [values], version)
 
     """
     delete()
@@ -176,14 +373,97 @@ class AssetPriceHistory(db.Model):
     """
 
     def delete(self):
+        values = column_values(self)
         db.session.delete(self)
+        version = bump_versions(self.__tablename__)[self.__tablename__]
+        log_write(self.__tablename__, "delete", [values])
         db.session.commit()
+        notify_write(self.__tablename__, "delete", [values], version)
 
     def format(self):
         return {
             "id": self.id,
             "asset_type": self.asset_type,
             "price": self.price,
-            "date": self.date,
+            "date": format_date(self.date),
             "portfolio_id": self.portfolio_id
-        }
\ No newline at end of file
+        }
+
+
+class AssetPriceRollup(db.Model):
+    """Open/high/low/close bars of one price series per interval bucket,
+    derived from asset_price_histories and kept up to date by resample.py."""
+    __tablename__ = "asset_price_rollups"
+
+    portfolio_id = Column(Integer, primary_key=True)
+    asset_type = Column(String, primary_key=True)
+    interval = Column(String, primary_key=True)     # week, month or quarter
+    bucket = Column(Date, primary_key=True)         # first day of the bucket
+    open = Column(Float, nullable=False)
+    high = Column(Float, nullable=False)
+    low = Column(Float, nullable=False)
+    close = Column(Float, nullable=False)
+    count = Column(Integer, nullable=False)
+
+
+class AssetPriceRollupChange(db.Model):
+    """Series whose rollups failed to catch up with a write, served from the
+    raw prices until a refresh of their whole history succeeds."""
+    __tablename__ = "asset_price_rollup_changes"
+
+    id = Column(Integer, primary_key=True)
+    portfolio_id = Column(Integer, nullable=False)
+    asset_type = Column(String)         # None: every series of the portfolio
+
+
+class PortfolioSnapshot(db.Model):
+    """Valuation of every price series of every portfolio on each price date:
+    the latest price at or before the date and the series' weight, derived
+    from asset_price_histories and kept up to date by snapshots.py."""
+    __tablename__ = "portfolio_snapshots"
+
+    date = Column(Date, primary_key=True)
+    portfolio_id = Column(Integer, primary_key=True)
+    asset_type = Column(String, primary_key=True)
+    price = Column(Float, nullable=False)
+    price_date = Column(Date, nullable=False)       # earlier than date when the price was carried forward
+    weight = Column(Float, nullable=False)          # the portfolio weight split between its series that day
+    benchmark = Column(Boolean, nullable=False)     # asset_type is the portfolio's benchmark_desc
+
+
+class PortfolioSnapshotChange(db.Model):
+    """Writes the portfolio snapshots haven't caught up with yet."""
+    __tablename__ = "portfolio_snapshot_changes"
+
+    id = Column(Integer, primary_key=True)
+    portfolio_id = Column(Integer)      # None: every portfolio
+    asset_type = Column(String)         # None: every series of the portfolio
+    first = Column(Date)                # first and last date written, None: the whole history
+    last = Column(Date)
+
+
+class TableVersion(db.Model):
+    """Write counter of a table, see `bump_versions`."""
+    __tablename__ = "table_versions"
+
+    table_name = Column(String, primary_key=True)
+    version = Column(BigInteger, nullable=False)
+
+
+class Job(db.Model):
+    """A background job of workers.JobRegistry, readable from every worker
+    process."""
+    __tablename__ = "jobs"
+    __table_args__ = (
+        Index("ix_jobs_submitted_at", "submitted_at"),
+    )
+
+    id = Column(String, primary_key=True)
+    kind = Column(String, nullable=False)           # risk or backtest
+    status = Column(String, nullable=False)         # pending, running, done or failed
+    submitted_at = Column(Float, nullable=False)    # epoch seconds
+    finished_at = Column(Float)
+    result = Column(Text)                           # JSON
+    error = Column(Text)
+    owner = Column(String)                          # JobRegistry.owner of the process running it
+    heartbeat_at = Column(Float)                    # epoch seconds, refreshed while pending or running
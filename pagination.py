@@ -0,0 +1,118 @@
+import base64, binascii, json
+from flask import request
+from sqlalchemy import Date, select
+from models import db, format_date
+
+MAX_PAGE_SIZE = 1000
+
+
+def encode_cursor(last_id):
+    data = json.dumps({'id': last_id}, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        last_id = json.loads(base64.urlsafe_b64decode(padded))['id']
+    except (binascii.Error, ValueError, TypeError, KeyError):
+        raise ValueError('invalid cursor')
+    if not isinstance(last_id, int):
+        raise ValueError('invalid cursor')
+    return last_id
+
+
+def parse_fields(model, fields):
+    """Returns the requested column names, `id` is always included since the
+    cursor is built from it."""
+    columns = [column.name for column in model.__table__.columns]
+    if not fields:
+        return columns
+
+    requested = [name.strip() for name in fields.split(',') if name.strip()]
+    unknown = set(requested) - set(columns)
+    if unknown:
+        raise ValueError('unknown fields: ' + ', '.join(sorted(unknown)))
+    return ['id'] + [name for name in columns if name in requested and name != 'id']
+
+
+def page_args(model, args=None):
+    """Reads `fields`, `after` and `limit` from the query string (or the
+    `args` mapping), raises ValueError on malformed values."""
+    if args is None:
+        args = request.args
+    fields = parse_fields(model, args.get('fields'))
+
+    after = args.get('after')
+    if after is not None:
+        after = decode_cursor(after)
+
+    limit = args.get('limit')
+    if limit is not None:
+        limit = int(limit)
+        if limit < 1:
+            raise ValueError('limit must be positive')
+        limit = min(limit, MAX_PAGE_SIZE)
+
+    return fields, after, limit
+
+
+def keyset_statement(model, fields, after=None, limit=None, filters=()):
+    """Selects one page of `model` rows ordered by id, plus one row telling
+    whether there is a next page."""
+    table = model.__table__
+    statement = select(*[table.c[name] for name in fields])
+    if after is not None:
+        statement = statement.where(table.c.id > after)
+    if filters:
+        statement = statement.where(*filters)
+    statement = statement.order_by(table.c.id)
+    if limit is not None:
+        statement = statement.limit(limit + 1)
+    return statement
+
+
+def next_page(rows, limit):
+    """Drops the extra row of `keyset_statement`, returns the rows and the
+    cursor of the next page."""
+    next_cursor = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][0])
+    return rows, next_cursor
+
+
+def keyset_rows(model, fields, after=None, limit=None, filters=()):
+    """Fetches one page of `model` rows ordered by id.
+
+    Only the requested columns are selected with a Core `select()` and the
+    rows come back as plain tuples, so no ORM instances are built. The page
+    starts right after the `after` id, which lets the database seek through
+    the primary key index instead of skipping over an offset. Returns the
+    row tuples and the cursor of the next page.
+    """
+    rows = db.session.execute(keyset_statement(model, fields, after, limit, filters)).fetchall()
+    return next_page(rows, limit)
+
+
+def keyset_page(model, fields, after=None, limit=None, filters=()):
+    """`keyset_rows` as a list of dicts with formatted dates."""
+    rows, next_cursor = keyset_rows(model, fields, after, limit, filters)
+    return format_rows(model.__table__, fields, rows), next_cursor
+
+
+def format_rows(table, fields, rows):
+    """Row tuples of `table` as dicts with formatted dates."""
+    items = [dict(zip(fields, row)) for row in rows]
+    date_columns = [name for name in fields if isinstance(table.c[name].type, Date)]
+    if date_columns:
+        # a page repeats the same few dates across series, format each once
+        formatted = {}
+        for item in items:
+            for name in date_columns:
+                value = item[name]
+                text = formatted.get(value)
+                if text is None:
+                    text = formatted[value] = format_date(value)
+                item[name] = text
+    return items
@@ -0,0 +1,323 @@
+from contextlib import contextmanager
+import fcntl, glob, json, os, threading
+import numpy as np
+from sqlalchemy import select
+from instrumentation import metric_collectors, prefixed
+from models import AssetPriceHistory, db, write_listeners
+
+# directory holding the memory-mapped cube, shared by the workers of a host.
+# The cube is off when it is not set
+PRICE_CUBE_DIR = os.environ.get('PRICE_CUBE_DIR')
+# free dates and series left by a rebuild for the appends, once they are
+# used up the next append that needs one makes the cube rebuild
+PRICE_CUBE_DATE_HEADROOM = int(os.environ.get('PRICE_CUBE_DATE_HEADROOM', 260))
+PRICE_CUBE_SERIES_HEADROOM = int(os.environ.get('PRICE_CUBE_SERIES_HEADROOM', 64))
+
+price_table = AssetPriceHistory.__table__
+
+
+def load_price_table():
+    """(portfolio ids, asset types, dates, prices) arrays of every price row
+    that belongs to a portfolio."""
+    statement = select(price_table.c.portfolio_id, price_table.c.asset_type, price_table.c.date,
+                       price_table.c.price) \
+        .where(price_table.c.portfolio_id.isnot(None))
+    rows = db.session.execute(statement).fetchall()
+    if not rows:
+        return (np.array([], dtype=np.int64), np.array([], dtype=object),
+                np.array([], dtype='datetime64[D]'), np.array([], dtype=np.float64))
+
+    portfolio_ids, asset_types, dates, prices = zip(*rows)
+    return (np.array(portfolio_ids, dtype=np.int64),
+            np.array(asset_types, dtype=object),
+            np.array(dates, dtype='datetime64[D]'),
+            np.array(prices, dtype=np.float64))
+
+
+class PriceCube:
+    """The price table as a date x series float64 matrix in memory-mapped
+    files, so every worker process of the host maps the same copy.
+
+    Series are the (portfolio id, asset type) pairs, `columns` maps them to a
+    column and the dates are a sorted axis, a NaN means the series has no
+    price that day. A rebuild writes a new generation of the files, sorted
+    by portfolio id and asset type, with headroom for appends: new prices
+    on the last date or later, or of a new series, are written in place
+    through `on_write`. Anything else (a back-filled date, a moved row, a
+    delete) marks the cube stale and the next read rebuilds it.
+
+    `meta.json` describes the current generation, and `version.npy` is a
+    shared counter bumped on every change to it, which readers compare with
+    the version they loaded. Writers of all processes are serialized by an
+    flock on `cube.lock`.
+    """
+
+    def __init__(self, directory=PRICE_CUBE_DIR, loader=load_price_table,
+                 date_headroom=PRICE_CUBE_DATE_HEADROOM, series_headroom=PRICE_CUBE_SERIES_HEADROOM):
+        self.directory = directory
+        self.loader = loader
+        self.date_headroom = date_headroom
+        self.series_headroom = series_headroom
+        self.counter = None
+        self.version = None
+        self.generation = None
+        self.dates = None
+        self.prices = None
+        self.date_count = 0
+        self.series = []
+        self.columns = {}
+        self.stale = False
+        self.reads = 0
+        self.rebuilds = 0
+        self.appends = 0
+        self.stale_marks = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.directory is not None
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    @contextmanager
+    def _exclusive(self):
+        with open(self._path('cube.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _open(self):
+        """Creates the directory and the shared version counter, before any
+        flock is taken (a second flock of the same process would deadlock)."""
+        if self.counter is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path('version.npy')
+        with self._exclusive():
+            if not os.path.exists(path):
+                np.lib.format.open_memmap(path, mode='w+', dtype=np.int64, shape=(1,)).flush()
+        self.counter = np.load(path, mmap_mode='r+')
+
+    def _load(self):
+        """Maps the generation described by meta.json, when another process
+        changed it since this one last looked."""
+        version = int(self.counter[0])
+        if version == self.version:
+            return
+        try:
+            with open(self._path('meta.json'), encoding='utf-8') as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return
+        if meta['generation'] != self.generation:
+            self.dates = np.load(self._path('dates-{}.npy'.format(meta['generation'])), mmap_mode='r+')
+            self.prices = np.load(self._path('prices-{}.npy'.format(meta['generation'])), mmap_mode='r+')
+            self.generation = meta['generation']
+        self.date_count = meta['dates']
+        self.series = [tuple(key) for key in meta['series']]
+        self.columns = {key: column for column, key in enumerate(self.series)}
+        self.stale = meta['stale']
+        self.version = version
+
+    def _save(self):
+        path = self._path('meta.json')
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({
+                'generation': self.generation,
+                'dates': self.date_count,
+                'series': self.series,
+                'stale': self.stale
+            }, f)
+        os.replace(path + '.tmp', path)
+        self.counter[0] += 1
+        self.version = int(self.counter[0])
+
+    def _sync(self):
+        """Brings this process up to date, rebuilding a missing or stale cube."""
+        self._open()
+        self._load()
+        if self.generation is None or self.stale:
+            with self._exclusive():
+                # another process may have rebuilt it while we waited
+                self._load()
+                if self.generation is None or self.stale:
+                    self._rebuild()
+
+    def rebuild(self):
+        """Reloads the whole price table into a new generation."""
+        with self._lock:
+            self._open()
+            with self._exclusive():
+                self._load()
+                self._rebuild()
+
+    def _rebuild(self):
+        portfolio_ids, asset_types, dates, prices = self.loader()
+        series = []
+        row_index = column_index = np.array([], dtype=np.int64)
+        date_axis = np.array([], dtype='datetime64[D]')
+        if len(prices):
+            type_names, type_codes = np.unique(asset_types, return_inverse=True)
+            keys, column_index = np.unique(portfolio_ids * len(type_names) + type_codes.reshape(-1),
+                                           return_inverse=True)
+            series = [(int(key // len(type_names)), type_names[key % len(type_names)]) for key in keys]
+            date_axis, row_index = np.unique(dates, return_inverse=True)
+
+        generation = (self.generation or 0) + 1
+        date_capacity = len(date_axis) + self.date_headroom
+        series_capacity = len(series) + self.series_headroom
+        cube_dates = np.lib.format.open_memmap(self._path('dates-{}.npy'.format(generation)), mode='w+',
+                                               dtype='datetime64[D]', shape=(date_capacity,))
+        cube_prices = np.lib.format.open_memmap(self._path('prices-{}.npy'.format(generation)), mode='w+',
+                                                dtype=np.float64, shape=(date_capacity, series_capacity))
+        cube_dates[:len(date_axis)] = date_axis
+        cube_prices[:] = np.nan
+        cube_prices[row_index.reshape(-1), column_index.reshape(-1)] = prices
+        cube_dates.flush()
+        cube_prices.flush()
+
+        self.generation = generation
+        self.dates = cube_dates
+        self.prices = cube_prices
+        self.date_count = len(date_axis)
+        self.series = series
+        self.columns = {key: column for column, key in enumerate(series)}
+        self.stale = False
+        self._save()
+        self.rebuilds += 1
+
+        # the previous generation stays, a process may be about to map it
+        for path in glob.glob(self._path('*-*.npy')):
+            if int(os.path.basename(path).split('-')[1].split('.')[0]) < generation - 1:
+                os.remove(path)
+
+    def shared_version(self):
+        """The counter of version.npy, bumped by every process on every change
+        to the cube."""
+        with self._lock:
+            self._open()
+            return int(self.counter[0])
+
+    def keys(self, portfolio_ids=None):
+        """The (portfolio id, asset type) pairs in the cube, sorted."""
+        with self._lock:
+            self._sync()
+            series = self.series
+        return sorted(key for key in series if portfolio_ids is None or key[0] in portfolio_ids)
+
+    def window(self, keys, start=None, end=None):
+        """Returns the date axis between `start` and `end` (inclusive) and the
+        prices of the `keys` series on those dates, skipping the keys that
+        aren't in the cube.
+
+        Both are read-only views of the shared mapping when the keys map to
+        adjacent columns (e.g. the series of one portfolio, or of a range of
+        portfolios), otherwise the prices are gathered into a copy.
+        """
+        with self._lock:
+            self._sync()
+            self.reads += 1
+            dates = self.dates[:self.date_count]
+            prices = self.prices
+            columns = [self.columns[key] for key in keys if key in self.columns]
+
+        first = np.searchsorted(dates, np.datetime64(start, 'D'), 'left') if start is not None else 0
+        last = np.searchsorted(dates, np.datetime64(end, 'D'), 'right') if end is not None else len(dates)
+        if columns and columns == list(range(columns[0], columns[0] + len(columns))):
+            matrix = prices[first:last, columns[0]:columns[0] + len(columns)]
+        else:
+            matrix = prices[first:last].take(columns, axis=1)
+        dates = dates[first:last].view(np.ndarray)
+        matrix = matrix.view(np.ndarray)
+        dates.flags.writeable = matrix.flags.writeable = False
+        return dates, matrix
+
+    def _place(self, portfolio_id, asset_type, date, price):
+        """Writes one price in place, False when that needs a rebuild."""
+        date = np.datetime64(date, 'D')
+        count = self.date_count
+        if count and date <= self.dates[count - 1]:
+            row = int(np.searchsorted(self.dates[:count], date))
+            if self.dates[row] != date:
+                return False
+        elif count == len(self.dates):
+            return False
+        else:
+            row = count
+
+        key = (portfolio_id, asset_type)
+        column = self.columns.get(key)
+        if column is None:
+            if len(self.series) == self.prices.shape[1]:
+                return False
+            column = len(self.series)
+            self.series.append(key)
+            self.columns[key] = column
+        if row == count:
+            self.dates[row] = date
+            self.date_count += 1
+        self.prices[row, column] = price
+        return True
+
+    def _apply(self, action, change):
+        if action == 'insert':
+            if change['portfolio_id'] is None:
+                return True
+            return self._place(change['portfolio_id'], change['asset_type'], change['date'], change['price'])
+        if action == 'update':
+            previous = change.get('previous', {})
+            # no previous values when the instance was expired before the
+            # change, the row may have moved
+            if not previous or {'portfolio_id', 'asset_type', 'date'} & set(previous):
+                return False
+            if 'price' not in previous or change['portfolio_id'] is None:
+                return True
+            key = (change['portfolio_id'], change['asset_type'])
+            return key in self.columns and self._place(*key, change['date'], change['price'])
+        return False
+
+    def on_write(self, table_name, action, changes, version=None):
+        if not self.enabled or table_name != AssetPriceHistory.__tablename__:
+            return
+        with self._lock:
+            self._open()
+            with self._exclusive():
+                self._load()
+                if self.generation is None or self.stale:
+                    # the next read loads everything anyway
+                    return
+                layout = (self.date_count, len(self.series))
+                for change in changes:
+                    if not self._apply(action, change):
+                        self.stale = True
+                        self.stale_marks += 1
+                        self._save()
+                        return
+                self.appends += len(changes)
+                if (self.date_count, len(self.series)) != layout:
+                    self._save()
+                else:
+                    # prices written in place, readers keyed on the version move on
+                    self.counter[0] += 1
+                    self.version = int(self.counter[0])
+
+    def stats(self):
+        if not self.enabled:
+            return {}
+        return {
+            'dates': self.date_count,
+            'series': len(self.series),
+            'generation': self.generation or 0,
+            'reads': self.reads,
+            'rebuilds': self.rebuilds,
+            'appends': self.appends,
+            'stale_marks': self.stale_marks
+        }
+
+
+price_cube = PriceCube()
+write_listeners.append(price_cube.on_write)
+metric_collectors.append(lambda: prefixed('price_cube', price_cube.stats()))
@@ -0,0 +1,342 @@
+from datetime import timedelta
+import os, threading
+import numpy as np
+from sqlalchemy import Date, cast, func, literal, or_, select
+from columnar import row_columns
+from instrumentation import metric_collectors, prefixed
+from models import AssetPriceHistory, AssetPriceRollup, AssetPriceRollupChange, Portfolio, bump_versions, db, \
+    format_date, write_listeners
+
+RESAMPLE_INTERVALS = ('day', 'week', 'month', 'quarter')
+# intervals served from the asset_price_rollups table, the others scan the raw rows
+ROLLUP_INTERVALS = tuple(name for name in os.environ.get('ROLLUP_INTERVALS', 'week,month,quarter').split(',')
+                         if name in RESAMPLE_INTERVALS)
+ONE_DAY = timedelta(days=1)
+
+price_table = AssetPriceHistory.__table__
+rollup_table = AssetPriceRollup.__table__
+change_table = AssetPriceRollupChange.__table__
+BAR_COLUMNS = ('open', 'high', 'low', 'close', 'count')
+
+
+def bucket_start(value, interval):
+    """First day of the bucket `value` falls into, weeks start on Monday
+    like PostgreSQL's date_trunc."""
+    if interval == 'week':
+        return value - timedelta(days=value.weekday())
+    if interval == 'month':
+        return value.replace(day=1)
+    if interval == 'quarter':
+        return value.replace(month=(value.month - 1) // 3 * 3 + 1, day=1)
+    return value
+
+
+def next_bucket(value, interval):
+    """First day of the bucket after the one starting at `value`."""
+    if interval == 'week':
+        return value + timedelta(days=7)
+    if interval in ('month', 'quarter'):
+        months = value.year * 12 + value.month - 1 + (3 if interval == 'quarter' else 1)
+        return value.replace(year=months // 12, month=months % 12 + 1, day=1)
+    return value + ONE_DAY
+
+
+def bucket_starts(dates, interval):
+    """bucket_start over a datetime64[D] array."""
+    if interval == 'week':
+        days = dates.astype(np.int64)
+        # 1970-01-01 was a Thursday
+        return (days - (days + 3) % 7).astype('datetime64[D]')
+    if interval == 'month':
+        return dates.astype('datetime64[M]').astype('datetime64[D]')
+    if interval == 'quarter':
+        months = dates.astype('datetime64[M]').astype(np.int64)
+        return (months - months % 3).astype('datetime64[M]').astype('datetime64[D]')
+    return dates
+
+
+def numpy_bars(portfolio_ids, asset_types, dates, prices, interval):
+    """OHLC bars of rows sorted by series, date and id. Returns the series
+    and bucket of every bar plus the open, high, low, close and count
+    arrays."""
+    buckets = bucket_starts(dates, interval)
+    starts = np.flatnonzero(np.r_[True, (buckets[1:] != buckets[:-1]) | (portfolio_ids[1:] != portfolio_ids[:-1])
+                                  | (asset_types[1:] != asset_types[:-1])])
+    ends = np.r_[starts[1:], len(prices)]
+    return (portfolio_ids[starts], asset_types[starts], buckets[starts], prices[starts],
+            np.maximum.reduceat(prices, starts), np.minimum.reduceat(prices, starts), prices[ends - 1],
+            ends - starts)
+
+
+def load_rows(filters):
+    """Returns (portfolio ids, asset types, dates, prices) arrays of the
+    matching rows sorted by series, date and id."""
+    statement = select(price_table.c.portfolio_id, price_table.c.asset_type, price_table.c.date,
+                       price_table.c.price) \
+        .where(price_table.c.portfolio_id.isnot(None), *filters) \
+        .order_by(price_table.c.portfolio_id, price_table.c.asset_type, price_table.c.date, price_table.c.id)
+    rows = db.session.execute(statement).fetchall()
+    if not rows:
+        return (np.array([], dtype=np.int64), np.array([], dtype=object),
+                np.array([], dtype='datetime64[D]'), np.array([], dtype=np.float64))
+
+    portfolio_ids, asset_types, dates, prices = zip(*rows)
+    return (np.array(portfolio_ids, dtype=np.int64), np.array(asset_types, dtype=object),
+            np.array(dates, dtype='datetime64[D]'), np.array(prices, dtype=np.float64))
+
+
+def bars_select(interval, filters):
+    """OHLC bars computed by PostgreSQL: date_trunc buckets, the open and
+    close picked with window functions over each bucket."""
+    date = price_table.c.date
+    bucket = date if interval == 'day' else cast(func.date_trunc(interval, date), Date)
+    window = dict(partition_by=(price_table.c.portfolio_id, price_table.c.asset_type, bucket),
+                  order_by=(date, price_table.c.id), rows=(None, None))
+    rows = select(price_table.c.portfolio_id, price_table.c.asset_type, bucket.label('bucket'), price_table.c.price,
+                  func.first_value(price_table.c.price).over(**window).label('open'),
+                  func.last_value(price_table.c.price).over(**window).label('close')) \
+        .where(price_table.c.portfolio_id.isnot(None), *filters) \
+        .subquery()
+    return select(rows.c.portfolio_id, rows.c.asset_type, rows.c.bucket,
+                  func.min(rows.c.open).label('open'), func.max(rows.c.price).label('high'),
+                  func.min(rows.c.price).label('low'), func.min(rows.c.close).label('close'),
+                  func.count().label('count')) \
+        .group_by(rows.c.portfolio_id, rows.c.asset_type, rows.c.bucket) \
+        .order_by(rows.c.portfolio_id, rows.c.asset_type, rows.c.bucket)
+
+
+def use_sql():
+    return db.session.connection().dialect.name == 'postgresql'
+
+
+def compute_bars(filters, interval):
+    """Bars of the matching raw rows as (portfolio_id, asset_type, bucket,
+    open, high, low, close, count) tuples, in SQL on PostgreSQL and with
+    NumPy elsewhere."""
+    if use_sql():
+        return [tuple(row) for row in db.session.execute(bars_select(interval, filters))]
+
+    portfolio_ids, asset_types, dates, prices = load_rows(filters)
+    if len(prices) == 0:
+        return []
+    ids, types, buckets, opens, highs, lows, closes, counts = numpy_bars(portfolio_ids, asset_types, dates, prices,
+                                                                         interval)
+    return list(zip(ids.tolist(), types.tolist(), buckets.tolist(), opens.tolist(), highs.tolist(), lows.tolist(),
+                    closes.tolist(), counts.tolist()))
+
+
+def series_filters(portfolio_id, asset_type=None, start=None, end=None):
+    """WHERE conditions on the raw rows of one series (or one portfolio),
+    `end` is inclusive."""
+    filters = [price_table.c.portfolio_id == portfolio_id]
+    if asset_type is not None:
+        filters.append(price_table.c.asset_type == asset_type)
+    if start is not None:
+        filters.append(price_table.c.date >= start)
+    if end is not None:
+        filters.append(price_table.c.date <= end)
+    return filters
+
+
+def rollup_filters(interval, portfolio_id=None, asset_type=None, first=None, stop=None):
+    """WHERE conditions on the rollups of one interval, buckets in [first, stop)."""
+    filters = [rollup_table.c.interval == interval]
+    if portfolio_id is not None:
+        filters.append(rollup_table.c.portfolio_id == portfolio_id)
+    if asset_type is not None:
+        filters.append(rollup_table.c.asset_type == asset_type)
+    if first is not None:
+        filters.append(rollup_table.c.bucket >= first)
+    if stop is not None:
+        filters.append(rollup_table.c.bucket < stop)
+    return filters
+
+
+def write_rollups(interval, filters, portfolio_id=None, asset_type=None, first=None, stop=None):
+    """Replaces the rollups of the buckets in [first, stop) with bars computed
+    from the raw rows matching `filters`, the caller commits."""
+    db.session.execute(rollup_table.delete().where(*rollup_filters(interval, portfolio_id, asset_type, first, stop)))
+    columns = ('portfolio_id', 'asset_type', 'bucket') + BAR_COLUMNS
+    if use_sql():
+        bars = bars_select(interval, filters).subquery()
+        db.session.execute(rollup_table.insert().from_select(
+            columns + ('interval',), select(*(bars.c[name] for name in columns), literal(interval))))
+        return
+
+    rows = [dict(zip(columns, bar), interval=interval) for bar in compute_bars(filters, interval)]
+    if rows:
+        db.session.execute(rollup_table.insert(), rows)
+
+
+class Rollups:
+    """Keeps asset_price_rollups in step with the raw prices.
+
+    Every committed write recomputes the buckets it touched, of every
+    interval in ROLLUP_INTERVALS, from the raw rows of the affected series.
+    A series whose refresh failed is logged to asset_price_rollup_changes
+    and served from the raw rows, by every process, until a later refresh
+    of its whole history succeeds.
+    """
+
+    def __init__(self, intervals=ROLLUP_INTERVALS):
+        self.intervals = intervals
+        self.refreshes = 0
+        self.failures = 0
+        self.dirty_marks = 0
+        self.mark_failures = 0
+        self._lock = threading.Lock()
+
+    def is_fresh(self, portfolio_id, asset_type):
+        statement = select(change_table.c.id) \
+            .where(change_table.c.portfolio_id == portfolio_id,
+                   or_(change_table.c.asset_type == asset_type, change_table.c.asset_type.is_(None))) \
+            .limit(1)
+        return db.session.execute(statement).first() is None
+
+    def refresh(self, ranges):
+        """Recomputes the rollups of {(portfolio_id, asset_type): (first date,
+        last date)}, an asset_type of None covers the whole portfolio and
+        dates of None the whole history. The series logged as dirty are
+        recomputed whole along the way."""
+        if not self.intervals:
+            return
+        with self._lock:
+            ranges = dict(ranges)
+            dirty = []
+            try:
+                dirty = db.session.execute(
+                    select(change_table.c.id, change_table.c.portfolio_id, change_table.c.asset_type)).fetchall()
+                for _, portfolio_id, asset_type in dirty:
+                    ranges[portfolio_id, asset_type] = (None, None)
+                for (portfolio_id, asset_type), (first, last) in ranges.items():
+                    for interval in self.intervals:
+                        lo = bucket_start(first, interval) if first is not None else None
+                        hi = next_bucket(bucket_start(last, interval), interval) if last is not None else None
+                        write_rollups(interval, series_filters(portfolio_id, asset_type, lo, hi and hi - ONE_DAY),
+                                      portfolio_id, asset_type, lo, hi)
+                # by id, marks logged meanwhile stay for the next refresh
+                if dirty:
+                    db.session.execute(change_table.delete().where(change_table.c.id.in_([row.id for row in dirty])))
+                bump_versions(rollup_table.name)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                self.failures += 1
+                self.mark_dirty(set(ranges) - {(row.portfolio_id, row.asset_type) for row in dirty})
+                raise
+            self.refreshes += 1
+
+    def mark_dirty(self, keys):
+        if not keys:
+            return
+        try:
+            db.session.execute(change_table.insert(), [
+                {'portfolio_id': portfolio_id, 'asset_type': asset_type} for portfolio_id, asset_type in keys])
+            # responses cached from the stale rollups get a new ETag
+            bump_versions(rollup_table.name)
+            db.session.commit()
+            self.dirty_marks += len(keys)
+        except Exception:
+            # the write itself is committed, `flask rebuild-rollups` catches up
+            db.session.rollback()
+            self.mark_failures += 1
+
+    def rebuild(self):
+        """Recomputes every rollup from the raw rows."""
+        with self._lock:
+            db.session.execute(rollup_table.delete())
+            db.session.execute(change_table.delete())
+            for interval in self.intervals:
+                write_rollups(interval, [])
+            bump_versions(rollup_table.name)
+            db.session.commit()
+
+    def on_write(self, table_name, action, changes, version=None):
+        ranges = {}
+
+        def touch(key, value):
+            first, last = ranges.get(key, (value, value))
+            ranges[key] = (min(first, value), max(last, value))
+
+        if table_name == Portfolio.__tablename__:
+            if action == 'delete':
+                for change in changes:
+                    ranges[change['id'], None] = (None, None)
+        elif table_name == AssetPriceHistory.__tablename__:
+            for change in changes:
+                if change.get('portfolio_id') is not None:
+                    touch((change['portfolio_id'], change['asset_type']), change['date'])
+                previous = change.get('previous')
+                if previous:
+                    key = (previous.get('portfolio_id', change['portfolio_id']),
+                           previous.get('asset_type', change['asset_type']))
+                    if key[0] is not None:
+                        touch(key, previous.get('date', change['date']))
+                elif action == 'update' and change.get('portfolio_id') is not None:
+                    # the previous values aren't known, the date may have moved
+                    ranges[change['portfolio_id'], change['asset_type']] = (None, None)
+        if ranges:
+            try:
+                self.refresh(ranges)
+            except Exception:
+                # the write itself is committed, the series are marked dirty
+                pass
+
+    def stats(self):
+        return {
+            'refreshes': self.refreshes,
+            'failures': self.failures,
+            'dirty_marks': self.dirty_marks,
+            'mark_failures': self.mark_failures
+        }
+
+
+rollups = Rollups()
+write_listeners.append(rollups.on_write)
+metric_collectors.append(lambda: prefixed('rollups', rollups.stats()))
+
+
+def format_bars(bars):
+    return [{'date': format_date(bar[2]), **dict(zip(BAR_COLUMNS, bar[3:]))} for bar in bars]
+
+
+def bar_columns(bars):
+    """The fields of `format_bars` as one array each."""
+    columns = row_columns(rollup_table, ('bucket',) + BAR_COLUMNS, [bar[2:] for bar in bars])
+    return {'date': columns.pop('bucket'), **columns}
+
+
+def resample_prices(portfolio_id, asset_type, interval, start=None, end=None):
+    """`resample_bars` as a list of dicts with formatted dates."""
+    return format_bars(resample_bars(portfolio_id, asset_type, interval, start, end))
+
+
+def resample_bars(portfolio_id, asset_type, interval, start=None, end=None):
+    """OHLC bars of one series between `start` and `end` (inclusive), as
+    (portfolio_id, asset_type, bucket, open, high, low, close, count) rows.
+
+    For rollup intervals the whole buckets inside the range are read from
+    asset_price_rollups and only the partial buckets at the edges are
+    computed from the raw rows. A partial bucket covers the requested dates
+    only but is still labelled with the bucket's first day.
+    """
+    if interval not in rollups.intervals or not rollups.is_fresh(portfolio_id, asset_type):
+        return compute_bars(series_filters(portfolio_id, asset_type, start, end), interval)
+
+    first = start if start is None or bucket_start(start, interval) == start else \
+        next_bucket(bucket_start(start, interval), interval)
+    stop = bucket_start(end + ONE_DAY, interval) if end is not None else None
+    if first is not None and stop is not None and first >= stop:
+        return compute_bars(series_filters(portfolio_id, asset_type, start, end), interval)
+
+    bars = []
+    if start is not None and first > start:
+        bars += compute_bars(series_filters(portfolio_id, asset_type, start, first - ONE_DAY), interval)
+    statement = select(rollup_table.c.portfolio_id, rollup_table.c.asset_type, rollup_table.c.bucket,
+                       *(rollup_table.c[name] for name in BAR_COLUMNS)) \
+        .where(*rollup_filters(interval, portfolio_id, asset_type, first, stop)) \
+        .order_by(rollup_table.c.bucket)
+    bars += db.session.execute(statement).fetchall()
+    if stop is not None and stop <= end:
+        bars += compute_bars(series_filters(portfolio_id, asset_type, stop, end), interval)
+    return bars
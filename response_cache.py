@@ -0,0 +1,163 @@
+from collections import OrderedDict
+from functools import wraps
+import gzip, hashlib, os, threading, time
+from flask import Response, make_response, request
+from instrumentation import metric_collectors, prefixed
+from models import table_versions
+from serialization import negotiated_mimetype
+
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 256))
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+# bodies at least this large are also kept gzipped, 0 disables compression
+RESPONSE_CACHE_GZIP_MIN_SIZE = int(os.environ.get('RESPONSE_CACHE_GZIP_MIN_SIZE', 1024))
+# seconds a body is served from the cache, 0 keeps it until evicted. Bounds
+# the staleness after writes that don't bump the table versions (e.g. psql)
+RESPONSE_CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL', 0))
+
+# browsers and proxies may keep the body but must revalidate it
+CACHE_CONTROL = 'private, no-cache'
+
+
+def make_etag(path, versions, args, mimetype):
+    key = repr((path, versions, sorted(args), mimetype)).encode('utf-8')
+    return hashlib.sha1(key).hexdigest()
+
+
+class ResponseCache:
+    """Bounded LRU of serialized response bodies keyed by ETag.
+
+    The ETag already covers the table versions and the query string, so an
+    entry never has to be invalidated: a write moves readers on to a new key
+    and the old entry ages out. Entries are (mimetype, body, gzipped body or
+    None, expiry or None).
+    """
+
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE, max_bytes=RESPONSE_CACHE_MAX_BYTES,
+                 gzip_min_size=RESPONSE_CACHE_GZIP_MIN_SIZE, ttl=RESPONSE_CACHE_TTL):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.gzip_min_size = gzip_min_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.maxsize > 0
+
+    def get(self, etag):
+        with self._lock:
+            entry = self.entries.get(etag)
+            if entry is not None and entry[3] is not None and time.monotonic() >= entry[3]:
+                del self.entries[etag]
+                self.size_bytes -= len(entry[1]) + len(entry[2] or b'')
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(etag)
+            self.hits += 1
+            return entry
+
+    def put(self, etag, mimetype, body):
+        compressed = None
+        if self.gzip_min_size and len(body) >= self.gzip_min_size:
+            compressed = gzip.compress(body, compresslevel=5)
+        entry = (mimetype, body, compressed, time.monotonic() + self.ttl if self.ttl > 0 else None)
+        size = len(body) + len(compressed or b'')
+        if size > self.max_bytes:
+            return entry
+
+        with self._lock:
+            previous = self.entries.pop(etag, None)
+            if previous is not None:
+                self.size_bytes -= len(previous[1]) + len(previous[2] or b'')
+            self.entries[etag] = entry
+            self.size_bytes += size
+            while len(self.entries) > self.maxsize or self.size_bytes > self.max_bytes:
+                _, (_, old_body, old_compressed, _) = self.entries.popitem(last=False)
+                self.size_bytes -= len(old_body) + len(old_compressed or b'')
+                self.evictions += 1
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            self.size_bytes = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'not_modified': self.not_modified,
+            'evictions': self.evictions,
+            'size': len(self.entries),
+            'bytes': self.size_bytes
+        }
+
+
+response_cache = ResponseCache()
+metric_collectors.append(lambda: prefixed('response_cache', response_cache.stats()))
+
+
+def entry_body(entry, accept_encodings):
+    """The body of a cache entry to send and its Content-Encoding (None
+    when it goes out as is)."""
+    body, compressed = entry[1], entry[2]
+    if compressed is not None and 'gzip' in accept_encodings:
+        return compressed, 'gzip'
+    return body, None
+
+
+def entry_response(entry):
+    body, encoding = entry_body(entry, request.accept_encodings)
+    response = Response(body, mimetype=entry[0])
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    if entry[2] is not None:
+        response.vary.add('Accept-Encoding')
+    return response
+
+
+def conditional(*table_names, cache=True):
+    """Decorates a read endpoint whose response only depends on the query
+    string and the given tables.
+
+    The response carries an ETag built from the tables' write versions and
+    the negotiated format, a matching `If-None-Match` is answered with 304
+    before the view runs, and successful bodies are kept in `response_cache`
+    unless `cache` is off (for views with a cache of their own).
+    """
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            versions = table_versions(*table_names)
+            etag = make_etag(request.path, versions, request.args.items(multi=True), negotiated_mimetype())
+
+            if request.if_none_match.contains_weak(etag):
+                response_cache.not_modified += 1
+                response = Response(status=304)
+            else:
+                enabled = cache and response_cache.enabled
+                entry = response_cache.get(etag) if enabled else None
+                if entry is not None:
+                    response = entry_response(entry)
+                else:
+                    response = make_response(f(*args, **kwargs))
+                    if response.status_code != 200 or response.is_streamed:
+                        return response
+                    if enabled:
+                        entry = response_cache.put(etag, response.mimetype, response.get_data())
+                        response = entry_response(entry)
+
+            response.set_etag(etag)
+            response.vary.add('Accept')
+            response.headers['Cache-Control'] = CACHE_CONTROL
+            return response
+        return wrapper
+    return conditional_decorator
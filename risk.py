@@ -0,0 +1,113 @@
+import os
+import numpy as np
+from analytics import load_allocation, simple_returns, to_float
+from workers import SharedArrays, get_process_pool
+
+RISK_METHODS = ('monte_carlo', 'historical')
+RISK_BATCH_SIZE = int(os.environ.get('RISK_BATCH_SIZE', 50000))
+MAX_SCENARIOS = int(os.environ.get('MAX_SCENARIOS', 5000000))
+
+
+def covariance_factor(covariance):
+    """Cholesky factor of the covariance matrix. Sample covariances can be
+    singular (e.g. duplicated series), in which case the factor is built from
+    the eigen decomposition with the negative eigenvalues clipped."""
+    try:
+        return np.linalg.cholesky(covariance)
+    except np.linalg.LinAlgError:
+        values, vectors = np.linalg.eigh(covariance)
+        return vectors * np.sqrt(np.clip(values, 0.0, None))
+
+
+def simulate_batch(spec, start, size, seed_sequence, horizon):
+    """Draws `size` correlated scenarios and writes the portfolio returns into
+    the shared `pnl` array at `start`. Runs in the process pool."""
+    arrays = SharedArrays.attach(spec)
+    try:
+        mean, factor, weights = arrays['mean'], arrays['factor'], arrays['weights']
+        generator = np.random.default_rng(seed_sequence)
+        shocks = generator.standard_normal((size, len(weights)))
+        # portfolio return = w . (mu h + sqrt(h) L z), without materializing the asset returns
+        arrays['pnl'][start:start + size] = mean @ weights * horizon \
+            + np.sqrt(horizon) * (shocks @ (factor.T @ weights))
+    finally:
+        arrays.close()
+    return size
+
+
+def monte_carlo_pnl(returns, weights, scenarios, seed, horizon=1, batch_size=RISK_BATCH_SIZE):
+    """Simulates `scenarios` portfolio returns over `horizon` periods from a
+    multivariate normal fitted to `returns`. The batches are spread over the
+    process pool and every batch has its own child seed, so the result only
+    depends on `seed`, not on how the batches were scheduled."""
+    covariance = np.atleast_2d(np.cov(returns, rowvar=False))
+    batches = [(start, min(batch_size, scenarios - start)) for start in range(0, scenarios, batch_size)]
+    seed_sequences = np.random.SeedSequence(seed).spawn(len(batches))
+
+    with SharedArrays.create(mean=(len(weights),), factor=covariance.shape, weights=(len(weights),),
+                             pnl=(scenarios,)) as arrays:
+        arrays['mean'][:] = returns.mean(axis=0)
+        arrays['factor'][:] = covariance_factor(covariance)
+        arrays['weights'][:] = weights
+
+        pool = get_process_pool()
+        futures = [pool.submit(simulate_batch, arrays.spec, start, size, seed_sequence, horizon)
+                   for (start, size), seed_sequence in zip(batches, seed_sequences)]
+        for future in futures:
+            future.result()
+        return arrays['pnl'].copy()
+
+
+def historical_pnl(returns, weights, horizon=1):
+    """Portfolio returns over every overlapping `horizon` period window of the
+    history, from a cumulative sum of the daily portfolio returns."""
+    daily = returns @ weights
+    if horizon == 1:
+        return daily
+    cumulative = np.concatenate(([0.0], np.cumsum(daily)))
+    return cumulative[horizon:] - cumulative[:-horizon]
+
+
+def value_at_risk(pnl, confidence):
+    """Returns (VaR, CVaR) as positive losses."""
+    threshold = np.quantile(pnl, 1.0 - confidence)
+    tail = pnl[pnl <= threshold]
+    return -threshold, -tail.mean()
+
+
+def portfolio_risk(portfolio_ids=None, start=None, end=None, method='monte_carlo', confidence=0.99,
+                   horizon=1, scenarios=100000, seed=None):
+    """Estimates VaR and CVaR (as fractions of the portfolio value) of the
+    weighted allocation built by `load_allocation`."""
+    allocation = load_allocation(portfolio_ids, start, end)
+    if allocation is None or allocation.benchmark.all():
+        raise ValueError('no price history for the selected portfolios')
+
+    assets = ~allocation.benchmark
+    returns = simple_returns(allocation.prices[:, assets])
+    weights = allocation.weights[assets] / allocation.weights[assets].sum()
+    if len(returns) <= horizon:
+        raise ValueError('not enough price history for the horizon')
+
+    if method == 'monte_carlo':
+        if seed is None:
+            # draw one and report it, so the run can be reproduced
+            seed = int(np.random.SeedSequence().entropy % 2 ** 63)
+        pnl = monte_carlo_pnl(returns, weights, scenarios, seed, horizon)
+    else:
+        pnl = historical_pnl(returns, weights, horizon)
+
+    var, cvar = value_at_risk(pnl, confidence)
+    return {
+        'method': method,
+        'confidence': confidence,
+        'horizon_days': horizon,
+        'scenarios': len(pnl),
+        'seed': seed if method == 'monte_carlo' else None,
+        'observations': len(returns),
+        'portfolio_ids': sorted(set(allocation.portfolio_ids[assets].tolist())),
+        'var': to_float(var),
+        'cvar': to_float(cvar),
+        'mean_return': to_float(pnl.mean()),
+        'volatility': to_float(pnl.std(ddof=1))
+    }
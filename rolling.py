@@ -0,0 +1,136 @@
+import os
+import numpy as np
+from analytics import TRADING_DAYS, load_series_matrix, simple_returns
+from models import Portfolio, db
+
+ROLLING_METRICS = ('volatility', 'correlation', 'beta')
+DEFAULT_ROLLING_WINDOWS = (30, 90, 252)
+MAX_ROLLING_WINDOWS = 8
+# the pairwise correlations grow with the square of the number of series
+MAX_ROLLING_SERIES = int(os.environ.get('MAX_ROLLING_SERIES', 50))
+
+
+class WindowSums:
+    """Cumulative sums of the columns of `values`, from which the sum over any
+    window is a single subtraction, O(n) per window size whatever its length.
+    Sums are aligned with the window's last row, windows that are incomplete
+    or hold a NaN are NaN."""
+
+    def __init__(self, values):
+        valid = ~np.isnan(values)
+        self.cumulative = np.zeros((len(values) + 1,) + values.shape[1:])
+        self.counts = None
+        if valid.all():
+            np.cumsum(values, axis=0, out=self.cumulative[1:])
+        else:
+            np.cumsum(np.where(valid, values, 0.0), axis=0, out=self.cumulative[1:])
+            self.counts = np.zeros(self.cumulative.shape, dtype=np.int64)
+            np.cumsum(valid, axis=0, out=self.counts[1:])
+
+    def __call__(self, window):
+        sums = np.empty(self.cumulative[1:].shape)
+        sums[:window - 1] = np.nan
+        if window < len(self.cumulative):
+            np.subtract(self.cumulative[window:], self.cumulative[:-window], out=sums[window - 1:])
+            if self.counts is not None:
+                sums[window - 1:][self.counts[window:] - self.counts[:-window] < window] = np.nan
+        return sums
+
+
+def centred(values):
+    """Shifts every column by its mean. Variances and covariances don't change,
+    but the running sums stay small and their differences don't cancel out."""
+    counts = (~np.isnan(values)).sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = np.nansum(values, axis=0) / counts
+    return values - np.where(counts > 0, means, 0.0)
+
+
+def rolling_moments(returns, windows, metrics, benchmark=None, periods_per_year=TRADING_DAYS):
+    """Rolling statistics of the columns of `returns` (dates x series, NaN
+    before a series starts) for every window size, vectorized over the
+    series: annualized volatility, the correlation of every pair of columns
+    (in `np.triu_indices` order) and the beta against `benchmark`. Returns
+    {window: {metric: dates x columns array}}."""
+    returns = centred(returns)
+    first, second = np.triu_indices(returns.shape[1], 1)
+    sums = WindowSums(returns)
+    squares = WindowSums(returns ** 2)
+    if 'correlation' in metrics:
+        products = WindowSums(returns[:, first] * returns[:, second])
+    if 'beta' in metrics and benchmark is not None:
+        benchmark = centred(benchmark.reshape(-1, 1))
+        benchmark_sums = WindowSums(benchmark)
+        benchmark_squares = WindowSums(benchmark ** 2)
+        benchmark_products = WindowSums(returns * benchmark)
+
+    results = {}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for window in windows:
+            total = sums(window)
+            mean = total / window
+            variances = np.maximum((squares(window) - total * mean) / (window - 1), 0.0)
+            deviations = np.sqrt(variances)
+            result = results[window] = {}
+            if 'volatility' in metrics:
+                result['volatility'] = deviations * np.sqrt(periods_per_year)
+            if 'correlation' in metrics:
+                # the pair arrays are the big ones, updated in place
+                correlations = products(window)
+                correlations -= mean[:, first] * total[:, second]
+                correlations /= window - 1
+                correlations /= deviations[:, first] * deviations[:, second]
+                result['correlation'] = np.clip(correlations, -1.0, 1.0, out=correlations)
+            if 'beta' in metrics and benchmark is not None:
+                benchmark_total = benchmark_sums(window)
+                benchmark_variance = (benchmark_squares(window) - benchmark_total ** 2 / window) / (window - 1)
+                covariances = (benchmark_products(window) - mean * benchmark_total) / (window - 1)
+                result['beta'] = covariances / benchmark_variance
+    return results
+
+
+def rolling_statistics(portfolio_ids=None, asset_type=None, benchmark=None, windows=DEFAULT_ROLLING_WINDOWS,
+                       metrics=ROLLING_METRICS, start=None, end=None, periods_per_year=TRADING_DAYS):
+    """Rolling statistics of the daily returns of the portfolios' price
+    series (of `asset_type` only, when it is set), aligned on one date axis
+    like `load_allocation` does. `benchmark` is the (portfolio id, asset type)
+    of the series the betas are measured against.
+
+    The result is columnar: the dates, the series and the correlation pairs
+    once, then per window and metric a series (or pair) x dates array, NaN
+    until the window is full. Returns None when there
+    is no data, raises ValueError when more than MAX_ROLLING_SERIES series
+    match.
+    """
+    if portfolio_ids is None:
+        portfolio_ids = [portfolio_id for portfolio_id, in db.session.query(Portfolio.id)]
+    wanted = set(portfolio_ids) | ({benchmark[0]} if benchmark is not None else set())
+    series = load_series_matrix(sorted(wanted), start, end)
+    if series is None:
+        return None
+
+    column_portfolios, column_types, dates, matrix = series
+    keys = list(zip(column_portfolios.tolist(), column_types.tolist()))
+    columns = [column for column, (portfolio_id, name) in enumerate(keys)
+               if portfolio_id in portfolio_ids and (asset_type is None or name == asset_type)]
+    if not columns or (benchmark is not None and tuple(benchmark) not in keys):
+        return None
+    if len(columns) > MAX_ROLLING_SERIES:
+        raise ValueError('{} series, at most {} are allowed'.format(len(columns), MAX_ROLLING_SERIES))
+
+    returns = simple_returns(matrix)
+    benchmark_returns = returns[:, keys.index(tuple(benchmark))] if benchmark is not None else None
+    results = rolling_moments(returns[:, columns], windows, metrics, benchmark_returns, periods_per_year)
+
+    payload = {
+        'dates': dates[1:],
+        'series': [{'portfolio_id': keys[column][0], 'asset_type': keys[column][1]} for column in columns],
+        'benchmark': {'portfolio_id': benchmark[0], 'asset_type': benchmark[1]} if benchmark is not None else None,
+        'windows': {
+            str(window): {metric: values.T for metric, values in result.items()}
+            for window, result in results.items()
+        }
+    }
+    if 'correlation' in metrics:
+        payload['pairs'] = np.column_stack(np.triu_indices(len(columns), 1)).tolist()
+    return payload
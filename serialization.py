@@ -0,0 +1,82 @@
+from datetime import date
+from decimal import Decimal
+import json
+import numpy as np
+from flask import Response, request
+from columnar import COLUMNAR_MIMETYPE, encode as encode_columnar
+from instrumentation import phase
+from models import format_date
+
+JSON_MIMETYPE = 'application/json'
+RESPONSE_MIMETYPES = (JSON_MIMETYPE, COLUMNAR_MIMETYPE)
+
+try:
+    import orjson
+except ImportError:  # optional, the stdlib encoder is used without it
+    orjson = None
+
+
+def nullable(column):
+    """float array -> list, NaN and infinities -> None."""
+    return np.where(np.isfinite(column), column, None).tolist()
+
+
+def format_dates(dates):
+    """datetime64[D] array -> list of DD-MM-YYYY strings."""
+    return [iso[8:10] + '-' + iso[5:7] + '-' + iso[:4] for iso in np.datetime_as_string(dates, unit='D')]
+
+
+def default(value):
+    if isinstance(value, date):
+        return format_date(value)
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, np.ndarray):
+        if np.issubdtype(value.dtype, np.datetime64):
+            return np.reshape(format_dates(value.ravel()), value.shape).tolist()
+        if np.issubdtype(value.dtype, np.floating):
+            return nullable(value)
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError('{!r} is not JSON serializable'.format(value))
+
+
+def dumps(payload):
+    """Encodes `payload` to compact JSON bytes with sorted keys, like
+    `jsonify` does, using orjson when it is installed."""
+    with phase('serialize'):
+        if orjson is not None:
+            return orjson.dumps(payload, default=default, option=orjson.OPT_SORT_KEYS | orjson.OPT_APPEND_NEWLINE
+                                | orjson.OPT_PASSTHROUGH_DATETIME)
+        return (json.dumps(payload, default=default, sort_keys=True, separators=(',', ':')) + '\n').encode('utf-8')
+
+
+def json_response(payload, status=200):
+    """Drop-in for `jsonify(payload), status` on large responses. NumPy
+    arrays in `payload` are written as lists."""
+    return Response(dumps(payload), status=status, mimetype=JSON_MIMETYPE)
+
+
+def negotiated_mimetype(accept_mimetypes=None):
+    """The response format the `Accept` header (of the current request by
+    default) asks for, JSON unless the client prefers the columnar encoding."""
+    if accept_mimetypes is None:
+        accept_mimetypes = request.accept_mimetypes
+    return accept_mimetypes.best_match(RESPONSE_MIMETYPES, default=JSON_MIMETYPE)
+
+
+def wants_columnar():
+    return negotiated_mimetype() == COLUMNAR_MIMETYPE
+
+
+def negotiated_response(payload, status=200):
+    """`json_response`, or the columnar encoding (see `columnar.encode`) of
+    the NumPy arrays in `payload` when the client asks for it."""
+    if wants_columnar():
+        with phase('serialize'):
+            response = Response(encode_columnar(payload), status=status, mimetype=COLUMNAR_MIMETYPE)
+    else:
+        response = json_response(payload, status)
+    response.vary.add('Accept')
+    return response
@@ -0,0 +1,28 @@
+import base64
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+
+def b64url_uint(value):
+    data = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def make_key(kid):
+    """Returns a fresh RS256 signing key as PEM and its public half as a JWK,
+    for the tests and benchmarks that serve their own JWKS."""
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption()).decode('ascii')
+    numbers = key.public_key().public_numbers()
+    jwk = {
+        'kty': 'RSA',
+        'kid': kid,
+        'use': 'sig',
+        'alg': 'RS256',
+        'n': b64url_uint(numbers.n),
+        'e': b64url_uint(numbers.e)
+    }
+    return pem, jwk
@@ -0,0 +1,391 @@
+import atexit, os, threading, time
+import numpy as np
+from sqlalchemy import func, select
+from analytics import series_keys
+from columnar import row_columns
+from corrections import chunked
+from instrumentation import metric_collectors, prefixed
+from models import (AssetPriceHistory, Portfolio, PortfolioSnapshot, PortfolioSnapshotChange, db, format_date,
+                    write_loggers)
+
+# seconds between two background refreshes, 0 leaves it to `flask refresh-snapshots`
+SNAPSHOT_REFRESH_INTERVAL = float(os.environ.get('SNAPSHOT_REFRESH_INTERVAL', 0))
+# price dates computed per pass, bounds the memory of a rebuild
+SNAPSHOT_CHUNK_DAYS = int(os.environ.get('SNAPSHOT_CHUNK_DAYS', 250))
+# PostgreSQL advisory lock held by the process refreshing the snapshots
+SNAPSHOT_LOCK_KEY = 0x736e6170
+
+price_table = AssetPriceHistory.__table__
+portfolio_table = Portfolio.__table__
+snapshot_table = PortfolioSnapshot.__table__
+change_table = PortfolioSnapshotChange.__table__
+SNAPSHOT_COLUMNS = ('date', 'portfolio_id', 'asset_type', 'price', 'price_date', 'weight', 'benchmark')
+# a portfolio update only changes its snapshots through these
+WEIGHT_COLUMNS = {'weight', 'benchmark_desc'}
+
+
+def empty_snapshot():
+    return (np.array([], dtype='datetime64[D]'), np.array([], dtype=np.int64), np.array([], dtype=object),
+            np.array([], dtype=np.float64), np.array([], dtype='datetime64[D]'), np.array([], dtype=np.float64),
+            np.array([], dtype=bool))
+
+
+def snapshot_rows(dates, carried, rows, portfolios):
+    """Snapshots of the sorted price dates `dates` (datetime64[D]).
+
+    `carried` holds the (portfolio ids, asset types, prices, price dates) of
+    the snapshot before dates[0], `rows` the (portfolio ids, asset types,
+    dates, prices) price rows from dates[0] on, sorted by date and id so the
+    last price of a day wins. `portfolios` maps a portfolio id to its
+    (weight, benchmark_desc), series of other portfolios are left out.
+
+    A series is valued from its first price on. Like in `load_allocation`
+    the portfolio weight is split evenly between its series, its benchmark
+    series apart from the others, counting the series priced that day.
+    Returns the SNAPSHOT_COLUMNS arrays ordered by date, portfolio id and
+    asset type.
+    """
+    carried_ids, carried_types, carried_prices, carried_dates = carried
+    row_ids, row_types, row_dates, row_prices = rows
+    portfolio_ids = np.concatenate([carried_ids, row_ids])
+    known = np.isin(portfolio_ids, list(portfolios))
+    if len(dates) == 0 or not known.any():
+        return empty_snapshot()
+
+    column_index, column_portfolios, column_types = series_keys(
+        portfolio_ids[known], np.concatenate([carried_types, row_types])[known])
+    carried_known = known[:len(carried_ids)]
+    row_known = known[len(carried_ids):]
+    carried_columns = column_index[:carried_known.sum()]
+    row_columns = column_index[carried_known.sum():]
+
+    # row 0 holds the carried values, forward filled together with the prices
+    prices = np.full((len(dates) + 1, len(column_portfolios)), np.nan)
+    price_dates = np.full(prices.shape, np.datetime64('NaT'), dtype='datetime64[D]')
+    prices[0, carried_columns] = carried_prices[carried_known]
+    price_dates[0, carried_columns] = carried_dates[carried_known]
+    positions = np.searchsorted(dates, row_dates[row_known]) + 1
+    prices[positions, row_columns] = row_prices[row_known]
+    price_dates[positions, row_columns] = row_dates[row_known]
+
+    index = np.where(np.isnan(prices), 0, np.arange(len(prices))[:, None])
+    np.maximum.accumulate(index, axis=0, out=index)
+    columns = np.arange(prices.shape[1])
+    prices = prices[index, columns][1:]
+    price_dates = price_dates[index, columns][1:]
+    priced = ~np.isnan(prices)
+
+    owners = column_portfolios.tolist()
+    weights = np.array([portfolios[portfolio_id][0] for portfolio_id in owners], dtype=np.float64)
+    benchmark = np.array([asset_type == portfolios[portfolio_id][1]
+                          for portfolio_id, asset_type in zip(owners, column_types)], dtype=bool)
+    # number of series sharing each column's weight that day
+    _, group = np.unique(column_portfolios * 2 + benchmark, return_inverse=True)
+    group = group.reshape(-1)
+    order = np.argsort(group, kind='stable')
+    starts = np.flatnonzero(np.r_[True, group[order][1:] != group[order][:-1]])
+    counts = np.add.reduceat(priced[:, order].astype(np.int64), starts, axis=1)[:, group]
+
+    days, cells = np.nonzero(priced)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        shares = weights[cells] / counts[days, cells]
+    return (dates[days], column_portfolios[cells], column_types[cells], prices[days, cells],
+            price_dates[days, cells], shares, benchmark[cells])
+
+
+def date_range(column, first=None, stop=None):
+    """WHERE conditions of `column` in [first, stop), None is unbounded."""
+    filters = []
+    if first is not None:
+        filters.append(column >= first)
+    if stop is not None:
+        filters.append(column < stop)
+    return filters
+
+
+def load_dates(first=None, stop=None):
+    """The sorted price dates in [first, stop), the days snapshots exist for."""
+    statement = select(price_table.c.date).distinct() \
+        .where(price_table.c.portfolio_id.isnot(None), *date_range(price_table.c.date, first, stop)) \
+        .order_by(price_table.c.date)
+    return np.array([value for value, in db.session.execute(statement)], dtype='datetime64[D]')
+
+
+def load_carried(before, portfolio_ids=None):
+    """Series values of the last snapshot day before `before`."""
+    latest = select(func.max(snapshot_table.c.date)).where(snapshot_table.c.date < before).scalar_subquery()
+    statement = select(snapshot_table.c.portfolio_id, snapshot_table.c.asset_type, snapshot_table.c.price,
+                       snapshot_table.c.price_date) \
+        .where(snapshot_table.c.date == latest)
+    if portfolio_ids is not None:
+        statement = statement.where(snapshot_table.c.portfolio_id.in_(portfolio_ids))
+    rows = db.session.execute(statement).fetchall()
+    if not rows:
+        return (np.array([], dtype=np.int64), np.array([], dtype=object), np.array([], dtype=np.float64),
+                np.array([], dtype='datetime64[D]'))
+
+    portfolio_ids, asset_types, prices, price_dates = zip(*rows)
+    return (np.array(portfolio_ids, dtype=np.int64), np.array(asset_types, dtype=object),
+            np.array(prices, dtype=np.float64), np.array(price_dates, dtype='datetime64[D]'))
+
+
+def load_prices(first, stop=None, portfolio_ids=None):
+    """Price rows in [first, stop) sorted by date and id."""
+    statement = select(price_table.c.portfolio_id, price_table.c.asset_type, price_table.c.date,
+                       price_table.c.price) \
+        .where(price_table.c.portfolio_id.isnot(None), *date_range(price_table.c.date, first, stop)) \
+        .order_by(price_table.c.date, price_table.c.id)
+    if portfolio_ids is not None:
+        statement = statement.where(price_table.c.portfolio_id.in_(portfolio_ids))
+    rows = db.session.execute(statement).fetchall()
+    if not rows:
+        return (np.array([], dtype=np.int64), np.array([], dtype=object), np.array([], dtype='datetime64[D]'),
+                np.array([], dtype=np.float64))
+
+    portfolio_ids, asset_types, dates, prices = zip(*rows)
+    return (np.array(portfolio_ids, dtype=np.int64), np.array(asset_types, dtype=object),
+            np.array(dates, dtype='datetime64[D]'), np.array(prices, dtype=np.float64))
+
+
+def snapshot_as_of_statement(as_of, portfolio_ids=None):
+    """Selects the rows (SNAPSHOT_COLUMNS) of the last snapshot day at or
+    before `as_of`, one lookup on the (date, portfolio_id, asset_type)
+    primary key."""
+    latest = select(func.max(snapshot_table.c.date)).where(snapshot_table.c.date <= as_of).scalar_subquery()
+    statement = select(*(snapshot_table.c[name] for name in SNAPSHOT_COLUMNS)) \
+        .where(snapshot_table.c.date == latest) \
+        .order_by(snapshot_table.c.portfolio_id, snapshot_table.c.asset_type)
+    if portfolio_ids is not None:
+        statement = statement.where(snapshot_table.c.portfolio_id.in_(portfolio_ids))
+    return statement
+
+
+def snapshot_as_of(as_of, portfolio_ids=None):
+    return db.session.execute(snapshot_as_of_statement(as_of, portfolio_ids)).fetchall()
+
+
+def snapshot_payload(rows, columnar=False):
+    """Response payload of the rows of one snapshot day, the valuations as
+    columns for the columnar encoding."""
+    fields = SNAPSHOT_COLUMNS[1:]
+    if columnar:
+        valuations = row_columns(snapshot_table, fields, [row[1:] for row in rows])
+    else:
+        valuations = [dict(zip(fields, row[1:]), price_date=format_date(row.price_date)) for row in rows]
+    return {
+        'success': True,
+        'date': format_date(rows[0].date),
+        'valuations': valuations
+    }
+
+
+def merge_windows(windows):
+    """Merges overlapping [first, stop) date windows, a stop of None is open-ended."""
+    merged = []
+    for first, stop in sorted(windows, key=lambda window: window[0]):
+        if merged and (merged[-1][1] is None or first <= merged[-1][1]):
+            previous_stop = merged[-1][1]
+            merged[-1] = (merged[-1][0], None if previous_stop is None or stop is None else max(previous_stop, stop))
+        else:
+            merged.append((first, stop))
+    return merged
+
+
+class Snapshots:
+    """Keeps portfolio_snapshots in step with the prices and portfolios.
+
+    Writes are logged to portfolio_snapshot_changes by the write logger, in
+    their own transaction, so a committed write is always logged. `refresh`, run by `flask refresh-snapshots` or every
+    SNAPSHOT_REFRESH_INTERVAL seconds by a background thread, recomputes
+    only the days the logged writes affect: a price written for a series on
+    day d changes every snapshot from d up to that series' next price, a
+    portfolio's weight or benchmark its rows on every day. Each pass starts
+    from the values of the snapshot before it.
+    """
+
+    def __init__(self, interval=SNAPSHOT_REFRESH_INTERVAL, chunk_days=SNAPSHOT_CHUNK_DAYS):
+        self.interval = interval
+        self.chunk_days = chunk_days
+        self.app = None
+        self.refreshes = 0
+        self.failures = 0
+        self.changes_logged = 0
+        self.days_refreshed = 0
+        self.rows_written = 0
+        self.last_refresh_seconds = 0.0
+        self._thread = None
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        if self.interval > 0:
+            self.start()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='snapshot-refresh', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            try:
+                with self.app.app_context():
+                    self.refresh()
+            except Exception:
+                # counted in failures, the changes stay logged for the next run
+                pass
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stopping.set()
+        self._thread.join()
+        self._thread = None
+
+    def log_changes(self, table_name, action, changes):
+        """Logs the days a write affects in the write's transaction, the
+        caller commits."""
+        ranges = {}
+
+        def touch(key, value):
+            first, last = ranges.get(key, (value, value))
+            ranges[key] = (min(first, value), max(last, value))
+
+        if table_name == Portfolio.__tablename__:
+            for change in changes:
+                # the previous values are missing when the attributes were expired before the change
+                previous = change.get('previous')
+                if action == 'delete' or (action == 'update' and (not previous or WEIGHT_COLUMNS & set(previous))):
+                    ranges[change['id'], None] = (None, None)
+        elif table_name == AssetPriceHistory.__tablename__:
+            for change in changes:
+                if change.get('portfolio_id') is not None:
+                    touch((change['portfolio_id'], change['asset_type']), change['date'])
+                previous = change.get('previous')
+                if previous:
+                    key = (previous.get('portfolio_id', change['portfolio_id']),
+                           previous.get('asset_type', change['asset_type']))
+                    if key[0] is not None:
+                        touch(key, previous.get('date', change['date']))
+                elif action == 'update':
+                    # the previous values are missing when the attributes were
+                    # expired before the change, the row may have come from any series
+                    ranges[None, None] = (None, None)
+        if not ranges:
+            return
+        db.session.execute(change_table.insert(), [
+            {'portfolio_id': portfolio_id, 'asset_type': asset_type, 'first': first, 'last': last}
+            for (portfolio_id, asset_type), (first, last) in ranges.items()])
+        self.changes_logged += len(ranges)
+
+    def refresh_range(self, portfolios, first=None, stop=None, portfolio_ids=None):
+        """Recomputes the snapshots of the days in [first, stop), of
+        `portfolio_ids` only when set. The caller commits. Returns the
+        number of days and rows written."""
+        filters = date_range(snapshot_table.c.date, first, stop)
+        if portfolio_ids is not None:
+            filters.append(snapshot_table.c.portfolio_id.in_(portfolio_ids))
+        statement = snapshot_table.delete()
+        db.session.execute(statement.where(*filters) if filters else statement)
+
+        dates = load_dates(first, stop)
+        written = 0
+        for start in range(0, len(dates), self.chunk_days):
+            chunk = dates[start:start + self.chunk_days]
+            chunk_stop = dates[start + self.chunk_days].item() if start + self.chunk_days < len(dates) else stop
+            columns = snapshot_rows(chunk, load_carried(chunk[0].item(), portfolio_ids),
+                                    load_prices(chunk[0].item(), chunk_stop, portfolio_ids), portfolios)
+            if len(columns[0]):
+                db.session.execute(snapshot_table.insert(), [
+                    dict(zip(SNAPSHOT_COLUMNS, row)) for row in zip(*(column.tolist() for column in columns))])
+            written += len(columns[0])
+        return len(dates), written
+
+    def price_windows(self, changes):
+        """[first, stop) windows of the days the price changes affect."""
+        ranges = {}
+        for _, portfolio_id, asset_type, first, last in changes:
+            previous = ranges.get((portfolio_id, asset_type))
+            ranges[portfolio_id, asset_type] = (first, last) if previous is None else \
+                (min(previous[0], first), max(previous[1], last))
+
+        windows = []
+        for (portfolio_id, asset_type), (first, last) in ranges.items():
+            stop = db.session.execute(
+                select(func.min(price_table.c.date))
+                .where(price_table.c.portfolio_id == portfolio_id, price_table.c.asset_type == asset_type,
+                       price_table.c.date > last)).scalar()
+            windows.append((first, stop))
+        return merge_windows(windows)
+
+    def try_lock(self):
+        if db.session.connection().dialect.name != 'postgresql':
+            return True
+        return db.session.execute(select(func.pg_try_advisory_xact_lock(SNAPSHOT_LOCK_KEY))).scalar()
+
+    def refresh(self, full=False):
+        """Applies the logged changes, or recomputes every snapshot with
+        `full`, in one transaction. Returns the number of changes applied
+        and of days and rows written, None when another process holds the
+        refresh lock."""
+        with self._lock:
+            started = time.monotonic()
+            try:
+                if not self.try_lock():
+                    db.session.rollback()
+                    return None
+                changes = db.session.execute(
+                    select(change_table.c.id, change_table.c.portfolio_id, change_table.c.asset_type,
+                           change_table.c.first, change_table.c.last).order_by(change_table.c.id)).fetchall()
+                portfolios = {portfolio_id: (weight, benchmark_desc) for portfolio_id, weight, benchmark_desc
+                              in db.session.execute(select(portfolio_table.c.id, portfolio_table.c.weight,
+                                                           portfolio_table.c.benchmark_desc))}
+
+                passes = []
+                if full or any(change.portfolio_id is None for change in changes):
+                    passes.append((None, None, None))
+                else:
+                    passes += [(first, stop, None) for first, stop in
+                               self.price_windows([change for change in changes if change.asset_type is not None])]
+                    # after the price windows, which may carry their stale weights
+                    scoped = sorted({change.portfolio_id for change in changes if change.asset_type is None})
+                    if scoped:
+                        passes.append((None, None, scoped))
+
+                days = rows = 0
+                for first, stop, portfolio_ids in passes:
+                    written = self.refresh_range(portfolios, first, stop, portfolio_ids)
+                    days += written[0]
+                    rows += written[1]
+                # by id, changes logged meanwhile stay for the next refresh
+                for ids in chunked([change.id for change in changes], 1000):
+                    db.session.execute(change_table.delete().where(change_table.c.id.in_(ids)))
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                self.failures += 1
+                raise
+            self.refreshes += 1
+            self.days_refreshed += days
+            self.rows_written += rows
+            self.last_refresh_seconds = time.monotonic() - started
+            return {'changes': len(changes), 'days': days, 'rows': rows}
+
+    def stats(self):
+        return {
+            'refreshes': self.refreshes,
+            'failures': self.failures,
+            'changes_logged': self.changes_logged,
+            'days_refreshed': self.days_refreshed,
+            'rows_written': self.rows_written,
+            'last_refresh_seconds': round(self.last_refresh_seconds, 6)
+        }
+
+
+snapshots = Snapshots()
+write_loggers.append(snapshots.log_changes)
+metric_collectors.append(lambda: prefixed('snapshots', snapshots.stats()))
@@ -0,0 +1,264 @@
+from collections import OrderedDict
+import math, os, threading
+from analytics import TRADING_DAYS, drawdowns, load_price_rows, simple_returns, split_series, to_float
+from instrumentation import metric_collectors, prefixed
+from models import AssetPriceHistory, Portfolio, format_date, table_versions, write_listeners
+
+STATS_CACHE_SIZE = int(os.environ.get('STATS_CACHE_SIZE', 1024))
+
+
+class SeriesStats:
+    """Running statistics of one price series.
+
+    Everything `performance_stats` reports can be derived from this state, and
+    appending a newer price updates it in O(1): the simple returns are tracked
+    with Welford's algorithm, the drawdown with the running maximum and the
+    index of the last peak.
+    """
+
+    def __init__(self, date, price):
+        self.first_date = date
+        self.first_price = price
+        self.last_date = date
+        self.last_price = price
+        self.count = 1
+        self.return_mean = 0.0
+        self.return_m2 = 0.0
+        self.running_max = price
+        self.peak_index = 0
+        self.max_drawdown = 0.0
+        self.max_drawdown_duration = 0
+
+    @classmethod
+    def from_prices(cls, dates, prices):
+        """Builds the state from a whole series (sorted by date) with array
+        operations."""
+        stats = cls(dates[0].item(), float(prices[0]))
+        if len(prices) == 1:
+            return stats
+
+        returns = simple_returns(prices)
+        drawdown, duration = drawdowns(prices)
+        stats.last_date = dates[-1].item()
+        stats.last_price = float(prices[-1])
+        stats.count = len(prices)
+        stats.return_mean = float(returns.mean())
+        stats.return_m2 = float(((returns - stats.return_mean) ** 2).sum())
+        stats.running_max = float(prices.max())
+        stats.peak_index = int(len(prices) - 1 - duration[-1])
+        stats.max_drawdown = float(drawdown.min())
+        stats.max_drawdown_duration = int(duration.max())
+        return stats
+
+    def append(self, date, price):
+        value = price / self.last_price - 1.0
+        returns = self.count
+        delta = value - self.return_mean
+        self.return_mean += delta / returns
+        self.return_m2 += delta * (value - self.return_mean)
+
+        index = self.count
+        self.count += 1
+        self.last_date = date
+        self.last_price = price
+        if price >= self.running_max:
+            self.running_max = price
+            self.peak_index = index
+        self.max_drawdown = min(self.max_drawdown, price / self.running_max - 1.0)
+        self.max_drawdown_duration = max(self.max_drawdown_duration, index - self.peak_index)
+
+    def snapshot(self, periods_per_year=TRADING_DAYS, risk_free=0.0):
+        stats = {
+            'start': format_date(self.first_date),
+            'end': format_date(self.last_date),
+            'observations': self.count,
+            'cumulative_return': None,
+            'annualized_return': None,
+            'mean_simple_return': None,
+            'mean_log_return': None,
+            'annualized_volatility': None,
+            'sharpe_ratio': None,
+            'max_drawdown': None,
+            'max_drawdown_duration': None
+        }
+        returns = self.count - 1
+        if returns < 1:
+            return stats
+
+        total_log_return = math.log(self.last_price / self.first_price)
+        volatility = math.sqrt(self.return_m2 / (returns - 1) * periods_per_year) if returns > 1 else math.nan
+        sharpe = (self.return_mean * periods_per_year - risk_free) / volatility if volatility else math.nan
+        stats.update({
+            'cumulative_return': to_float(self.last_price / self.first_price - 1.0),
+            'annualized_return': to_float(math.exp(total_log_return * periods_per_year / returns) - 1.0),
+            'mean_simple_return': to_float(self.return_mean),
+            'mean_log_return': to_float(total_log_return / returns),
+            'annualized_volatility': to_float(volatility),
+            'sharpe_ratio': to_float(sharpe),
+            'max_drawdown': to_float(self.max_drawdown),
+            'max_drawdown_duration': self.max_drawdown_duration
+        })
+        return stats
+
+
+def price_version():
+    return table_versions(AssetPriceHistory.__tablename__)[0]
+
+
+def load_portfolio_stats(portfolio_id):
+    asset_types, dates, prices = load_price_rows([AssetPriceHistory.portfolio_id == portfolio_id])
+    return {asset_type: SeriesStats.from_prices(series_dates, series_prices)
+            for asset_type, (series_dates, series_prices) in split_series(asset_types, dates, prices).items()}
+
+
+class StatsCache:
+    """Bounded LRU of per-portfolio `SeriesStats`, keyed by portfolio id.
+
+    Appending a newer price to a cached series updates it in place, any other
+    change to a portfolio's prices drops that portfolio only.
+
+    Every entry remembers the shared version of the price table it reflects
+    (see `models.bump_versions`) and is only served while that is current.
+    The listeners of this process only see its own writes: a write moves the
+    entries of the version right before the one it committed on to that
+    version, the entries of any older version are dropped, so the writes of
+    other workers and processes are never missed.
+    """
+
+    def __init__(self, maxsize=STATS_CACHE_SIZE, loader=load_portfolio_stats, version=price_version):
+        self.maxsize = maxsize
+        self.loader = loader
+        self.version = version
+        self.entries = OrderedDict()
+        self.versions = {}
+        # bumped on every invalidation, so a load that raced with a write is not stored
+        self.generations = {}
+        self.hits = 0
+        self.misses = 0
+        self.recomputes = 0
+        self.incremental_updates = 0
+        self.invalidations = 0
+        self.stale = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def get(self, portfolio_id):
+        # read before the prices, a write in between leaves the entry stale
+        version = self.version()
+        with self._lock:
+            entry = self.entries.get(portfolio_id)
+            if entry is not None and self.versions[portfolio_id] == version:
+                self.entries.move_to_end(portfolio_id)
+                self.hits += 1
+                return entry
+            if entry is not None:
+                self._drop(portfolio_id)
+                self.stale += 1
+            self.misses += 1
+            generation = self.generations.get(portfolio_id, 0)
+
+        entry = self.loader(portfolio_id)
+
+        with self._lock:
+            self.recomputes += 1
+            if self.generations.get(portfolio_id, 0) == generation:
+                self.entries[portfolio_id] = entry
+                self.versions[portfolio_id] = version
+                while len(self.entries) > self.maxsize:
+                    evicted, _ = self.entries.popitem(last=False)
+                    del self.versions[evicted]
+                    self.evictions += 1
+        return entry
+
+    def _drop(self, portfolio_id):
+        self.generations[portfolio_id] = self.generations.get(portfolio_id, 0) + 1
+        del self.entries[portfolio_id]
+        del self.versions[portfolio_id]
+
+    def invalidate(self, portfolio_id):
+        with self._lock:
+            self.generations[portfolio_id] = self.generations.get(portfolio_id, 0) + 1
+            if self.entries.pop(portfolio_id, None) is not None:
+                del self.versions[portfolio_id]
+                self.invalidations += 1
+
+    def append(self, portfolio_id, asset_type, date, price):
+        with self._lock:
+            entry = self.entries.get(portfolio_id)
+            if entry is None:
+                # nothing cached, but a load may be in flight
+                self.generations[portfolio_id] = self.generations.get(portfolio_id, 0) + 1
+                return
+
+            series = entry.get(asset_type)
+            if series is None:
+                entry[asset_type] = SeriesStats(date, price)
+            elif date > series.last_date and series.last_price > 0:
+                series.append(date, price)
+            else:
+                # an older point was back-filled, the running state can't absorb it
+                self._drop(portfolio_id)
+                self.invalidations += 1
+                return
+            self.incremental_updates += 1
+
+    def clear(self):
+        with self._lock:
+            for portfolio_id in self.entries:
+                self.generations[portfolio_id] = self.generations.get(portfolio_id, 0) + 1
+            self.entries.clear()
+            self.versions.clear()
+
+    def on_write(self, table_name, action, changes, version=None):
+        if table_name == Portfolio.__tablename__:
+            if action == 'delete':
+                for change in changes:
+                    self.invalidate(change['id'])
+            return
+
+        if table_name != AssetPriceHistory.__tablename__:
+            return
+        if version is None:
+            # can't tell which entries the write follows
+            self.clear()
+            return
+        with self._lock:
+            # entries of a version after this write already hold it
+            for portfolio_id in [portfolio_id for portfolio_id, entry_version in self.versions.items()
+                                 if entry_version < version - 1]:
+                self._drop(portfolio_id)
+            behind = {portfolio_id: self.entries[portfolio_id] for portfolio_id, entry_version
+                      in self.versions.items() if entry_version == version - 1}
+        for change in changes:
+            if action == 'insert':
+                if self.versions.get(change['portfolio_id'], version - 1) == version - 1:
+                    self.append(change['portfolio_id'], change['asset_type'], change['date'], change['price'])
+            else:
+                self.invalidate(change['portfolio_id'])
+                previous = change.get('previous', {})
+                if 'portfolio_id' in previous:
+                    self.invalidate(previous['portfolio_id'])
+                elif action == 'update' and not previous:
+                    # the changed columns are unknown, the row may have left another portfolio
+                    self.clear()
+        with self._lock:
+            for portfolio_id, entry in behind.items():
+                if self.entries.get(portfolio_id) is entry:
+                    self.versions[portfolio_id] = version
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'recomputes': self.recomputes,
+            'incremental_updates': self.incremental_updates,
+            'invalidations': self.invalidations,
+            'stale': self.stale,
+            'evictions': self.evictions,
+            'size': len(self.entries)
+        }
+
+
+stats_cache = StatsCache()
+write_listeners.append(stats_cache.on_write)
+metric_collectors.append(lambda: prefixed('stats_cache', stats_cache.stats()))
@@ -0,0 +1,193 @@
+import unittest, os
+
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+import numpy as np
+from analytics import (align_prices, blend, drawdowns, forward_fill, log_returns, performance_stats,
+                       relative_metrics, series_keys, simple_returns, split_series)
+from stats_cache import SeriesStats, StatsCache
+
+
+class AnalyticsTestCase(unittest.TestCase):
+    """This class represents the analytics test case"""
+
+    def setUp(self):
+        self.prices = np.array([100.0, 110.0, 99.0, 88.0, 120.0, 108.0])
+
+    def test_returns(self):
+        np.testing.assert_allclose(simple_returns(self.prices)[:2], [0.1, -0.1])
+        np.testing.assert_allclose(log_returns(self.prices).sum(), np.log(108.0 / 100.0))
+
+    def test_drawdowns(self):
+        drawdown, duration = drawdowns(self.prices)
+
+        np.testing.assert_allclose(drawdown, [0.0, 0.0, -0.1, -0.2, 0.0, -0.1])
+        np.testing.assert_array_equal(duration, [0, 0, 1, 2, 0, 1])
+
+    def test_performance_stats(self):
+        stats = performance_stats(self.prices, periods_per_year=252)
+        simple = simple_returns(self.prices)
+
+        self.assertEqual(stats['observations'], 6)
+        self.assertAlmostEqual(stats['cumulative_return'], 0.08)
+        self.assertAlmostEqual(stats['max_drawdown'], -0.2)
+        self.assertEqual(stats['max_drawdown_duration'], 2)
+        self.assertAlmostEqual(stats['annualized_volatility'], simple.std(ddof=1) * np.sqrt(252))
+        self.assertAlmostEqual(stats['sharpe_ratio'], simple.mean() * 252 / stats['annualized_volatility'])
+
+    def test_performance_stats_single_price(self):
+        stats = performance_stats([100.0])
+
+        self.assertEqual(stats['observations'], 1)
+        self.assertIsNone(stats['annualized_volatility'])
+
+    def test_split_series(self):
+        keys = np.array(['Bond', 'Bond', 'Equity'], dtype=object)
+        series = split_series(keys, np.array([1.0, 2.0, 3.0]))
+
+        self.assertEqual(list(series), ['Bond', 'Equity'])
+        np.testing.assert_array_equal(series['Bond'][0], [1.0, 2.0])
+
+    def test_forward_fill(self):
+        matrix = np.array([[np.nan, 1.0], [2.0, np.nan], [np.nan, np.nan], [3.0, 4.0]])
+
+        np.testing.assert_array_equal(forward_fill(matrix),
+                                      [[np.nan, 1.0], [2.0, 1.0], [2.0, 1.0], [3.0, 4.0]])
+
+    def test_align_prices(self):
+        column_index, portfolios, types = series_keys(np.array([2, 1, 2]), np.array(['Bond', 'Bond', 'Bond'], dtype=object))
+        dates = np.array(['2020-01-03', '2020-01-02', '2020-01-02'], dtype='datetime64[D]')
+        date_axis, matrix = align_prices(column_index, dates, np.array([11.0, 20.0, 10.0]), len(portfolios))
+
+        np.testing.assert_array_equal(portfolios, [1, 2])
+        np.testing.assert_array_equal(date_axis, np.array(['2020-01-02', '2020-01-03'], dtype='datetime64[D]'))
+        np.testing.assert_array_equal(matrix, [[20.0, 10.0], [20.0, 11.0]])
+
+    def test_blend(self):
+        matrix = np.array([[10.0, 100.0], [11.0, 90.0]])
+
+        np.testing.assert_allclose(blend(matrix, np.array([3.0, 1.0])), [1.0, 0.75 * 1.1 + 0.25 * 0.9])
+
+    def test_relative_metrics(self):
+        benchmark = np.array([100.0, 101.0, 99.0, 102.0, 103.0])
+        nav = benchmark / benchmark[0]
+        metrics = relative_metrics(nav, benchmark)
+
+        self.assertAlmostEqual(metrics['active_return'], 0.0)
+        self.assertAlmostEqual(metrics['tracking_error'], 0.0)
+        self.assertAlmostEqual(metrics['beta'], 1.0)
+
+
+
+class StatsCacheTestCase(unittest.TestCase):
+    """This class represents the incremental analytics cache test case"""
+
+    def setUp(self):
+        self.dates = np.arange(np.datetime64('2020-01-01'), np.datetime64('2020-01-07'))
+        self.prices = np.array([100.0, 110.0, 99.0, 88.0, 120.0, 108.0])
+        self.loads = 0
+        self.version = 7
+        self.cache = StatsCache(maxsize=2, loader=self.load, version=lambda: self.version)
+
+    def load(self, portfolio_id):
+        self.loads += 1
+        return {'Bond': SeriesStats.from_prices(self.dates[:4], self.prices[:4])}
+
+    def test_append_matches_full_recompute(self):
+        series = SeriesStats.from_prices(self.dates[:2], self.prices[:2])
+        for date, price in zip(self.dates[2:], self.prices[2:]):
+            series.append(date.item(), float(price))
+
+        expected = performance_stats(self.prices)
+        snapshot = series.snapshot()
+        for name, value in expected.items():
+            self.assertAlmostEqual(snapshot[name], value, msg=name)
+
+    def test_hits_and_incremental_updates(self):
+        self.cache.get(1)
+        self.cache.append(1, 'Bond', self.dates[4].item(), 120.0)
+        entry = self.cache.get(1)
+
+        self.assertEqual(self.loads, 1)
+        self.assertEqual(entry['Bond'].count, 5)
+        self.assertEqual(self.cache.stats()['incremental_updates'], 1)
+
+    def test_write_of_this_process_is_applied(self):
+        self.cache.get(1)
+        self.cache.get(2)
+        self.version += 1
+        self.cache.on_write('asset_price_histories', 'insert', [{
+            'portfolio_id': 1, 'asset_type': 'Bond', 'date': self.dates[4].item(), 'price': 120.0
+        }], self.version)
+
+        self.assertEqual(self.cache.get(1)['Bond'].count, 5)
+        self.assertEqual(self.cache.get(2)['Bond'].count, 4)
+        self.assertEqual(self.loads, 2)
+
+    def test_write_of_another_process_right_after_this_one_reloads(self):
+        self.cache.get(1)
+        # this process committed version 8, another one 9 before the listeners ran
+        self.version += 2
+        self.cache.on_write('asset_price_histories', 'insert', [{
+            'portfolio_id': 1, 'asset_type': 'Bond', 'date': self.dates[4].item(), 'price': 120.0
+        }], self.version - 1)
+
+        self.assertEqual(self.cache.versions[1], self.version - 1)
+        self.cache.get(1)
+        self.assertEqual(self.loads, 2)
+
+    def test_write_of_unknown_version_clears(self):
+        self.cache.get(1)
+        self.version += 1
+        self.cache.on_write('asset_price_histories', 'insert', [{
+            'portfolio_id': 1, 'asset_type': 'Bond', 'date': self.dates[4].item(), 'price': 120.0
+        }])
+
+        self.assertEqual(len(self.cache.entries), 0)
+
+    def test_write_of_another_process_reloads(self):
+        self.cache.get(1)
+        self.version += 1
+        self.cache.get(1)
+
+        self.assertEqual(self.loads, 2)
+        self.assertEqual(self.cache.stats()['stale'], 1)
+
+    def test_update_without_previous_values_clears(self):
+        self.cache.get(1)
+        self.cache.get(2)
+        self.version += 1
+        self.cache.on_write('asset_price_histories', 'update', [{
+            'portfolio_id': 1, 'asset_type': 'Bond', 'date': self.dates[0].item(), 'price': 1.0, 'previous': {}
+        }], self.version)
+
+        self.assertEqual(len(self.cache.entries), 0)
+
+    def test_backfill_invalidates(self):
+        self.cache.get(1)
+        self.version += 1
+        self.cache.on_write('asset_price_histories', 'insert', [{
+            'portfolio_id': 1, 'asset_type': 'Bond', 'date': self.dates[0].item(), 'price': 1.0
+        }], self.version)
+        self.cache.get(1)
+
+        self.assertEqual(self.loads, 2)
+
+    def test_invalidation_is_per_portfolio(self):
+        self.cache.get(1)
+        self.cache.get(2)
+        self.cache.on_write('portfolios', 'delete', [{'id': 1}])
+
+        self.assertNotIn(1, self.cache.entries)
+        self.assertIn(2, self.cache.entries)
+
+    def test_lru_eviction(self):
+        for portfolio_id in (1, 2, 3):
+            self.cache.get(portfolio_id)
+
+        self.assertEqual(list(self.cache.entries), [2, 3])
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
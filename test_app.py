@@ -1,6 +1,10 @@
-import unittest, json, os
-from app import app
-from models import AssetPriceHistory, Portfolio
+import unittest, json, os, time
+from datetime import date
+from app import create_app
+from columnar import COLUMNAR_MIMETYPE, decode
+from models import AssetPriceHistory, Portfolio, bump_versions, db
+from snapshots import snapshots
+from workers import JOB_HEARTBEAT_INTERVAL, JOB_MISSED_HEARTBEATS, JobRegistry, job_table
 
 USER_TOKEN = os.environ['USER_TOKEN']
 ADMIN_TOKEN = os.environ['ADMIN_TOKEN']
@@ -8,9 +12,17 @@ ADMIN_TOKEN = os.environ['ADMIN_TOKEN']
 class CapstoneTestCase(unittest.TestCase):
     """This class represents the capstone test case"""
 
+    @classmethod
+    def setUpClass(cls):
+        """Create the app once, the schema is created on its database."""
+        cls.app = create_app()
+        with cls.app.app_context():
+            db.create_all()
+
     def setUp(self):
         """Define test variables and initialize app."""
-        self.app = app
+        self.context = self.app.app_context()
+        self.context.push()
         self.client = self.app.test_client
 
         self.portfolio = Portfolio('Some class', 0.4, 'Some benchmark description', 22, 'Some bloomberg query')
@@ -25,6 +37,7 @@ class CapstoneTestCase(unittest.TestCase):
         if self.asset_price_history:
             self.asset_price_history.delete()
         self.portfolio.delete()
+        self.context.pop()
 
         
     def test_get_portfolios_without_token(self):
@@ -70,6 +83,170 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertTrue(len(data['asset_price_histories']))
 
 
+    def test_get_asset_price_histories_paginated(self):
+        second = AssetPriceHistory('Bond', 235.1, '03-02-2002', self.portfolio.id)
+        second.insert()
+
+        res = self.client().get('/asset_price_histories?limit=1&fields=price', headers={
+            'Authorization': "Bearer {}".format(USER_TOKEN)
+        })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['asset_price_histories']), 1)
+        self.assertEqual(set(data['asset_price_histories'][0]), {'id', 'price'})
+        self.assertTrue(data['next_cursor'])
+
+        res = self.client().get('/asset_price_histories?limit=1&after={}'.format(data['next_cursor']), headers={
+            'Authorization': "Bearer {}".format(USER_TOKEN)
+        })
+        next_page = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertGreater(next_page['asset_price_histories'][0]['id'], data['asset_price_histories'][0]['id'])
+        second.delete()
+
+
+    def test_conditional_get_asset_price_histories(self):
+        headers = {'Authorization': "Bearer {}".format(USER_TOKEN)}
+        res = self.client().get('/asset_price_histories', headers=headers)
+        etag = res.headers['ETag']
+
+        res = self.client().get('/asset_price_histories', headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertEqual(res.status_code, 304)
+
+        self.asset_price_history.price = 240.0
+        self.asset_price_history.update()
+
+        res = self.client().get('/asset_price_histories', headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+
+    def test_cached_response_after_write_by_another_process(self):
+        headers = {'Authorization': "Bearer {}".format(USER_TOKEN)}
+        path = '/asset_price_histories?portfolio_id={}'.format(self.portfolio.id)
+        self.client().get(path, headers=headers)
+
+        # what another worker or `flask ingest-prices` commits, without this process' listeners
+        table = AssetPriceHistory.__table__
+        db.session.execute(table.insert().values(asset_type='Equity', price=10.0, date=date(2002, 2, 3),
+                                                 portfolio_id=self.portfolio.id))
+        bump_versions(table.name)
+        db.session.commit()
+
+        res = self.client().get(path, headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(len(data['asset_price_histories']), 2)
+        db.session.execute(table.delete().where(table.c.asset_type == 'Equity'))
+        db.session.commit()
+
+
+    def run_job(self, kind, function, *args, **kwargs):
+        """Runs a job to its end on a registry sharing nothing with the app's
+        but the jobs table, like one of another worker process."""
+        registry = JobRegistry(threads=1)
+        job_id = registry.submit(kind, function, *args, **kwargs)
+        registry.executor.shutdown()
+        return job_id
+
+
+    def test_get_risk_job_submitted_by_another_process(self):
+        job_id = self.run_job('risk', dict, var=0.036, cvar=0.041)
+        failed_id = self.run_job('risk', max, [])
+
+        res = self.client().get('/risk_jobs/{}'.format(job_id), headers={
+            'Authorization': "Bearer {}".format(USER_TOKEN)
+        })
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['job']['status'], 'done', data['job']['error'])
+        self.assertEqual(data['job']['result'], {'var': 0.036, 'cvar': 0.041})
+
+        res = self.client().get('/risk_jobs/{}'.format(failed_id), headers={
+            'Authorization': "Bearer {}".format(USER_TOKEN)
+        })
+        data = json.loads(res.data)
+        self.assertEqual(data['job']['status'], 'failed')
+        self.assertIsNone(data['job']['result'])
+        db.session.execute(job_table.delete())
+        db.session.commit()
+
+
+    def test_get_backtest_job_submitted_by_another_process(self):
+        job_id = self.run_job('backtest', dict, runs=[{'schedule': 'monthly', 'band': 0.05}])
+        headers = {'Authorization': "Bearer {}".format(USER_TOKEN)}
+
+        res = self.client().get('/backtest_jobs/{}'.format(job_id), headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['job']['kind'], 'backtest')
+        self.assertEqual(data['job']['result'], {'runs': [{'schedule': 'monthly', 'band': 0.05}]})
+
+        res = self.client().get('/risk_jobs/{}'.format(job_id), headers=headers)
+        self.assertEqual(res.status_code, 404)
+        db.session.execute(job_table.delete())
+        db.session.commit()
+
+
+    def test_get_job_of_an_exited_process(self):
+        now = time.time()
+        stale = now - (JOB_MISSED_HEARTBEATS + 1) * JOB_HEARTBEAT_INTERVAL
+        for job_id, heartbeat_at in (('exited', stale), ('alive', now)):
+            db.session.execute(job_table.insert().values(id=job_id, kind='risk', status='running', submitted_at=stale,
+                                                         owner='gone', heartbeat_at=heartbeat_at))
+        db.session.commit()
+        headers = {'Authorization': "Bearer {}".format(USER_TOKEN)}
+
+        data = json.loads(self.client().get('/risk_jobs/exited', headers=headers).data)
+        self.assertEqual(data['job']['status'], 'failed')
+        self.assertEqual(data['job']['error'], 'interrupted')
+        self.assertNotIn('owner', data['job'])
+
+        data = json.loads(self.client().get('/risk_jobs/alive', headers=headers).data)
+        self.assertEqual(data['job']['status'], 'running')
+        db.session.execute(job_table.delete())
+        db.session.commit()
+
+
+    def test_get_asset_price_histories_columnar(self):
+        res = self.client().get('/asset_price_histories?portfolio_id={}'.format(self.portfolio.id), headers={
+            'Authorization': "Bearer {}".format(ADMIN_TOKEN),
+            'Accept': COLUMNAR_MIMETYPE
+        })
+        data = decode(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, COLUMNAR_MIMETYPE)
+        self.assertIn('Accept', res.headers['Vary'])
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['asset_price_histories']['price'].tolist(), [234.3])
+        self.assertEqual(str(data['asset_price_histories']['date'][0]), '2002-02-02')
+        self.assertEqual(data['asset_price_histories']['asset_type'].tolist(), ['Bond'])
+
+
+    def test_get_portfolio_analytics_columnar(self):
+        headers = {'Authorization': "Bearer {}".format(USER_TOKEN)}
+        path = '/portfolios/{}/analytics'.format(self.portfolio.id)
+        expected = json.loads(self.client().get(path, headers=headers).data)
+        res = self.client().get(path, headers=dict(headers, Accept=COLUMNAR_MIMETYPE))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, COLUMNAR_MIMETYPE)
+        self.assertIn('Accept', res.headers['Vary'])
+        self.assertEqual(decode(res.data), expected)
+
+
+    def test_400_get_asset_price_histories_bad_cursor(self):
+        res = self.client().get('/asset_price_histories?after=not-a-cursor', headers={
+            'Authorization': "Bearer {}".format(USER_TOKEN)
+        })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+
     def test_404_get_asset_price_histories(self):
         self.asset_price_history.delete()
         res = self.client().get('/asset_price_histories/example', headers={
@@ -138,6 +315,24 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertEqual(data["message"], "unprocessable")
 
 
+    def test_bulk_create_asset_price_histories(self):
+        body = 'asset_type,price,date,portfolio_id\nBond,235.1,03-02-2002,{0}\nBond,,04-02-2002,{0}\n'.format(self.portfolio.id)
+
+        res = self.client().post('/asset_price_histories/bulk', data=body, content_type='text/csv', headers={
+            'Authorization': "Bearer {}".format(ADMIN_TOKEN)
+        })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['accepted'], 1)
+        self.assertEqual(data['rejected'], 1)
+        self.assertEqual(data['chunks'][0]['errors'][0]['line'], 3)
+
+        AssetPriceHistory.query.filter(AssetPriceHistory.portfolio_id == self.portfolio.id,
+                                       AssetPriceHistory.id != self.asset_price_history.id).delete()
+        AssetPriceHistory.query.session.commit()
+
+
     def test_edit_asset_price_history(self):
         self.asset_price_history.price = 100
 
@@ -168,6 +363,159 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertEqual(data["message"], "unprocessable")
 
 
+    def test_bulk_edit_asset_price_histories(self):
+        patches = [{'id': self.asset_price_history.id, 'price': 236.4}, {'id': 2323232232, 'price': 1.0}]
+
+        res = self.client().patch('/asset_price_histories/bulk', json={'patches': patches}, headers={
+            'Authorization': "Bearer {}".format(ADMIN_TOKEN)
+        })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['updated'], 0)
+        self.assertEqual(data['errors'][0]['index'], 1)
+
+        res = self.client().patch('/asset_price_histories/bulk', json={'mode': 'best_effort', 'patches': patches}, headers={
+            'Authorization': "Bearer {}".format(ADMIN_TOKEN)
+        })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['updated'], 1)
+        self.assertEqual(data['rejected'], 1)
+        AssetPriceHistory.query.session.expire_all()
+        self.assertEqual(AssetPriceHistory.query.get(self.asset_price_history.id).price, 236.4)
+
+
+    def test_resample_asset_price_histories(self):
+        history = AssetPriceHistory('Bond', 240.1, '08-02-2002', self.portfolio.id)
+        history.insert()
+
+        res = self.client().get('/asset_price_histories/resample?portfolio_id={}&asset_type=Bond&interval=month'
+                                .format(self.portfolio.id), headers={
+            'Authorization': "Bearer {}".format(ADMIN_TOKEN)
+        })
+        data = json.loads(res.data)
+        history.delete()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['bars'], [{'date': '01-02-2002', 'open': 234.3, 'high': 240.1, 'low': 234.3,
+                                         'close': 240.1, 'count': 2}])
+
+
+    def test_rolling_statistics(self):
+        histories = [AssetPriceHistory('Bond', price, '0{}-03-2002'.format(day), self.portfolio.id)
+                     for day, price in ((4, 100.0), (5, 101.0), (6, 99.5))]
+        for history in histories:
+            history.insert()
+
+        res = self.client().get('/asset_price_histories/rolling?ids={}&windows=2&metrics=volatility'
+                                .format(self.portfolio.id), headers={
+            'Authorization': "Bearer {}".format(ADMIN_TOKEN)
+        })
+        data = json.loads(res.data)
+        for history in histories:
+            history.delete()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['dates'], ['04-03-2002', '05-03-2002', '06-03-2002'])
+        self.assertEqual(data['series'], [{'portfolio_id': self.portfolio.id, 'asset_type': 'Bond'}])
+        volatility = data['windows']['2']['volatility'][0]
+        self.assertIsNone(volatility[0])
+        self.assertGreater(volatility[2], 0)
+
+
+    def test_covariance(self):
+        histories = [AssetPriceHistory(asset_type, price, '0{}-03-2002'.format(day), self.portfolio.id)
+                     for day, prices in ((4, (100.0, 50.0)), (5, (101.0, 49.0)), (6, (99.5, 50.5)))
+                     for asset_type, price in zip(('Bond', 'Equity'), prices)]
+        for history in histories:
+            history.insert()
+
+        res = self.client().get('/asset_price_histories/covariance?ids={}&start=2002-03-01'
+                                .format(self.portfolio.id), headers={
+            'Authorization': "Bearer {}".format(ADMIN_TOKEN)
+        })
+        data = json.loads(res.data)
+        for history in histories:
+            history.delete()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['observations'], 2)
+        self.assertEqual(len(data['series']), 2)
+        self.assertAlmostEqual(data['sample']['correlation'][0][1], -1.0)
+        self.assertEqual(len(data['ledoit_wolf']['covariance']), 2)
+
+
+    def test_get_portfolios_as_of(self):
+        histories = [AssetPriceHistory('Bond', 100.0, '04-03-2002', self.portfolio.id),
+                     AssetPriceHistory('Equity', 50.0, '05-03-2002', self.portfolio.id),
+                     AssetPriceHistory('Bond', 101.0, '07-03-2002', self.portfolio.id)]
+        for history in histories:
+            history.insert()
+        snapshots.refresh()
+
+        res = self.client().get('/portfolios?as_of=06-03-2002&ids={}'.format(self.portfolio.id), headers={
+            'Authorization': "Bearer {}".format(ADMIN_TOKEN)
+        })
+        data = json.loads(res.data)
+        for history in histories:
+            history.delete()
+        snapshots.refresh()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['date'], '05-03-2002')
+        self.assertEqual([(item['asset_type'], item['price'], item['price_date']) for item in data['valuations']],
+                         [('Bond', 100.0, '04-03-2002'), ('Equity', 50.0, '05-03-2002')])
+        self.assertAlmostEqual(data['valuations'][0]['weight'], self.portfolio.weight / 2)
+
+
+    def test_get_portfolios_as_of_invalid_date(self):
+        res = self.client().get('/portfolios?as_of=yesterday', headers={
+            'Authorization': "Bearer {}".format(ADMIN_TOKEN)
+        })
+
+        self.assertEqual(res.status_code, 400)
+
+
+    def test_backtest_portfolio(self):
+        history = AssetPriceHistory('Bond', 240.1, '08-02-2002', self.portfolio.id)
+        history.insert()
+
+        res = self.client().post('/portfolios/backtest', json={
+            'ids': [self.portfolio.id], 'schedule': 'monthly', 'cost_bps': 10
+        }, headers={
+            'Authorization': "Bearer {}".format(ADMIN_TOKEN)
+        })
+        data = json.loads(res.data)
+        history.delete()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['dates'], ['02-02-2002', '08-02-2002'])
+        self.assertAlmostEqual(data['nav'][1], 240.1 / 234.3)
+        self.assertEqual(data['rebalances'], 0)
+
+
+    def test_422_backtest_portfolio(self):
+        res = self.client().post('/portfolios/backtest', json={'schedule': 'weekly'}, headers={
+            'Authorization': "Bearer {}".format(ADMIN_TOKEN)
+        })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
+
+    def test_422_enqueue_malformed_tick(self):
+        res = self.client().post('/asset_price_histories/queue', json=[{'asset_type': 'Bond', 'price': 'n/a'}], headers={
+            'Authorization': "Bearer {}".format(ADMIN_TOKEN)
+        })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
+
     def test_delete_portfolio(self):
         self.asset_price_history.delete()
         portfolio_id = self.portfolio.id
@@ -0,0 +1,153 @@
+import unittest, asyncio, functools, json, os, shutil, tempfile, time
+from unittest import mock
+from werkzeug.datastructures import Headers
+
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+os.environ.setdefault('AUTH0_DOMAIN', 'test.local')
+os.environ.setdefault('API_AUDIENCE', 'test-api')
+
+from jose import jwt
+import auth
+from asgi import async_database_url, create_asgi_app, wsgi_environ
+from instrumentation import init_instrumentation
+from models import AssetPriceHistory, Portfolio, db
+from signing_keys import make_key
+
+try:
+    import aiosqlite
+except ImportError:
+    aiosqlite = None
+
+
+def call(app, method, path, query=b'', headers=()):
+    """Sends one request to an ASGI app, returns (status, headers, body)."""
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {'type': 'http', 'method': method, 'path': path, 'root_path': '', 'query_string': query,
+             'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+             'server': ('testserver', 80), 'client': ('127.0.0.1', 1234), 'scheme': 'http', 'http_version': '1.1'}
+    asyncio.run(app(scope, receive, send))
+    start = messages[0]
+    headers = Headers([(name.decode('latin-1'), value.decode('latin-1')) for name, value in start['headers']])
+    return start['status'], headers, b''.join(message.get('body', b'') for message in messages[1:])
+
+
+class AsgiHelpersTestCase(unittest.TestCase):
+    """This class represents the ASGI helpers test case"""
+
+    def test_async_database_url(self):
+        self.assertEqual(async_database_url('postgres://u:p@db/prices'), 'postgresql+asyncpg://u:p@db/prices')
+        self.assertEqual(async_database_url('postgresql://db/prices'), 'postgresql+asyncpg://db/prices')
+        self.assertEqual(async_database_url('sqlite:////tmp/prices.db'), 'sqlite+aiosqlite:////tmp/prices.db')
+        self.assertEqual(async_database_url('postgresql+asyncpg://db/prices'), 'postgresql+asyncpg://db/prices')
+
+    def test_wsgi_environ(self):
+        scope = {'method': 'POST', 'path': '/portfolios', 'query_string': b'a=1',
+                 'headers': [(b'content-type', b'application/json'), (b'accept', b'text/html'),
+                             (b'accept', b'application/json')]}
+        environ = wsgi_environ(scope, b'{}')
+
+        self.assertEqual(environ['PATH_INFO'], '/portfolios')
+        self.assertEqual(environ['QUERY_STRING'], 'a=1')
+        self.assertEqual(environ['CONTENT_TYPE'], 'application/json')
+        self.assertEqual(environ['HTTP_ACCEPT'], 'text/html,application/json')
+        self.assertEqual(environ['wsgi.input'].read(), b'{}')
+
+
+@unittest.skipIf(aiosqlite is None, 'aiosqlite is not installed')
+class AsgiAppTestCase(unittest.TestCase):
+    """This class represents the ASGI serving mode test case"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        with mock.patch('app.init_instrumentation', functools.partial(init_instrumentation, enabled=True)):
+            cls.asgi = create_asgi_app({'DATABASE_URL': 'sqlite:///' + os.path.join(cls.directory, 'test.db')})
+        cls.app = cls.asgi.app
+        with cls.app.app_context():
+            db.create_all()
+            for i in range(3):
+                portfolio = Portfolio('Class {}'.format(i), 0.2, 'Benchmark {}'.format(i), i, 'QRY{}'.format(i))
+                portfolio.insert()
+                AssetPriceHistory('Bond', 100.0 + i, '02-0{}-2002'.format(i + 1), portfolio.id).insert()
+
+        cls.pem, jwk = make_key('asgi')
+        handle, cls.jwks_path = tempfile.mkstemp(suffix='.json')
+        with os.fdopen(handle, 'w') as f:
+            json.dump({'keys': [jwk]}, f)
+
+    @classmethod
+    def tearDownClass(cls):
+        asyncio.run(cls.asgi.engine.dispose())
+        cls.asgi.executor.shutdown()
+        shutil.rmtree(cls.directory)
+        os.remove(cls.jwks_path)
+
+    def setUp(self):
+        self.patch = mock.patch.object(auth, 'jwks_cache', auth.JWKSCache('file://' + self.jwks_path))
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+
+    def headers(self, *permissions):
+        token = jwt.encode({
+            'iss': f'https://{auth.AUTH0_DOMAIN}/',
+            'aud': auth.API_AUDIENCE,
+            'exp': int(time.time()) + 3600,
+            'permissions': list(permissions)
+        }, self.pem, algorithm='RS256', headers={'kid': 'asgi'})
+        return {'Authorization': 'Bearer ' + token}
+
+    def test_reads_match_the_flask_app(self):
+        headers = self.headers('get:portfolios', 'get:asset_price_histories')
+        headers['Origin'] = 'https://example.com'
+        for path, query in (('/portfolios', 'limit=2'), ('/asset_price_histories', 'portfolio_id=2'),
+                            ('/asset_price_histories', 'limit=1&fields=price,date')):
+            status, response_headers, body = call(self.asgi, 'GET', path, query.encode('latin-1'), headers.items())
+            expected = self.app.test_client().get(path + '?' + query, headers=headers)
+
+            self.assertEqual(status, 200)
+            self.assertEqual(json.loads(body), expected.get_json())
+            self.assertEqual({name.lower() for name in response_headers.keys()},
+                             {name.lower() for name in expected.headers.keys()})
+            for name in ('Access-Control-Allow-Origin', 'Content-Type', 'ETag', 'Vary', 'Cache-Control'):
+                self.assertEqual(response_headers.getlist(name), expected.headers.getlist(name))
+            self.assertIn('total;dur=', response_headers['Server-Timing'])
+
+    def test_not_modified(self):
+        headers = self.headers('get:portfolios')
+        status, response_headers, _ = call(self.asgi, 'GET', '/portfolios', headers=headers.items())
+        self.assertEqual(status, 200)
+
+        headers['If-None-Match'] = response_headers['ETag']
+        status, _, body = call(self.asgi, 'GET', '/portfolios', headers=headers.items())
+        self.assertEqual(status, 304)
+        self.assertEqual(body, b'')
+
+    def test_errors_fall_back_to_the_flask_app(self):
+        status, _, body = call(self.asgi, 'GET', '/portfolios')
+        self.assertEqual(status, 401)
+        self.assertFalse(json.loads(body)['success'])
+
+        status, _, _ = call(self.asgi, 'GET', '/portfolios', headers=self.headers('get:nothing').items())
+        self.assertEqual(status, 401)
+
+        status, _, _ = call(self.asgi, 'GET', '/portfolios', b'limit=abc', self.headers('get:portfolios').items())
+        self.assertEqual(status, 400)
+
+        status, _, body = call(self.asgi, 'GET', '/asset_price_histories', b'portfolio_id=999',
+                               self.headers('get:asset_price_histories').items())
+        self.assertEqual(status, 404)
+        self.assertEqual(json.loads(body)['message'], 'resource not found')
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+import unittest, json, os, tempfile, time
+from unittest import mock
+
+os.environ.setdefault('AUTH0_DOMAIN', 'test.local')
+os.environ.setdefault('API_AUDIENCE', 'test-api')
+
+from jose import jwt
+import auth
+from signing_keys import make_key
+
+
+class AuthCacheTestCase(unittest.TestCase):
+    """This class represents the JWKS and token cache test case"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.pem, cls.jwk = make_key('key-1')
+
+    def setUp(self):
+        handle, self.jwks_path = tempfile.mkstemp(suffix='.json')
+        with os.fdopen(handle, 'w') as f:
+            json.dump({'keys': [self.jwk]}, f)
+
+        self.jwks_cache = auth.JWKSCache('file://' + self.jwks_path, ttl=3600, min_refresh_interval=60)
+        self.token_cache = auth.TokenCache(maxsize=2)
+        self.patches = [
+            mock.patch.object(auth, 'jwks_cache', self.jwks_cache),
+            mock.patch.object(auth, 'token_cache', self.token_cache)
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        os.remove(self.jwks_path)
+
+    def make_token(self, kid='key-1', expires_in=3600, **claims):
+        payload = {
+            'iss': f'https://{auth.AUTH0_DOMAIN}/',
+            'aud': auth.API_AUDIENCE,
+            'sub': 'user|1',
+            'exp': int(time.time()) + expires_in,
+            'permissions': ['get:portfolios']
+        }
+        payload.update(claims)
+        return jwt.encode(payload, self.pem, algorithm='RS256', headers={'kid': kid})
+
+    def test_jwks_fetched_once(self):
+        for sub in ('user|1', 'user|2', 'user|3'):
+            payload = auth.verify_decode_jwt(self.make_token(sub=sub))
+            self.assertEqual(payload['sub'], sub)
+
+        self.assertEqual(self.jwks_cache.fetches, 1)
+        self.assertEqual(self.jwks_cache.hits, 3)
+
+    def test_verified_token_served_from_cache(self):
+        token = self.make_token()
+        auth.verify_decode_jwt(token)
+        auth.verify_decode_jwt(token)
+
+        self.assertEqual(self.token_cache.hits, 1)
+        self.assertEqual(self.token_cache.misses, 1)
+        self.assertEqual(self.jwks_cache.hits, 1)
+
+    def test_token_cache_is_bounded(self):
+        for sub in ('user|1', 'user|2', 'user|3'):
+            auth.verify_decode_jwt(self.make_token(sub=sub))
+
+        self.assertEqual(len(self.token_cache.entries), 2)
+
+    def test_cached_token_expires(self):
+        token = self.make_token()
+        payload = auth.verify_decode_jwt(token)
+        self.token_cache.put(token, dict(payload, exp=int(time.time()) - 1))
+
+        self.assertIsNone(self.token_cache.get(token))
+
+    def test_unknown_kid_refresh_is_rate_limited(self):
+        auth.verify_decode_jwt(self.make_token())
+
+        for _ in range(5):
+            with self.assertRaises(auth.AuthError):
+                auth.verify_decode_jwt(self.make_token(kid='unknown'))
+
+        self.assertEqual(self.jwks_cache.misses, 5)
+        self.assertEqual(self.jwks_cache.fetches, 1)
+
+    def test_rotated_key_is_picked_up(self):
+        self.jwks_cache.min_refresh_interval = 0
+        auth.verify_decode_jwt(self.make_token())
+
+        pem, jwk = make_key('key-2')
+        with open(self.jwks_path, 'w') as f:
+            json.dump({'keys': [self.jwk, jwk]}, f)
+
+        token = jwt.encode({
+            'iss': f'https://{auth.AUTH0_DOMAIN}/',
+            'aud': auth.API_AUDIENCE,
+            'exp': int(time.time()) + 3600
+        }, pem, algorithm='RS256', headers={'kid': 'key-2'})
+        auth.verify_decode_jwt(token)
+
+        self.assertEqual(self.jwks_cache.fetches, 2)
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
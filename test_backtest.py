@@ -0,0 +1,114 @@
+import unittest, os
+
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+import numpy as np
+from analytics import blend
+from backtest import calendar_rebalances, first_breach, simulate, sweep, sweep_runs
+from workers import shutdown_process_pool
+
+
+def naive_simulation(prices, targets, rebalance_days, cost):
+    """Day by day reference: revalue the holdings, trade back to the targets
+    on the rebalance days."""
+    targets = targets / targets.sum()
+    units = targets / prices[0]
+    nav = [1.0]
+    for day in range(1, len(prices)):
+        values = units * prices[day]
+        value = values.sum()
+        if day in rebalance_days:
+            value -= cost * np.abs(targets * value - values).sum()
+            units = targets * value / prices[day]
+        nav.append(value)
+    return np.array(nav)
+
+
+class BacktestTestCase(unittest.TestCase):
+    """This class represents the backtest test case"""
+
+    def setUp(self):
+        generator = np.random.default_rng(11)
+        returns = generator.normal([0.0008, 0.0001, -0.0002], [0.02, 0.005, 0.01], size=(600, 3))
+        self.prices = 100.0 * np.cumprod(1.0 + returns, axis=0)
+        self.targets = np.array([0.6, 0.3, 0.1])
+        self.dates = np.datetime64('2019-12-20') + np.arange(600)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutdown_process_pool()
+
+    def test_calendar_rebalances(self):
+        dates = np.array(['2020-01-30', '2020-01-31', '2020-02-03', '2020-03-02', '2020-04-01', '2021-01-04'],
+                         dtype='datetime64[D]')
+
+        self.assertEqual(calendar_rebalances(dates, 'monthly').tolist(), [2, 3, 4, 5])
+        self.assertEqual(calendar_rebalances(dates, 'quarterly').tolist(), [4, 5])
+        self.assertEqual(calendar_rebalances(dates, 'annually').tolist(), [5])
+
+    def test_buy_and_hold(self):
+        nav, rebalances, turnover, costs = simulate(self.prices, self.targets, 'none', cost=0.01)
+
+        np.testing.assert_allclose(nav, blend(self.prices, self.targets))
+        self.assertEqual((rebalances, turnover, costs), ([], [], 0.0))
+
+    def test_calendar_matches_naive(self):
+        calendar = calendar_rebalances(self.dates, 'monthly')
+        nav, rebalances, turnover, costs = simulate(self.prices, self.targets, 'monthly', cost=0.002,
+                                                    calendar=calendar)
+
+        self.assertEqual(rebalances, calendar.tolist())
+        np.testing.assert_allclose(nav, naive_simulation(self.prices, self.targets, set(rebalances), 0.002))
+        self.assertEqual(len(turnover), len(rebalances))
+        self.assertGreater(costs, 0.0)
+
+    def test_threshold_band(self):
+        band = 0.03
+        nav, rebalances, turnover, costs = simulate(self.prices, self.targets, 'threshold', band)
+
+        self.assertTrue(rebalances)
+        np.testing.assert_allclose(nav, naive_simulation(self.prices, self.targets, set(rebalances), 0.0))
+        # the weights stay inside the band except on the rebalance days
+        units = self.targets / self.prices[0]
+        for day in range(1, len(self.prices)):
+            values = units * self.prices[day]
+            drift = np.abs(values / values.sum() - self.targets).max()
+            self.assertEqual(drift > band, day in rebalances)
+            if day in rebalances:
+                units = self.targets * values.sum() / self.prices[day]
+
+    def test_breach_across_scan_chunks(self):
+        units = self.targets / self.prices[0]
+        breach = first_breach(self.prices, units, self.targets, 0.05, 1, scan_rows=len(self.prices))
+
+        self.assertLess(breach, len(self.prices))
+        self.assertEqual(first_breach(self.prices, units, self.targets, 0.05, 1, scan_rows=7), breach)
+        self.assertEqual(first_breach(self.prices, units, self.targets, 0.99, 1, scan_rows=7), len(self.prices))
+
+    def test_costs_lower_the_nav(self):
+        calendar = calendar_rebalances(self.dates, 'quarterly')
+        free = simulate(self.prices, self.targets, 'quarterly', cost=0.0, calendar=calendar)
+        costly = simulate(self.prices, self.targets, 'quarterly', cost=0.005, calendar=calendar)
+
+        self.assertEqual(free[1], costly[1])
+        self.assertLess(costly[0][-1], free[0][-1])
+        self.assertEqual(free[3], 0.0)
+
+    def test_sweep_in_pool(self):
+        runs = sweep_runs(['none', 'monthly', 'threshold'], [0.02, 0.1], [0.0, 10.0])
+        results = sweep(self.prices, self.targets, self.dates, runs)
+
+        self.assertEqual(len(runs), 8)
+        self.assertEqual([result['schedule'] for result in results], [run['schedule'] for run in runs])
+        threshold = [result for result in results if result['schedule'] == 'threshold']
+        self.assertGreater(threshold[0]['rebalances'], threshold[1]['rebalances'])
+        expected = simulate(self.prices, self.targets, 'monthly', cost=0.001,
+                            calendar=calendar_rebalances(self.dates, 'monthly'))
+        self.assertEqual(results[3]['cost_bps'], 10.0)
+        self.assertAlmostEqual(results[3]['turnover'], sum(expected[2]))
+        self.assertAlmostEqual(results[3]['transaction_costs'], expected[3])
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+import unittest, os
+
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from datetime import date
+import json
+import numpy as np
+import serialization
+from columnar import decode, encode, row_columns
+from models import AssetPriceHistory
+
+
+class ColumnarTestCase(unittest.TestCase):
+    """This class represents the columnar encoding test case"""
+
+    def setUp(self):
+        self.payload = {
+            'success': True,
+            'next_cursor': None,
+            'dates': np.array(['1969-12-31', '2002-02-02'], dtype='datetime64[D]'),
+            'windows': {'30': {'volatility': np.array([[np.nan, 0.5], [0.25, np.inf]])}},
+            'series': [{'portfolio_id': 1, 'asset_type': 'Bond'}]
+        }
+
+    def test_round_trip(self):
+        payload = dict(self.payload, asset_type=np.array(['Bond', 'Equity', 'Bond'], dtype=object),
+                       id=np.array([1, 2, 2 ** 40]), count=np.array([3, 4], dtype=np.int64))
+        decoded = decode(encode(payload))
+
+        self.assertEqual(decoded['series'], payload['series'])
+        self.assertIsNone(decoded['next_cursor'])
+        np.testing.assert_array_equal(decoded['dates'], payload['dates'])
+        np.testing.assert_array_equal(decoded['windows']['30']['volatility'], payload['windows']['30']['volatility'])
+        self.assertEqual(decoded['asset_type'].tolist(), ['Bond', 'Equity', 'Bond'])
+        self.assertEqual(decoded['id'].dtype, np.dtype('<i8'))
+        self.assertEqual(decoded['count'].dtype, np.dtype('<i4'))
+
+    def test_layout(self):
+        data = encode({'price': np.array([1.5, 2.5]), 'date': np.array(['1970-01-03'], dtype='datetime64[D]'),
+                       'asset_type': np.array(['Bond', 'Equity', 'Bond'], dtype=object)})
+        header_size = int.from_bytes(data[4:8], 'little')
+        header = json.loads(data[8:8 + header_size])
+        start = 8 + header_size + (-(8 + header_size) % 8)
+        price, day, asset_type = header['columns']
+
+        self.assertEqual(data[:4], b'COL1')
+        self.assertEqual(start % 8, 0)
+        self.assertEqual(np.frombuffer(data, '<f8', 2, start + price['offset']).tolist(), [1.5, 2.5])
+        self.assertEqual((day['dtype'], day['encoding']), ('<i4', 'days'))
+        self.assertEqual(np.frombuffer(data, '<i4', 1, start + day['offset']).tolist(), [2])
+        self.assertEqual(asset_type['dictionary'], ['Bond', 'Equity'])
+        self.assertEqual(np.frombuffer(data, asset_type['dtype'], 3, start + asset_type['offset']).tolist(), [0, 1, 0])
+        self.assertTrue(all(column['offset'] % 8 == 0 for column in header['columns']))
+
+    def test_row_columns(self):
+        table = AssetPriceHistory.__table__
+        rows = [(1, 'Bond', 234.3, date(2002, 2, 2), 7), (2, 'Equity', 10.0, date(2002, 2, 3), None)]
+        columns = row_columns(table, ['id', 'asset_type', 'price', 'date', 'portfolio_id'], rows)
+
+        self.assertEqual(columns['id'].dtype, np.int64)
+        self.assertEqual(columns['price'].tolist(), [234.3, 10.0])
+        self.assertEqual(columns['date'].tolist(), [date(2002, 2, 2), date(2002, 2, 3)])
+        self.assertTrue(np.isnan(columns['portfolio_id'][1]))
+        self.assertEqual(len(row_columns(table, ['id', 'price'], [])['price']), 0)
+
+    def test_json_writes_arrays_as_lists(self):
+        expected = {'success': True, 'next_cursor': None, 'dates': ['31-12-1969', '02-02-2002'],
+                    'windows': {'30': {'volatility': [[None, 0.5], [0.25, None]]}},
+                    'series': [{'portfolio_id': 1, 'asset_type': 'Bond'}]}
+        orjson = serialization.orjson
+        try:
+            for module in {orjson, None}:
+                serialization.orjson = module
+                self.assertEqual(json.loads(serialization.dumps(self.payload)), expected)
+        finally:
+            serialization.orjson = orjson
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+import unittest, os, shutil, tempfile
+from unittest import mock
+
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+import numpy as np
+import covariance
+from covariance import CovarianceCache, covariance_estimates, ledoit_wolf
+from app import create_app
+from models import AssetPriceHistory, bump_versions, db
+from price_cube import PriceCube
+
+
+def naive_ledoit_wolf(returns):
+    """Ledoit & Wolf (2004), one observation at a time."""
+    observations, size = returns.shape
+    centred = returns - returns.mean(axis=0)
+    covariance = centred.T @ centred / observations
+    mu = np.trace(covariance) / size
+    target = mu * np.eye(size)
+    delta = np.linalg.norm(covariance - target) ** 2 / size
+    beta = sum(np.linalg.norm(np.outer(row, row) - covariance) ** 2 for row in centred) / observations ** 2 / size
+    shrinkage = min(beta, delta) / delta
+    return shrinkage * target + (1 - shrinkage) * covariance, shrinkage
+
+
+class CovarianceTestCase(unittest.TestCase):
+    """This class represents the covariance test case"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = create_app()
+        with cls.app.app_context():
+            db.create_all()
+
+    def setUp(self):
+        self.context = self.app.app_context()
+        self.context.push()
+        self.addCleanup(self.context.pop)
+        generator = np.random.default_rng(3)
+        self.returns = generator.multivariate_normal(np.zeros(4), [[4, 2, 0, 0], [2, 3, 1, 0], [0, 1, 2, 0],
+                                                                   [0, 0, 0, 1]], size=60) / 100
+
+    def test_sample_estimates(self):
+        estimates = covariance_estimates(self.returns, periods_per_year=252)
+
+        np.testing.assert_allclose(estimates['sample']['covariance'], np.cov(self.returns, rowvar=False) * 252)
+        np.testing.assert_allclose(estimates['sample']['correlation'], np.corrcoef(self.returns, rowvar=False))
+
+    def test_ledoit_wolf_matches_naive(self):
+        expected, expected_shrinkage = naive_ledoit_wolf(self.returns)
+        centred = self.returns - self.returns.mean(axis=0)
+        shrunk, shrinkage = ledoit_wolf(centred, centred.T @ centred / len(centred))
+
+        np.testing.assert_allclose(shrunk, expected)
+        self.assertAlmostEqual(shrinkage, expected_shrinkage)
+        self.assertTrue(0 < shrinkage < 1)
+
+    def test_shrunk_estimates(self):
+        estimates = covariance_estimates(self.returns[:4], periods_per_year=1)
+        correlation = estimates['ledoit_wolf']['correlation']
+
+        # fewer observations than series: the sample matrix is singular, the shrunk one is not
+        self.assertEqual(np.linalg.matrix_rank(estimates['sample']['covariance']), 3)
+        self.assertGreater(np.linalg.eigvalsh(estimates['ledoit_wolf']['covariance']).min(), 0)
+        np.testing.assert_allclose(np.diag(correlation), 1.0)
+        self.assertTrue((np.abs(correlation) <= np.abs(estimates['sample']['correlation']) + 1e-12).all())
+
+    def test_cache_keys_on_selection_and_version(self):
+        calls = []
+        payload = {'sample': {'covariance': np.eye(2)}, 'ledoit_wolf': {'covariance': np.eye(2)}}
+        cache = CovarianceCache(maxsize=2, compute=lambda *args: calls.append(args) or payload)
+
+        self.assertIs(cache.get([1, 2], None, None), payload)
+        cache.get([2, 1], None, None)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(cache.stats()['bytes'], 64)
+
+        bump_versions(AssetPriceHistory.__tablename__)
+        db.session.commit()
+        cache.get([1, 2], None, None)
+        self.assertEqual(len(calls), 2)
+
+        cache.get([3], None, None)
+        cache.get([1, 2], series=[(1, 'Bond')])
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 4, 'evictions': 2, 'size': 2, 'bytes': 128})
+
+    def test_cache_keys_on_the_cube_version(self):
+        directory = tempfile.mkdtemp(prefix='price-cube-')
+        self.addCleanup(shutil.rmtree, directory)
+        cube = PriceCube(directory, loader=lambda: (np.array([1], dtype=np.int64), np.array(['Bond'], dtype=object),
+                                                    np.array(['2020-01-02'], dtype='datetime64[D]'), np.array([1.0])))
+        cube.keys()
+        calls = []
+        payload = {'sample': {'covariance': np.eye(1)}, 'ledoit_wolf': {'covariance': np.eye(1)}}
+        cache = CovarianceCache(compute=lambda *args: calls.append(args) or payload)
+
+        with mock.patch.object(covariance, 'price_cube', cube):
+            cache.get([1])
+            cache.get([1])
+            # a price written in place by another process, the tables' versions are unchanged here
+            PriceCube(directory, loader=cube.loader).on_write(AssetPriceHistory.__tablename__, 'insert', [{
+                'portfolio_id': 1, 'asset_type': 'Bond', 'date': np.datetime64('2020-01-02').item(), 'price': 2.0
+            }])
+            cache.get([1])
+
+        self.assertEqual(len(calls), 2)
+
+    def test_cache_byte_limit(self):
+        payload = {'sample': {'covariance': np.eye(10)}, 'ledoit_wolf': {'covariance': np.eye(10)}}
+        cache = CovarianceCache(max_bytes=1000, compute=lambda *args: payload)
+
+        self.assertIs(cache.get([1]), payload)
+        self.assertEqual(cache.stats()['size'], 0)
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
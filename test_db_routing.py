@@ -0,0 +1,60 @@
+import unittest, os
+
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+from db_routing import ReplicaRouter, engine_options, sqlite_statement_timeout
+
+
+class DatabaseRoutingTestCase(unittest.TestCase):
+    """This class represents the pool settings and read replica routing test case"""
+
+    def setUp(self):
+        self.router = ReplicaRouter(max_lag=60, check_interval=0)
+        self.router.replica = create_engine('sqlite://')
+
+    def test_engine_options(self):
+        options = engine_options('postgresql://user@localhost/capstone', statement_timeout=2000)
+
+        self.assertTrue(options['pool_pre_ping'])
+        self.assertEqual(options['connect_args'], {'options': '-c statement_timeout=2000'})
+        self.assertEqual(engine_options('sqlite://'), {})
+
+    def test_reads_go_to_the_replica(self):
+        self.router.route('GET')
+        self.assertIs(self.router.read_engine(), self.router.replica)
+        self.assertEqual(self.router.lag, 0.0)
+
+        self.router.route('POST')
+        self.assertIsNone(self.router.read_engine())
+
+    def test_recent_write_stays_on_the_primary(self):
+        self.router.on_write('portfolios', 'insert', [])
+        self.router.route('GET')
+
+        self.assertIsNone(self.router.read_engine())
+        self.assertEqual(self.router.stats()['write_fallbacks'], 1)
+
+    def test_lagging_replica_falls_back(self):
+        self.router.check_lag = lambda: None
+        self.router.lag = 120.0
+        self.router.route('GET')
+
+        self.assertIsNone(self.router.read_engine())
+        self.assertEqual(self.router.stats()['lag_fallbacks'], 1)
+
+    def test_sqlite_statement_timeout(self):
+        engine = create_engine('sqlite://')
+        sqlite_statement_timeout(engine, 50)
+
+        with engine.connect() as connection:
+            self.assertEqual(connection.execute(text('SELECT 1')).scalar(), 1)
+            with self.assertRaises(OperationalError):
+                connection.execute(text('WITH RECURSIVE n(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM n) '
+                                        'SELECT count(*) FROM n')).scalar()
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,136 @@
+import unittest, csv, gzip, io, json, os, tempfile, time
+from unittest import mock
+
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+os.environ.setdefault('AUTH0_DOMAIN', 'test.local')
+os.environ.setdefault('API_AUDIENCE', 'test-api')
+
+from jose import jwt
+import auth
+from app import create_app
+from export import EXPORT_COLUMNS, export_price_rows
+from models import AssetPriceHistory, Portfolio, db
+from signing_keys import make_key
+
+
+class ExportTestCase(unittest.TestCase):
+    """This class represents the asset price history export test case"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = create_app()
+        with cls.app.app_context():
+            db.create_all()
+
+        cls.pem, jwk = make_key('export')
+        handle, cls.jwks_path = tempfile.mkstemp(suffix='.json')
+        with os.fdopen(handle, 'w') as f:
+            json.dump({'keys': [jwk]}, f)
+
+    @classmethod
+    def tearDownClass(cls):
+        os.remove(cls.jwks_path)
+
+    def setUp(self):
+        self.context = self.app.app_context()
+        self.context.push()
+        self.patch = mock.patch.object(auth, 'jwks_cache', auth.JWKSCache('file://' + self.jwks_path))
+        self.patch.start()
+        self.client = self.app.test_client
+
+        self.portfolios = []
+        for i in range(2):
+            portfolio = Portfolio('Class {}'.format(i), 0.5, 'Benchmark {}'.format(i), i, 'QRY{}'.format(i))
+            portfolio.insert()
+            self.portfolios.append(portfolio.id)
+        self.rows = []
+        for day in range(1, 6):
+            for portfolio_id in self.portfolios:
+                for asset_type in ('Bond', 'Equity'):
+                    price = AssetPriceHistory(asset_type, 100.0 + day, '2020-01-0{}'.format(day), portfolio_id)
+                    price.insert()
+                    self.rows.append({'id': price.id, 'asset_type': asset_type, 'price': 100.0 + day,
+                                      'date': '0{}-01-2020'.format(day), 'portfolio_id': portfolio_id})
+
+    def tearDown(self):
+        db.session.execute(AssetPriceHistory.__table__.delete())
+        db.session.execute(Portfolio.__table__.delete())
+        db.session.commit()
+        self.patch.stop()
+        self.context.pop()
+
+    def headers(self):
+        token = jwt.encode({
+            'iss': f'https://{auth.AUTH0_DOMAIN}/',
+            'aud': auth.API_AUDIENCE,
+            'exp': int(time.time()) + 3600,
+            'permissions': ['get:asset_price_histories']
+        }, self.pem, algorithm='RS256', headers={'kid': 'export'})
+        return {'Authorization': 'Bearer ' + token}
+
+    def export(self, query=''):
+        return self.client().get('/asset_price_histories/export' + query, headers=self.headers())
+
+    def test_ndjson(self):
+        res = self.export()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertEqual(res.headers['Content-Disposition'], 'attachment; filename=asset_price_histories.ndjson')
+        self.assertEqual([json.loads(line) for line in res.data.decode('utf-8').splitlines()], self.rows)
+
+    def test_csv(self):
+        res = self.export('?format=csv')
+        rows = list(csv.reader(io.StringIO(res.data.decode('utf-8'))))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'text/csv')
+        self.assertEqual(tuple(rows[0]), EXPORT_COLUMNS)
+        self.assertEqual(rows[1:], [[str(row[name]) for name in EXPORT_COLUMNS] for row in self.rows])
+
+    def test_gzip(self):
+        for export_format in ('ndjson', 'csv'):
+            plain = self.export('?format={}'.format(export_format))
+            res = self.export('?format={}&gzip=true'.format(export_format))
+
+            self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(gzip.decompress(res.data), plain.data)
+
+    def test_filters(self):
+        portfolio_id = self.portfolios[1]
+        res = self.export('?portfolio_id={}&asset_type=Equity&start=2020-01-02&end=03-01-2020'.format(portfolio_id))
+        expected = [row for row in self.rows if row['portfolio_id'] == portfolio_id and row['asset_type'] == 'Equity'
+                    and row['date'] in ('02-01-2020', '03-01-2020')]
+
+        self.assertEqual(len(expected), 2)
+        self.assertEqual([json.loads(line) for line in res.data.decode('utf-8').splitlines()], expected)
+
+    def test_empty_result(self):
+        res = self.export('?asset_type=Commodity')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.data, b'')
+
+        res = self.export('?asset_type=Commodity&format=csv')
+        self.assertEqual(res.data.decode('utf-8').splitlines(), [','.join(EXPORT_COLUMNS)])
+
+        res = self.export('?asset_type=Commodity&gzip=true')
+        self.assertEqual(gzip.decompress(res.data), b'')
+
+    def test_chunks_join_up(self):
+        for export_format in ('ndjson', 'csv'):
+            chunked = b''.join(export_price_rows(export_format, chunk_size=3))
+            self.assertEqual(chunked, b''.join(export_price_rows(export_format)))
+
+    def test_400_export(self):
+        self.assertEqual(self.export('?format=xml').status_code, 400)
+        self.assertEqual(self.export('?portfolio_id=abc').status_code, 400)
+        self.assertEqual(self.export('?start=not-a-date').status_code, 400)
+
+    def test_401_export_without_token(self):
+        res = self.client().get('/asset_price_histories/export')
+        self.assertEqual(res.status_code, 401)
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+import unittest, os, shutil, tempfile
+from unittest import mock
+
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+import fcntl, json
+from flask import Flask
+import ingest_queue
+from ingest_queue import DEAD_LETTER_FILE, IngestQueue, QueueFull, Spool, pending_ticks
+
+
+def tick(day):
+    return {'asset_type': 'Bond', 'price': 100.0 + day, 'date': '2020-01-{:02d}'.format(day), 'portfolio_id': 1}
+
+
+class IngestQueueTestCase(unittest.TestCase):
+    """This class represents the ingest queue test case"""
+
+    def setUp(self):
+        self.spool_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.spool_dir)
+
+    def test_pending_ticks_skips_flushed_and_torn_lines(self):
+        lines = [json.dumps(dict(tick(1), sequence=1)), json.dumps(dict(tick(2), sequence=2)),
+                 json.dumps({'flushed': 1}), json.dumps(dict(tick(3), sequence=3)), '{"sequence": 4, "pri']
+
+        self.assertEqual([entry['sequence'] for entry in pending_ticks(lines)], [2, 3])
+
+    def test_orphaned_spool_is_detected(self):
+        owner = Spool(self.spool_dir)
+        owner.append([dict(tick(1), sequence=1)])
+        other = Spool(self.spool_dir)
+
+        self.assertEqual(list(other.orphans()), [])
+        owner.file.close()
+        orphans = list(other.orphans())
+        self.assertEqual([path for path, _ in orphans], [owner.path])
+        for _, orphan in orphans:
+            orphan.close()
+        other.close()
+
+    def test_spool_rewritten_while_waiting_for_its_lock_is_not_an_orphan(self):
+        owner = Spool(self.spool_dir)
+        owner.append([dict(tick(1), sequence=1), dict(tick(2), sequence=2)])
+        other = Spool(self.spool_dir)
+        flock = fcntl.flock
+        rewrites = []
+
+        def rewrite_then_lock(f, operation):
+            # the owner compacts its spool between our open() and flock()
+            if getattr(f, 'name', None) == owner.path and f is not owner.file and not rewrites:
+                rewrites.append(f)
+                owner.rewrite([dict(tick(2), sequence=2)])
+            return flock(f, operation)
+
+        with mock.patch.object(ingest_queue.fcntl, 'flock', side_effect=rewrite_then_lock):
+            self.assertEqual(list(other.orphans()), [])
+        self.assertEqual(len(rewrites), 1)
+        self.assertTrue(os.path.exists(owner.path))
+        other.close()
+        owner.close()
+
+    def test_bad_tick_is_dead_lettered(self):
+        queue = IngestQueue(flush_size=4, flush_interval=0, spool_dir=self.spool_dir, max_attempts=2)
+        queue.app = Flask(__name__)
+        queue.spool = Spool(self.spool_dir)
+        written = []
+
+        def ingest_chunk(records):
+            if any(record['price'] == 103.0 for _, record in records):
+                return {'accepted': 0, 'rejected': len(records), 'errors': [{'line': None, 'error': 'chunk not written'}]}
+            written.extend(record['date'] for _, record in records)
+            return {'accepted': len(records), 'rejected': 0, 'errors': []}
+
+        with queue._condition:
+            queue._enqueue([tick(day) for day in range(1, 7)])
+        with mock.patch.object(ingest_queue, 'ingest_chunk', side_effect=ingest_chunk):
+            for _ in range(20):
+                if not queue.buffer:
+                    break
+                queue.flush(queue._next_batch())
+
+        self.assertEqual(written, ['2020-01-{:02d}'.format(day) for day in (1, 2, 4, 5, 6)])
+        self.assertEqual(queue.stats()['dead_lettered'], 1)
+        with open(os.path.join(self.spool_dir, DEAD_LETTER_FILE)) as f:
+            self.assertEqual([json.loads(line)['price'] for line in f], [103.0])
+        with open(queue.spool.path) as spool:
+            self.assertEqual(pending_ticks(spool), [])
+        queue.spool.close()
+
+    def test_out_of_range_ticks_are_refused(self):
+        queue = IngestQueue(flush_interval=60, spool_dir=self.spool_dir)
+
+        for bad in (dict(tick(1), portfolio_id=9999999999), dict(tick(1), portfolio_id=0),
+                    dict(tick(1), price='nan'), dict(tick(1), price='inf')):
+            with self.assertRaises(ValueError):
+                queue.submit([bad])
+        self.assertIsNone(queue.spool)
+
+    def test_backpressure(self):
+        # no app, the writer never gets to flush
+        queue = IngestQueue(maxsize=3, flush_interval=60, spool_dir=self.spool_dir)
+
+        self.assertEqual(queue.submit([tick(1), tick(2)]), (1, 2))
+        with self.assertRaises(QueueFull):
+            queue.submit([tick(3), tick(4)])
+        with self.assertRaises(ValueError):
+            queue.submit([dict(tick(3), price='x')])
+        self.assertEqual(queue.stats()['depth'], 2)
+        queue.stop()
+        with open(queue.spool.path) as spool:
+            self.assertEqual(len(pending_ticks(spool)), 2)
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
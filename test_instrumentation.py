@@ -0,0 +1,76 @@
+import unittest, os
+
+os.environ.setdefault('AUTH0_DOMAIN', 'test.local')
+os.environ.setdefault('API_AUDIENCE', 'test-api')
+
+import instrumentation
+from instrumentation import CountingCursor, Metrics, RequestTimings, phase
+
+
+class FakeCursor:
+    description = (('id',),)
+
+    def __init__(self, rows):
+        self.rows = list(rows)
+
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+    def fetchmany(self, size=2):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+
+class InstrumentationTestCase(unittest.TestCase):
+    """This class represents the request instrumentation test case"""
+
+    def tearDown(self):
+        instrumentation._local.timings = None
+
+    def test_phase_is_a_no_op_outside_requests(self):
+        self.assertIs(phase('db'), phase('auth'))
+
+    def test_phase_accumulates(self):
+        timings = RequestTimings()
+        instrumentation._local.timings = timings
+        with phase('auth'):
+            pass
+        with phase('auth'):
+            pass
+
+        self.assertGreater(timings.phases['auth'], 0.0)
+        self.assertEqual(timings.phases['db'], 0.0)
+
+    def test_counting_cursor(self):
+        timings = RequestTimings()
+        cursor = CountingCursor(FakeCursor([(1,), (2,), (3,), (4,), (5,)]), timings)
+
+        self.assertEqual(cursor.fetchone(), (1,))
+        self.assertEqual(len(cursor.fetchmany(2)), 2)
+        self.assertEqual(len(cursor.fetchall()), 2)
+        self.assertIsNone(cursor.fetchone())
+        self.assertEqual(timings.rows, 5)
+        self.assertEqual(cursor.description, (('id',),))
+
+    def test_metrics_render(self):
+        metrics = Metrics()
+        timings = RequestTimings()
+        timings.statements = 3
+        timings.rows = 10
+        metrics.observe('get_portfolios', 'GET', 200, 0.02, timings)
+        metrics.observe('get_portfolios', 'GET', 200, 0.2, timings)
+        text = metrics.render()
+
+        self.assertIn('http_requests_total{endpoint="get_portfolios",method="GET",status="200"} 2', text)
+        self.assertIn('http_request_duration_seconds_bucket{endpoint="get_portfolios",le="0.025"} 1', text)
+        self.assertIn('http_request_duration_seconds_bucket{endpoint="get_portfolios",le="+Inf"} 2', text)
+        self.assertIn('db_statements_total{endpoint="get_portfolios"} 6', text)
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
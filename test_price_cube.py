@@ -0,0 +1,126 @@
+import unittest, os
+
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from datetime import date
+import shutil, tempfile
+import numpy as np
+from price_cube import PriceCube
+
+
+class PriceCubeTestCase(unittest.TestCase):
+    """This class represents the memory-mapped price cube test case"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='price-cube-')
+        self.rows = [
+            (2, 'Bond', date(2020, 1, 2), 20.0),
+            (1, 'Equity', date(2020, 1, 2), 10.0),
+            (1, 'Bond', date(2020, 1, 3), 11.0),
+            (1, 'Equity', date(2020, 1, 6), 12.0),
+            (2, 'Bond', date(2020, 1, 6), 21.0)
+        ]
+        self.cube = self.make_cube()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def load(self):
+        portfolio_ids, asset_types, dates, prices = zip(*self.rows)
+        return (np.array(portfolio_ids, dtype=np.int64), np.array(asset_types, dtype=object),
+                np.array(dates, dtype='datetime64[D]'), np.array(prices))
+
+    def make_cube(self):
+        return PriceCube(self.directory, loader=self.load, date_headroom=2, series_headroom=1)
+
+    def insert(self, cube, portfolio_id, asset_type, day, price):
+        self.rows.append((portfolio_id, asset_type, day, price))
+        cube.on_write('asset_price_histories', 'insert', [{
+            'portfolio_id': portfolio_id, 'asset_type': asset_type, 'date': day, 'price': price
+        }])
+
+    def test_window(self):
+        keys = self.cube.keys()
+        dates, matrix = self.cube.window(keys)
+
+        self.assertEqual(keys, [(1, 'Bond'), (1, 'Equity'), (2, 'Bond')])
+        self.assertEqual(dates.tolist(), [date(2020, 1, 2), date(2020, 1, 3), date(2020, 1, 6)])
+        np.testing.assert_array_equal(matrix, [[np.nan, 10.0, 20.0], [11.0, np.nan, np.nan], [np.nan, 12.0, 21.0]])
+        self.assertFalse(matrix.flags.writeable)
+
+    def test_adjacent_series_are_views(self):
+        dates, matrix = self.cube.window(self.cube.keys({1}), start=date(2020, 1, 3))
+
+        self.assertEqual(dates.tolist(), [date(2020, 1, 3), date(2020, 1, 6)])
+        self.assertTrue(np.shares_memory(matrix, self.cube.prices))
+        _, gathered = self.cube.window([(1, 'Bond'), (2, 'Bond')])
+        self.assertFalse(np.shares_memory(gathered, self.cube.prices))
+
+    def test_appends_are_shared(self):
+        self.cube.keys()
+        other = self.make_cube()
+        other.keys()
+
+        self.insert(self.cube, 2, 'Bond', date(2020, 1, 7), 22.0)
+        self.insert(self.cube, 3, 'Bond', date(2020, 1, 7), 30.0)
+        dates, matrix = other.window(other.keys())
+
+        self.assertEqual(other.rebuilds, 0)
+        self.assertEqual(dates[-1].item(), date(2020, 1, 7))
+        np.testing.assert_array_equal(matrix[-1], [np.nan, np.nan, 22.0, 30.0])
+        self.assertEqual(self.cube.stats()['appends'], 2)
+
+    def test_in_place_writes_bump_the_version(self):
+        self.cube.keys()
+        other = self.make_cube()
+        version = other.shared_version()
+
+        self.insert(self.cube, 1, 'Bond', date(2020, 1, 6), 13.0)
+
+        self.assertGreater(other.shared_version(), version)
+        _, matrix = other.window([(1, 'Bond')], start=date(2020, 1, 6))
+        self.assertEqual(matrix[0, 0], 13.0)
+
+    def test_write_before_first_read(self):
+        self.insert(self.cube, 1, 'Bond', date(2020, 1, 7), 13.0)
+        dates, matrix = self.cube.window([(1, 'Bond')])
+
+        self.assertEqual(self.cube.appends, 0)
+        self.assertEqual(dates[-1].item(), date(2020, 1, 7))
+        self.assertEqual(matrix[-1, 0], 13.0)
+
+    def test_backfill_rebuilds(self):
+        self.cube.keys()
+        self.insert(self.cube, 1, 'Bond', date(2020, 1, 1), 9.0)
+
+        self.assertTrue(self.cube.stale)
+        dates, matrix = self.make_cube().window([(1, 'Bond')])
+        self.assertEqual(dates[0].item(), date(2020, 1, 1))
+        self.assertEqual(matrix[0, 0], 9.0)
+
+    def test_update_without_previous_values_rebuilds(self):
+        self.cube.keys()
+        # an instance expired by an earlier commit, moved from 2020-01-03 to 2020-01-06
+        self.rows[2] = (1, 'Bond', date(2020, 1, 6), 11.0)
+        self.cube.on_write('asset_price_histories', 'update', [{
+            'portfolio_id': 1, 'asset_type': 'Bond', 'date': date(2020, 1, 6), 'price': 11.0, 'previous': {}
+        }])
+
+        self.assertTrue(self.cube.stale)
+        dates, matrix = self.make_cube().window([(1, 'Bond')])
+        self.assertEqual(dates[~np.isnan(matrix[:, 0])].tolist(), [date(2020, 1, 6)])
+
+    def test_headroom_exhausted_rebuilds(self):
+        self.cube.keys()
+        for day in (7, 8, 9):
+            self.insert(self.cube, 1, 'Bond', date(2020, 1, day), 11.0 + day)
+
+        self.assertTrue(self.cube.stale)
+        dates, _ = self.cube.window([(1, 'Bond')])
+        self.assertEqual(dates[-1].item(), date(2020, 1, 9))
+        self.assertEqual(self.cube.generation, 2)
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,143 @@
+import unittest, os
+from unittest import mock
+
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from datetime import date, timedelta
+import numpy as np
+from sqlalchemy import select
+import resample
+from app import create_app
+from models import AssetPriceHistory, Portfolio, db
+from resample import RESAMPLE_INTERVALS, Rollups, bucket_start, bucket_starts, change_table, compute_bars, next_bucket, \
+    numpy_bars, rollup_table, rollups, series_filters
+
+
+class ResampleTestCase(unittest.TestCase):
+    """This class represents the OHLC resampling test case"""
+
+    def setUp(self):
+        self.dates = [date(1999, 12, 27) + timedelta(days=day) for day in range(0, 400, 3)]
+        self.prices = np.linspace(100.0, 140.0, len(self.dates)) + np.sin(np.arange(len(self.dates)))
+
+    def test_bucket_start(self):
+        self.assertEqual(bucket_start(date(2020, 1, 1), 'week'), date(2019, 12, 30))
+        self.assertEqual(bucket_start(date(2020, 5, 31), 'month'), date(2020, 5, 1))
+        self.assertEqual(bucket_start(date(2020, 12, 31), 'quarter'), date(2020, 10, 1))
+        self.assertEqual(next_bucket(date(2020, 10, 1), 'quarter'), date(2021, 1, 1))
+        self.assertEqual(next_bucket(date(2020, 12, 1), 'month'), date(2021, 1, 1))
+
+    def test_bucket_starts_matches_scalar(self):
+        dates = np.array(self.dates, dtype='datetime64[D]')
+        for interval in RESAMPLE_INTERVALS:
+            self.assertEqual(bucket_starts(dates, interval).tolist(),
+                             [bucket_start(value, interval) for value in self.dates])
+
+    def test_numpy_bars(self):
+        portfolio_ids = np.ones(len(self.dates), dtype=np.int64)
+        asset_types = np.array(['Bond'] * len(self.dates), dtype=object)
+        dates = np.array(self.dates, dtype='datetime64[D]')
+
+        _, _, buckets, opens, highs, lows, closes, counts = numpy_bars(portfolio_ids, asset_types, dates,
+                                                                       self.prices, 'month')
+
+        self.assertEqual(buckets[0].item(), date(1999, 12, 1))
+        self.assertEqual(counts.sum(), len(self.dates))
+        in_january = [price for value, price in zip(self.dates, self.prices) if (value.year, value.month) == (2000, 1)]
+        self.assertEqual(opens[1], in_january[0])
+        self.assertEqual(closes[1], in_january[-1])
+        self.assertEqual(highs[1], max(in_january))
+        self.assertEqual(lows[1], min(in_january))
+
+    def test_numpy_bars_split_series(self):
+        dates = np.array(['2020-01-06', '2020-01-07', '2020-01-06'], dtype='datetime64[D]')
+
+        bars = numpy_bars(np.array([1, 1, 2]), np.array(['Bond', 'Bond', 'Bond'], dtype=object), dates,
+                          np.array([1.0, 2.0, 3.0]), 'week')
+
+        self.assertEqual(bars[0].tolist(), [1, 2])
+        self.assertEqual(bars[-1].tolist(), [2, 1])
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
+
+
+class RollupsTestCase(unittest.TestCase):
+    """This class represents the precomputed OHLC rollups test case"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = create_app()
+        with cls.app.app_context():
+            db.create_all()
+
+    def setUp(self):
+        self.context = self.app.app_context()
+        self.context.push()
+        self.portfolio = Portfolio('Some class', 0.4, 'Some benchmark', 22, 'Some query')
+        self.portfolio.insert()
+        self.prices = []
+        for day in range(0, 60, 3):
+            price = AssetPriceHistory('Bond', 100.0 + day, date(2020, 1, 1) + timedelta(days=day), self.portfolio.id)
+            price.insert()
+            self.prices.append(price)
+
+    def tearDown(self):
+        for table in (change_table, rollup_table, AssetPriceHistory.__table__, Portfolio.__table__):
+            db.session.execute(table.delete())
+        db.session.commit()
+        self.context.pop()
+
+    def assertRollupsMatch(self, asset_type='Bond'):
+        for interval in rollups.intervals:
+            statement = select(rollup_table.c.portfolio_id, rollup_table.c.asset_type, rollup_table.c.bucket,
+                               rollup_table.c.open, rollup_table.c.high, rollup_table.c.low, rollup_table.c.close,
+                               rollup_table.c.count) \
+                .where(rollup_table.c.interval == interval, rollup_table.c.portfolio_id == self.portfolio.id,
+                       rollup_table.c.asset_type == asset_type) \
+                .order_by(rollup_table.c.bucket)
+            self.assertEqual([tuple(row) for row in db.session.execute(statement)],
+                             compute_bars(series_filters(self.portfolio.id, asset_type), interval))
+
+    def test_failed_refresh_is_seen_by_other_processes(self):
+        with mock.patch.object(resample, 'write_rollups', side_effect=RuntimeError('database is gone')):
+            AssetPriceHistory('Bond', 90.0, date(2020, 1, 2), self.portfolio.id).insert()
+
+        # a fresh instance shares nothing with `rollups` but the database
+        self.assertFalse(Rollups().is_fresh(self.portfolio.id, 'Bond'))
+        self.assertTrue(Rollups().is_fresh(self.portfolio.id, 'Equity'))
+        self.assertEqual(rollups.stats()['failures'], 1)
+
+        # the next write refreshes the whole history of the dirty series
+        AssetPriceHistory('Equity', 50.0, date(2020, 1, 2), self.portfolio.id).insert()
+        self.assertTrue(Rollups().is_fresh(self.portfolio.id, 'Bond'))
+        self.assertRollupsMatch('Bond')
+        self.assertRollupsMatch('Equity')
+
+    def test_update_without_previous_values_refreshes_the_series(self):
+        # moved to another month by a writer whose previous values were lost
+        table = AssetPriceHistory.__table__
+        db.session.execute(table.update().where(table.c.id == self.prices[0].id).values(date=date(2020, 3, 30)))
+        db.session.commit()
+        rollups.on_write(table.name, 'update', [{
+            'id': self.prices[0].id, 'asset_type': 'Bond', 'price': 100.0, 'date': date(2020, 3, 30),
+            'portfolio_id': self.portfolio.id, 'previous': {}
+        }])
+
+        self.assertRollupsMatch()
+
+    def test_move_of_an_expired_instance(self):
+        price = self.prices[0]
+        price.date = date(2020, 3, 30)
+        price.asset_type = 'Equity'
+        price.update()
+
+        self.assertRollupsMatch('Bond')
+        self.assertRollupsMatch('Equity')
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
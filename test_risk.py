@@ -0,0 +1,57 @@
+import unittest, os
+
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+import numpy as np
+from risk import covariance_factor, historical_pnl, monte_carlo_pnl, value_at_risk
+from workers import shutdown_process_pool
+
+
+class RiskTestCase(unittest.TestCase):
+    """This class represents the VaR / CVaR test case"""
+
+    def setUp(self):
+        generator = np.random.default_rng(7)
+        self.returns = generator.multivariate_normal([0.001, 0.0], [[1e-4, 5e-5], [5e-5, 4e-4]], size=500)
+        self.weights = np.array([0.75, 0.25])
+
+    @classmethod
+    def tearDownClass(cls):
+        shutdown_process_pool()
+
+    def test_value_at_risk(self):
+        pnl = np.arange(-50.0, 50.0)
+        var, cvar = value_at_risk(pnl, 0.95)
+
+        self.assertAlmostEqual(var, -np.quantile(pnl, 0.05))
+        self.assertAlmostEqual(cvar, -pnl[pnl <= -var].mean())
+        self.assertGreaterEqual(cvar, var)
+
+    def test_historical_horizon(self):
+        pnl = historical_pnl(self.returns, self.weights, horizon=5)
+        daily = self.returns @ self.weights
+
+        self.assertEqual(len(pnl), len(daily) - 4)
+        self.assertAlmostEqual(pnl[3], daily[3:8].sum())
+
+    def test_covariance_factor_singular(self):
+        covariance = np.array([[1.0, 1.0], [1.0, 1.0]])
+        factor = covariance_factor(covariance)
+
+        np.testing.assert_allclose(factor @ factor.T, covariance, atol=1e-12)
+
+    def test_monte_carlo_is_reproducible(self):
+        first = monte_carlo_pnl(self.returns, self.weights, 20000, seed=42, horizon=2, batch_size=5000)
+        second = monte_carlo_pnl(self.returns, self.weights, 20000, seed=42, horizon=2, batch_size=5000)
+        other = monte_carlo_pnl(self.returns, self.weights, 20000, seed=43, horizon=2, batch_size=5000)
+
+        np.testing.assert_array_equal(first, second)
+        self.assertFalse(np.array_equal(first, other))
+
+        expected = np.sqrt(2 * self.weights @ np.cov(self.returns, rowvar=False) @ self.weights)
+        self.assertAlmostEqual(first.std(), expected, delta=expected * 0.05)
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
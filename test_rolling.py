@@ -0,0 +1,57 @@
+import unittest, os
+
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+import numpy as np
+from rolling import WindowSums, rolling_moments
+from serialization import nullable
+
+
+class RollingTestCase(unittest.TestCase):
+    """This class represents the rolling statistics test case"""
+
+    def setUp(self):
+        rng = np.random.default_rng(7)
+        self.returns = rng.normal(0.0005, 0.01, size=(300, 3))
+        self.returns[:40, 2] = np.nan
+        self.benchmark = rng.normal(0.0003, 0.008, size=300)
+
+    def test_window_sums(self):
+        values = np.array([[1.0], [2.0], [np.nan], [4.0], [5.0], [6.0]])
+        sums = WindowSums(values)
+
+        np.testing.assert_array_equal(sums(2).ravel(), [np.nan, 3.0, np.nan, np.nan, 9.0, 11.0])
+        self.assertTrue(np.isnan(sums(7)).all())
+
+    def test_matches_naive_windows(self):
+        window = 30
+        results = rolling_moments(self.returns, [window], ('volatility', 'correlation', 'beta'),
+                                  self.benchmark, periods_per_year=252)[window]
+
+        for end in (29, 45, 69, 299):
+            rows = self.returns[end - window + 1:end + 1]
+            benchmark = self.benchmark[end - window + 1:end + 1]
+            np.testing.assert_allclose(results['volatility'][end, :2], rows[:, :2].std(axis=0, ddof=1) * np.sqrt(252))
+            np.testing.assert_allclose(results['correlation'][end, 0], np.corrcoef(rows[:, 0], rows[:, 1])[0, 1])
+            np.testing.assert_allclose(results['beta'][end, 1],
+                                       np.cov(rows[:, 1], benchmark)[0, 1] / benchmark.var(ddof=1))
+        # the third series starts at row 40
+        self.assertTrue(np.isnan(results['volatility'][68, 2]))
+        np.testing.assert_allclose(results['volatility'][69, 2],
+                                   self.returns[40:70, 2].std(ddof=1) * np.sqrt(252))
+        self.assertTrue(np.isnan(results['correlation'][:29]).all())
+
+    def test_several_windows(self):
+        results = rolling_moments(self.returns[:, :1], [5, 250], ('volatility',))
+
+        self.assertEqual(sorted(results), [5, 250])
+        self.assertEqual(list(results[5]), ['volatility'])
+        self.assertEqual(int(np.isfinite(results[250]['volatility']).sum()), 51)
+
+    def test_nullable(self):
+        self.assertEqual(nullable(np.array([np.nan, 1.5, np.inf])), [None, 1.5, None])
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,170 @@
+import unittest, os
+from unittest import mock
+
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from datetime import date, timedelta
+import random
+import numpy as np
+from sqlalchemy import select
+from app import create_app
+import models
+from ingest import ingest_chunk
+from models import AssetPriceHistory, Portfolio, db
+from snapshots import change_table, merge_windows, snapshot_rows, snapshot_table, snapshots
+
+
+def price_rows(*rows):
+    portfolio_ids, asset_types, dates, prices = zip(*rows)
+    return (np.array(portfolio_ids, dtype=np.int64), np.array(asset_types, dtype=object),
+            np.array(dates, dtype='datetime64[D]'), np.array(prices, dtype=np.float64))
+
+
+class SnapshotsTestCase(unittest.TestCase):
+    """This class represents the portfolio snapshots test case"""
+
+    def setUp(self):
+        self.dates = np.array(['2020-01-02', '2020-01-03', '2020-01-06'], dtype='datetime64[D]')
+        self.portfolios = {1: (0.6, 'Index'), 2: (0.4, 'Index')}
+        self.no_carry = (np.array([], dtype=np.int64), np.array([], dtype=object), np.array([]),
+                         np.array([], dtype='datetime64[D]'))
+
+    def test_prices_are_carried_forward(self):
+        rows = price_rows((1, 'Bond', '2020-01-02', 100.0), (1, 'Bond', '2020-01-02', 101.0),
+                          (1, 'Equity', '2020-01-03', 50.0), (2, 'Bond', '2020-01-06', 10.0))
+
+        dates, portfolio_ids, asset_types, prices, price_dates, weights, benchmark = \
+            snapshot_rows(self.dates, self.no_carry, rows, self.portfolios)
+
+        self.assertEqual(list(zip(dates.tolist(), portfolio_ids.tolist(), asset_types.tolist())), [
+            (date(2020, 1, 2), 1, 'Bond'),
+            (date(2020, 1, 3), 1, 'Bond'), (date(2020, 1, 3), 1, 'Equity'),
+            (date(2020, 1, 6), 1, 'Bond'), (date(2020, 1, 6), 1, 'Equity'), (date(2020, 1, 6), 2, 'Bond')])
+        # the last price of a day wins
+        self.assertEqual(prices.tolist(), [101.0, 101.0, 50.0, 101.0, 50.0, 10.0])
+        self.assertEqual(price_dates[3].item(), date(2020, 1, 2))
+        # split between the series priced that day
+        np.testing.assert_allclose(weights, [0.6, 0.3, 0.3, 0.3, 0.3, 0.4])
+        self.assertFalse(benchmark.any())
+
+    def test_carried_snapshot_and_benchmark(self):
+        carried = (np.array([1, 1, 3]), np.array(['Bond', 'Index', 'Bond'], dtype=object), np.array([99.0, 7.0, 1.0]),
+                   np.array(['2019-12-31'] * 3, dtype='datetime64[D]'))
+        rows = price_rows((1, 'Equity', '2020-01-06', 50.0))
+
+        _, portfolio_ids, asset_types, prices, price_dates, weights, benchmark = \
+            snapshot_rows(self.dates, carried, rows, self.portfolios)
+
+        # portfolio 3 doesn't exist anymore
+        self.assertEqual(set(portfolio_ids.tolist()), {1})
+        self.assertEqual(prices[:2].tolist(), [99.0, 7.0])
+        self.assertEqual(price_dates[0].item(), date(2019, 12, 31))
+        self.assertEqual(benchmark[:2].tolist(), [False, True])
+        self.assertEqual(weights[:2].tolist(), [0.6, 0.6])
+        self.assertEqual(asset_types[-3:].tolist(), ['Bond', 'Equity', 'Index'])
+        np.testing.assert_allclose(weights[-3:], [0.3, 0.3, 0.6])
+
+    def test_merge_windows(self):
+        windows = [(date(2020, 1, 5), date(2020, 1, 9)), (date(2020, 1, 1), date(2020, 1, 3)),
+                   (date(2020, 1, 8), None), (date(2020, 1, 3), date(2020, 1, 4))]
+
+        self.assertEqual(merge_windows(windows), [(date(2020, 1, 1), date(2020, 1, 4)), (date(2020, 1, 5), None)])
+
+
+
+class SnapshotRefreshTestCase(unittest.TestCase):
+    """This class represents the incremental snapshot refresh test case"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = create_app()
+        with cls.app.app_context():
+            db.create_all()
+
+    def setUp(self):
+        self.context = self.app.app_context()
+        self.context.push()
+
+    def tearDown(self):
+        for table in (snapshot_table, change_table, AssetPriceHistory.__table__, Portfolio.__table__):
+            db.session.execute(table.delete())
+        db.session.commit()
+        self.context.pop()
+
+    def snapshot_rows(self):
+        return db.session.execute(select(snapshot_table).order_by(
+            snapshot_table.c.date, snapshot_table.c.portfolio_id, snapshot_table.c.asset_type)).fetchall()
+
+    def test_change_log_commits_with_the_write(self):
+        portfolio = Portfolio('Class 0', 0.5, 'Bond', 0, 'QRY0')
+        portfolio.insert()
+        db.session.execute(change_table.delete())
+        db.session.commit()
+        record = {'asset_type': 'Bond', 'price': 100.0, 'date': '2020-01-02', 'portfolio_id': portfolio.id}
+
+        def fail(table_name, action, changes):
+            raise RuntimeError()
+
+        with mock.patch.object(models, 'write_loggers', models.write_loggers + [fail]):
+            self.assertEqual(ingest_chunk([(1, record)])['accepted'], 0)
+        self.assertEqual(AssetPriceHistory.query.count(), 0)
+        self.assertEqual(db.session.execute(select(change_table)).fetchall(), [])
+
+        self.assertEqual(ingest_chunk([(1, record)])['accepted'], 1)
+        logged = db.session.execute(select(change_table.c.portfolio_id, change_table.c.asset_type,
+                                           change_table.c.first, change_table.c.last)).fetchall()
+        self.assertEqual(logged, [(portfolio.id, 'Bond', date(2020, 1, 2), date(2020, 1, 2))])
+
+    def test_incremental_refresh_matches_full_refresh(self):
+        self.maxDiff = None
+        rng = random.Random(7)
+        days = [date(2020, 1, 1) + timedelta(days=day) for day in range(20)]
+        portfolios = []
+        for i in range(3):
+            portfolio = Portfolio('Class {}'.format(i), 0.3, 'Bond', i, 'QRY{}'.format(i))
+            portfolio.insert()
+            portfolios.append(portfolio)
+        # kept across commits, so most updates see expired attributes
+        prices = []
+        for _ in range(30):
+            price = AssetPriceHistory(rng.choice(('Bond', 'Equity')), rng.uniform(50, 150), rng.choice(days),
+                                      rng.choice(portfolios).id)
+            price.insert()
+            prices.append(price)
+        snapshots.refresh(full=True)
+
+        for step in range(40):
+            kind = rng.choice(('insert', 'move', 'reprice', 'delete', 'weight'))
+            if kind == 'insert':
+                price = AssetPriceHistory(rng.choice(('Bond', 'Equity')), rng.uniform(50, 150), rng.choice(days),
+                                          rng.choice(portfolios).id)
+                price.insert()
+                prices.append(price)
+            elif kind == 'weight':
+                portfolio = rng.choice(portfolios)
+                portfolio.weight = rng.uniform(0.1, 0.5)
+                portfolio.update()
+            elif prices:
+                price = prices.pop(rng.randrange(len(prices)))
+                if step % 2:
+                    # a freshly queried instance, with its previous values
+                    price = AssetPriceHistory.query.get(price.id)
+                if kind == 'delete':
+                    price.delete()
+                elif kind == 'move':
+                    price.date = rng.choice(days)
+                    price.portfolio_id = rng.choice(portfolios).id
+                    price.asset_type = rng.choice(('Bond', 'Equity'))
+                else:
+                    price.price = rng.uniform(50, 150)
+                if kind != 'delete':
+                    price.update()
+                    prices.append(price)
+            snapshots.refresh()
+            incremental = self.snapshot_rows()
+            snapshots.refresh(full=True)
+            self.assertEqual(incremental, self.snapshot_rows(), 'step {}: {}'.format(step, kind))
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
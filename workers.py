@@ -0,0 +1,201 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import get_context, shared_memory
+import json, os, threading, time, uuid
+import numpy as np
+from flask import current_app
+from sqlalchemy import select
+from models import Job, db
+from serialization import dumps
+
+PROCESS_POOL_WORKERS = int(os.environ.get('PROCESS_POOL_WORKERS', os.cpu_count() or 1))
+JOB_THREADS = int(os.environ.get('JOB_THREADS', 2))
+MAX_JOBS = int(os.environ.get('MAX_JOBS', 256))
+# seconds between the heartbeats of the jobs a process is running, a pending
+# or running job that missed JOB_MISSED_HEARTBEATS of them was interrupted
+JOB_HEARTBEAT_INTERVAL = float(os.environ.get('JOB_HEARTBEAT_INTERVAL', 10))
+JOB_MISSED_HEARTBEATS = 3
+ACTIVE_STATUSES = ('pending', 'running')
+
+job_table = Job.__table__
+
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+
+def get_process_pool():
+    """Returns the process pool shared by the CPU heavy jobs, started on first
+    use. Workers are started with forkserver so they don't inherit the web
+    server's threads and locks."""
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            _process_pool = ProcessPoolExecutor(max_workers=PROCESS_POOL_WORKERS,
+                                                mp_context=get_context('forkserver'))
+        return _process_pool
+
+
+def shutdown_process_pool():
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is not None:
+            _process_pool.shutdown()
+            _process_pool = None
+
+
+class SharedArrays:
+    """A group of float64 arrays living in one shared memory block.
+
+    The owner creates the block and passes `spec` (a small tuple of names,
+    shapes and offsets) to the pool, workers call `SharedArrays.attach(spec)`
+    to get views on the same memory instead of receiving pickled copies.
+    """
+
+    def __init__(self, shm, layout, owner):
+        self.shm = shm
+        self.layout = layout
+        self.owner = owner
+        self.arrays = {
+            name: np.ndarray(shape, dtype=np.float64, buffer=shm.buf, offset=offset)
+            for name, (shape, offset) in layout.items()
+        }
+
+    @classmethod
+    def create(cls, **shapes):
+        layout = {}
+        offset = 0
+        for name, shape in shapes.items():
+            shape = tuple(shape)
+            layout[name] = (shape, offset)
+            offset += int(np.prod(shape, dtype=np.int64)) * 8
+        shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        return cls(shm, layout, owner=True)
+
+    @classmethod
+    def attach(cls, spec):
+        name, layout = spec
+        # pool workers share the owner's resource tracker, attaching registers
+        # the same name again which is a no-op, only the owner unlinks
+        shm = shared_memory.SharedMemory(name=name)
+        return cls(shm, layout, owner=False)
+
+    @property
+    def spec(self):
+        return self.shm.name, self.layout
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def close(self):
+        self.arrays = {}
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class JobRegistry:
+    """Runs functions on background threads and keeps their status and result
+    in the jobs table, so any worker process can answer a poll. Only the most
+    recent `max_jobs` jobs are kept.
+
+    While a registry has jobs pending or running, a heartbeat thread stamps
+    their rows every `heartbeat_interval` seconds. A poll of a job whose
+    heartbeat stopped, because the process running it exited, marks it
+    failed with the error "interrupted".
+    """
+
+    def __init__(self, max_jobs=MAX_JOBS, threads=JOB_THREADS, heartbeat_interval=JOB_HEARTBEAT_INTERVAL):
+        self.max_jobs = max_jobs
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='job')
+        self.owner = uuid.uuid4().hex
+        self.heartbeat_interval = heartbeat_interval
+        self.active = 0
+        self._heartbeat = None
+        self._condition = threading.Condition()
+
+    @staticmethod
+    def save(job_id, **values):
+        db.session.execute(job_table.update().where(job_table.c.id == job_id).values(**values))
+        db.session.commit()
+
+    def submit(self, kind, function, *args, **kwargs):
+        """Queues `function(*args, **kwargs)` inside an application context and
+        returns the job id. The result must be JSON serializable."""
+        app = current_app._get_current_object()
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        db.session.execute(job_table.insert().values(id=job_id, kind=kind, status='pending', submitted_at=now,
+                                                     owner=self.owner, heartbeat_at=now))
+        kept = select(job_table.c.id).order_by(job_table.c.submitted_at.desc()).limit(self.max_jobs)
+        db.session.execute(job_table.delete().where(job_table.c.id.notin_(kept.scalar_subquery())))
+        db.session.commit()
+
+        def run():
+            with app.app_context():
+                try:
+                    self.save(job_id, status='running')
+                    result = function(*args, **kwargs)
+                    self.save(job_id, status='done', result=dumps(result).decode('utf-8'), finished_at=time.time())
+                except Exception as e:
+                    db.session.rollback()
+                    self.save(job_id, status='failed', error=str(e) or e.__class__.__name__,
+                              finished_at=time.time())
+                finally:
+                    with self._condition:
+                        self.active -= 1
+                        self._condition.notify()
+
+        with self._condition:
+            self.active += 1
+            if self._heartbeat is None:
+                self._heartbeat = threading.Thread(target=self._beat, args=(app,), name='job-heartbeat',
+                                                   daemon=True)
+                self._heartbeat.start()
+        self.executor.submit(run)
+        return job_id
+
+    def _beat(self, app):
+        with app.app_context():
+            while True:
+                with self._condition:
+                    self._condition.wait_for(lambda: not self.active, self.heartbeat_interval)
+                    if not self.active:
+                        self._heartbeat = None
+                        return
+                try:
+                    db.session.execute(job_table.update()
+                                       .where(job_table.c.owner == self.owner,
+                                              job_table.c.status.in_(ACTIVE_STATUSES))
+                                       .values(heartbeat_at=time.time()))
+                    db.session.commit()
+                except Exception:
+                    # a missed beat, the next one may get through
+                    db.session.rollback()
+
+    def get(self, job_id):
+        # on the primary, the job may have been written a moment ago by another worker
+        statement = select(job_table).where(job_table.c.id == job_id)
+        row = db.session.execute(statement, bind_arguments={'bind': db.engine}).first()
+        if row is None:
+            return None
+        deadline = time.time() - JOB_MISSED_HEARTBEATS * self.heartbeat_interval
+        if row.status in ACTIVE_STATUSES and (row.heartbeat_at is None or row.heartbeat_at < deadline):
+            # unless the job was saved or stamped meanwhile
+            beat = job_table.c.heartbeat_at.is_(None) if row.heartbeat_at is None else \
+                job_table.c.heartbeat_at == row.heartbeat_at
+            db.session.execute(job_table.update()
+                               .where(job_table.c.id == job_id, job_table.c.status == row.status, beat)
+                               .values(status='failed', error='interrupted', finished_at=time.time()))
+            db.session.commit()
+            row = db.session.execute(statement, bind_arguments={'bind': db.engine}).first()
+        job = {name: value for name, value in row._mapping.items() if name not in ('owner', 'heartbeat_at')}
+        job['result'] = json.loads(job['result']) if job['result'] is not None else None
+        return job
+
+
+jobs = JobRegistry()